@@ -0,0 +1,146 @@
+import base64
+import json
+import random
+import threading
+import time
+from collections import deque
+from io import BytesIO
+
+import httpx
+from anthropic import Anthropic
+from PIL import Image
+
+from .synthetic_pdf import has_start_banner
+
+class FakeAnthropicServer:
+    """An in-process stand-in for the Anthropic Messages API.
+
+    Clients built by `client()` are real SDK clients whose HTTP transport is
+    routed here, so the pipeline's request scheduler and instructor's tool
+    parsing run as they would against the real API.
+
+    Each request sleeps `latency` seconds (plus up to `jitter`), fails with a 500
+    at `error_rate`, and gets a 429 with a Retry-After header once more than
+    `rate_limit_rpm` requests arrived in the last minute. Segmentation questions
+    are answered from the synthetic start-page banner, and structured (tool)
+    requests are answered with placeholder values that satisfy the tool schema.
+    Token usage is estimated at four characters per token plus a flat cost per
+    image. Prompt caching is simulated: the prefix up to the last `cache_control`
+    block is remembered, and later requests with the same prefix report it as
+    cache reads, provided it is at least `MIN_CACHE_TOKENS` long.
+    """
+
+    IMAGE_TOKENS = 1500
+    MIN_CACHE_TOKENS = 1024
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rpm=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._recent = deque()
+        self._cached_prefixes = set()
+        self._lock = threading.Lock()
+
+    def client(self, max_retries=0) -> Anthropic:
+        return Anthropic(api_key="benchmark", max_retries=max_retries,
+                         http_client=httpx.Client(transport=httpx.MockTransport(self.handle)))
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 60:
+                self._recent.popleft()
+            if self.rate_limit_rpm is not None and len(self._recent) >= self.rate_limit_rpm:
+                self.rate_limited += 1
+                retry_after = max(60 - (now - self._recent[0]), 0.1)
+                return _error(429, "rate_limit_error", "Synthetic rate limit", {"retry-after": f"{retry_after:.1f}"})
+            self._recent.append(now)
+            fail = self._rng.random() < self.error_rate
+            delay = self.latency + self._rng.random() * self.jitter
+        time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            return _error(500, "api_error", "Synthetic server error")
+
+        if body.get("tools"):
+            tool = body["tools"][0]
+            content = [{"type": "tool_use", "id": f"toolu_{self.requests}", "name": tool["name"],
+                        "input": _fill_schema(tool["input_schema"])}]
+            stop_reason = "tool_use"
+        else:
+            content = [{"type": "text", "text": self._segmentation_answer(body)}]
+            stop_reason = "end_turn"
+        usage = {"input_tokens": self._input_tokens(body), "output_tokens": len(json.dumps(content)) // 4}
+        usage.update(self._cache_usage(body))
+        usage["input_tokens"] -= usage["cache_read_input_tokens"] + usage["cache_creation_input_tokens"]
+        return httpx.Response(200, json={
+            "id": f"msg_{self.requests}", "type": "message", "role": "assistant", "model": body["model"],
+            "content": content, "stop_reason": stop_reason, "stop_sequence": None, "usage": usage,
+        })
+
+    def _cache_usage(self, body) -> dict:
+        blocks = [("system", block) for block in _system_blocks(body)]
+        blocks += [(msg["role"], item) for msg in body["messages"]
+                   for item in (msg["content"] if isinstance(msg["content"], list) else [])]
+        marked = [i for i, (_, block) in enumerate(blocks) if block.get("cache_control")]
+        usage = {"cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        if not marked:
+            return usage
+        prefix = blocks[:marked[-1] + 1]
+        key = json.dumps([body.get("tools"), prefix], sort_keys=True)
+        tokens = self._input_tokens({"system": [block for role, block in prefix if role == "system"],
+                                     "messages": [{"content": [block for role, block in prefix if role != "system"]}]})
+        if tokens < self.MIN_CACHE_TOKENS:
+            return usage
+        with self._lock:
+            hit = key in self._cached_prefixes
+            self._cached_prefixes.add(key)
+        usage["cache_read_input_tokens" if hit else "cache_creation_input_tokens"] = tokens
+        return usage
+
+    def _segmentation_answer(self, body) -> str:
+        images = [item["source"]["data"] for msg in body["messages"] for item in msg["content"]
+                  if isinstance(item, dict) and item.get("type") == "image"]
+        starts = [has_start_banner(Image.open(BytesIO(base64.b64decode(data)))) for data in images]
+        if "new_document_pages" in "".join(block["text"] for block in _system_blocks(body)):
+            return json.dumps({"new_document_pages": [i + 1 for i, start in enumerate(starts) if start and i > 0]})
+        return "YES" if starts and starts[-1] else "NO"
+
+    def _input_tokens(self, body) -> int:
+        text_chars, images = sum(len(block["text"]) for block in _system_blocks(body)), 0
+        for msg in body["messages"]:
+            for item in msg["content"] if isinstance(msg["content"], list) else [msg["content"]]:
+                if isinstance(item, dict) and item.get("type") == "image":
+                    images += 1
+                else:
+                    text_chars += len(json.dumps(item))
+        return text_chars // 4 + images * self.IMAGE_TOKENS
+
+def _system_blocks(body) -> list:
+    system = body.get("system") or []
+    return [{"type": "text", "text": system}] if isinstance(system, str) else system
+
+def _fill_schema(schema: dict) -> dict:
+    values = {}
+    for name, prop in schema.get("properties", {}).items():
+        if prop.get("type") == "array":
+            values[name] = ["synthetic"]
+        elif name == "date":
+            values[name] = "2024-01-01"
+        elif name == "markdown_text":
+            values[name] = "# Synthetic page\n\nTranscribed text."
+        else:
+            values[name] = f"Synthetic {name}"
+    return values
+
+def _error(status: int, error_type: str, message: str, headers=None) -> httpx.Response:
+    return httpx.Response(status, headers=headers,
+                          json={"type": "error", "error": {"type": error_type, "message": message}})
@@ -0,0 +1,207 @@
+"""Pipeline throughput benchmark against a synthetic PDF and a fake provider.
+
+    python -m benchmarks.run --pages 60 --documents 8 --content mixed --latency 0.5
+
+Each stage is timed on its own and then the whole pipeline runs end to end,
+reporting pages per second and peak resident memory. No API credits are used.
+Rendering needs poppler, as in normal runs.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from src.anthropic_client import AnthropicClient
+from src.db import init_db, DocumentWriter
+from src.doc_extractor import extract_document_data
+from src.doc_segmenter import segment_document, BoundaryPrefilter
+from src.instructor_client import InstructorClient
+from src.metrics import metrics
+from src.rate_limit import configure_scheduler
+from src.pdf_utils import PageSource, ImageEncoding, ImageProfile, PdfOutputs, extract_pages_text
+from src.transcriber import DocumentTranscriber, TextLayerCheck
+
+from .fake_provider import FakeAnthropicServer
+from .synthetic_pdf import make_synthetic_pdf
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs (e.g. macOS): fall back to the lifetime peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MemorySampler:
+    """Samples resident memory on a background thread and keeps the peak."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = _rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+class Benchmark:
+    def __init__(self, pages: int):
+        self.pages = pages
+        self.results = []
+
+    @contextmanager
+    def stage(self, name: str):
+        print(f"\n=== {name} ===")
+        started = time.perf_counter()
+        with MemorySampler() as sampler:
+            yield
+        elapsed = time.perf_counter() - started
+        self.results.append(dict(stage=name, seconds=elapsed, pages_per_second=self.pages / elapsed if elapsed else 0.0,
+                                 peak_rss_mb=sampler.peak / (1024 * 1024)))
+
+    def report(self) -> str:
+        lines = [f"{'stage':<16}{'seconds':>10}{'pages/s':>10}{'peak RSS MB':>14}"]
+        for r in self.results:
+            lines.append(f"{r['stage']:<16}{r['seconds']:>10.2f}{r['pages_per_second']:>10.1f}{r['peak_rss_mb']:>14.1f}")
+        return "\n".join(lines)
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bookmarker_bench_")
+    pdf_path = os.path.join(workdir, "synthetic.pdf")
+    starts = make_synthetic_pdf(pdf_path, args.pages, args.documents, args.content, args.page_numbers, args.seed)
+    print(f"Generated {args.pages}-page {args.content} PDF with {len(starts)} documents at {pdf_path}")
+
+    server = FakeAnthropicServer(args.latency, args.jitter, args.error_rate, args.rpm, args.seed)
+    configure_scheduler("anthropic", rpm=args.client_rpm, max_concurrency=args.max_concurrency, base_delay=0.1)
+    api_client = AnthropicClient(api_key="benchmark")
+    api_client.client = server.client()
+    model_client = server.client()
+    instructor_client = InstructorClient(model_client, "anthropic")
+    prefilter = BoundaryPrefilter() if args.prefilter else None
+    text_layer_check = TextLayerCheck() if args.text_fast_path != "off" else None
+    image_profile = ImageProfile(dpi=args.dpi, encoding=ImageEncoding(format=args.image_format)).for_provider("anthropic")
+    segmentation_profile = ImageProfile(dpi=args.segmentation_dpi,
+                                        encoding=ImageEncoding(format=args.image_format, grayscale=True))
+    bench = Benchmark(args.pages)
+    metrics.reset()
+
+    with bench.stage("text_layer"):
+        page_texts = extract_pages_text(pdf_path)
+
+    with PageSource(pdf_path, dpi=image_profile.dpi, encoding=image_profile.encoding) as pages, \
+            PageSource(pdf_path, dpi=segmentation_profile.dpi, encoding=segmentation_profile.encoding) as thumbnails:
+        with bench.stage("render_encode"):
+            for i in range(len(pages)):
+                pages.encoded(i)
+
+        with bench.stage("render_lowres"):
+            for i in range(len(thumbnails)):
+                thumbnails.encoded(i)
+
+        with bench.stage("segmentation"):
+            segments = segment_document(api_client, thumbnails, max_workers=args.page_workers, page_texts=page_texts,
+                                        prefilter=prefilter, mode=args.segmentation_mode)
+
+        transcriber = DocumentTranscriber(model_client, "anthropic", max_workers=args.page_workers,
+                                          text_layer_check=text_layer_check, text_mode=args.text_fast_path)
+        with bench.stage("extraction"):
+            docs_data = extract_document_data(instructor_client, transcriber, pdf_path, segments,
+                                              os.path.join(workdir, "stages"), pages, page_texts,
+                                              metadata_mode=args.metadata_mode)
+
+    titles = [f"{d[0].title} {i}" for i, d in enumerate(docs_data)]
+    dates = [d[0].date for d in docs_data]
+    with bench.stage("write_outputs"), PdfOutputs(pdf_path) as outputs:
+        outputs.bookmarked(segments, titles, dates, os.path.join(workdir, "bookmarked.pdf"))
+        doc_pdfs = [outputs.split(start, end, os.path.join(workdir, "stages"), title, date)
+                    for (start, end), title, date in zip(segments, titles, dates)]
+
+    db_path = os.path.join(workdir, "stages.db")
+    init_db(db_path)
+    with bench.stage("db_insert"), DocumentWriter(db_path) as writer:
+        writer.insert_documents([
+            dict(title=meta.title, date=meta.date, summary=meta.summary, original_filename=os.path.basename(path),
+                 tags=meta.tags, full_text=full_text, markdown_transcription=markdown, page_transcriptions=page_markdowns,
+                 page_texts=page_texts[start:end+1])
+            for path, (meta, full_text, markdown, page_markdowns), (start, end) in zip(doc_pdfs, docs_data, segments)
+        ])
+
+    # End to end through the same entry point main() uses
+    from main import process_single_pdf
+    full_db = os.path.join(workdir, "full.db")
+    full_output = os.path.join(workdir, "full")
+    os.makedirs(full_output)
+    init_db(full_db)
+    with bench.stage("full_pipeline"):
+        process_single_pdf(pdf_path, full_output, full_db, api_client, instructor_client, model_client, "anthropic",
+                           page_workers=args.page_workers, prefilter=prefilter, image_profile=image_profile,
+                           segmentation_profile=segmentation_profile,
+                           segmentation_mode=args.segmentation_mode, resume=False, document_workers=args.document_workers,
+                           text_layer_check=text_layer_check, text_mode=args.text_fast_path)
+
+    found = [start for start, _ in segments]
+    return dict(
+        config=vars(args),
+        workdir=workdir,
+        stages=bench.results,
+        table=bench.report(),
+        segmentation_correct=found == starts,
+        provider=dict(requests=server.requests, rate_limited=server.rate_limited, errors=server.errors),
+        metrics=metrics.snapshot(),
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on a synthetic PDF with a fake model provider")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--documents", type=int, default=6)
+    parser.add_argument("--content", choices=["text", "scan", "mixed"], default="mixed")
+    parser.add_argument("--page-numbers", action="store_true", help="add 'Page k of n' footers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="extra random latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with a 500")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute before the fake returns 429s")
+    parser.add_argument("--client-rpm", type=int, default=None, help="requests per minute the pipeline paces itself to")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="most model requests in flight at once")
+    parser.add_argument("--page-workers", type=int, default=4)
+    parser.add_argument("--document-workers", type=int, default=2)
+    parser.add_argument("--segmentation-mode", choices=["pairwise", "window"], default="pairwise")
+    parser.add_argument("--no-prefilter", dest="prefilter", action="store_false")
+    parser.add_argument("--text-fast-path", choices=["llm", "local", "off"], default="llm")
+    parser.add_argument("--metadata-mode", choices=["text", "images"], default="text")
+    parser.add_argument("--image-format", default="JPEG")
+    parser.add_argument("--dpi", type=int, default=150, help="render resolution for transcription and metadata")
+    parser.add_argument("--segmentation-dpi", type=int, default=72, help="render resolution for segmentation")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print("\n" + results["table"])
+    provider = results["provider"]
+    print(f"\nFake provider: {provider['requests']} requests, {provider['rate_limited']} rate limited, "
+          f"{provider['errors']} errors")
+    print(f"Segmentation matched the generated documents: {results['segmentation_correct']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({k: v for k, v in results.items() if k != "table"}, f, indent=2)
+        print(f"Results written to {args.json}")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfReader, PdfWriter
+
+# US Letter in PDF points; scanned pages are drawn at SCAN_DPI
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+SCAN_DPI = 100
+# Document start pages carry a dark banner across the top, where letterheads sit
+BANNER_TOP, BANNER_HEIGHT = 28, 24
+WORDS = """the court motion order plaintiff defendant agreement party shall notice hearing filed exhibit counsel
+request response production documents entergy power supply contract rate commission customer facility
+generation capacity energy section provided pursuant thereof herein testimony witness record discovery""".split()
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 16))]
+    return " ".join(words).capitalize() + "."
+
+def _page_lines(rng: random.Random, count: int) -> list[str]:
+    lines, line = [], ""
+    while len(lines) < count:
+        sentence = _sentence(rng)
+        if len(line) + len(sentence) > 90:
+            lines.append(line)
+            line = ""
+        line = f"{line} {sentence}".strip()
+    return lines
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def _text_page_pdf(title: str, lines: list[str], banner: bool, footer: str = None) -> bytes:
+    """A one-page PDF with a real text layer, written by hand so no PDF library is needed."""
+    ops = []
+    if banner:
+        ops.append(f"0 g 54 {PAGE_HEIGHT - BANNER_TOP - BANNER_HEIGHT} {PAGE_WIDTH - 108} {BANNER_HEIGHT} re f")
+    ops.append(f"BT /F1 14 Tf 72 {PAGE_HEIGHT - 90} Td ({_escape(title)}) Tj ET")
+    ops.append(f"BT /F1 10 Tf 13 TL 72 {PAGE_HEIGHT - 120} Td")
+    ops += [f"({_escape(line)}) Tj T*" for line in lines]
+    ops.append("ET")
+    if footer:
+        ops.append(f"BT /F1 9 Tf {PAGE_WIDTH // 2 - 30} 40 Td ({_escape(footer)}) Tj ET")
+    stream = "\n".join(ops).encode("latin-1")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+        f"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+    ]
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+def _scan_page_pdf(title: str, lines: list[str], banner: bool, footer: str, rng: random.Random) -> bytes:
+    """A one-page image-only PDF, like a scanner produces: no text layer, some speckle noise."""
+    scale = SCAN_DPI / 72
+    img = Image.new("L", (int(PAGE_WIDTH * scale), int(PAGE_HEIGHT * scale)), 250)
+    draw = ImageDraw.Draw(img)
+    if banner:
+        draw.rectangle([54 * scale, BANNER_TOP * scale, (PAGE_WIDTH - 54) * scale, (BANNER_TOP + BANNER_HEIGHT) * scale],
+                       fill=0)
+    draw.text((72 * scale, 90 * scale), title, fill=20)
+    for i, line in enumerate(lines):
+        draw.text((72 * scale, (120 + 13 * i) * scale), line, fill=30)
+    if footer:
+        draw.text(((PAGE_WIDTH // 2 - 30) * scale, (PAGE_HEIGHT - 40) * scale), footer, fill=30)
+    for _ in range(400):
+        x, y = rng.randrange(img.width), rng.randrange(img.height)
+        draw.point((x, y), fill=rng.randint(0, 120))
+    out = BytesIO()
+    img.save(out, format="PDF", resolution=SCAN_DPI)
+    return out.getvalue()
+
+def make_synthetic_pdf(path: str, pages: int = 20, documents: int = 4, content: str = "text",
+                       page_numbers: bool = False, seed: int = 0) -> list[int]:
+    """Write a PDF of `documents` documents spread over `pages` pages and return their 0-based start pages.
+
+    `content` is "text" (born-digital pages with a text layer), "scan" (image-only
+    pages) or "mixed" (alternating by document). Every document's first page has a
+    dark banner across the top so visual and fake-model segmentation can find it.
+    With `page_numbers`, pages carry "Page k of n" footers, which the boundary
+    pre-classifier settles without a model call.
+    """
+    if content not in ("text", "scan", "mixed"):
+        raise ValueError("content must be text, scan or mixed")
+    if not 1 <= documents <= pages:
+        raise ValueError("documents must be between 1 and pages")
+    rng = random.Random(seed)
+    starts = sorted([0] + rng.sample(range(1, pages), documents - 1))
+    bounds = list(zip(starts, starts[1:] + [pages]))
+
+    writer = PdfWriter()
+    # PyPDF2's writer remembers copied objects by id() of their reader, so every reader is kept
+    # alive until the file is written; a freed one's id can be reused and pull in another page
+    readers = []
+    for doc, (start, end) in enumerate(bounds):
+        scanned = content == "scan" or (content == "mixed" and doc % 2 == 1)
+        for p in range(start, end):
+            title = f"EXHIBIT {doc + 1}" if p == start else f"Exhibit {doc + 1} (continued)"
+            footer = f"Page {p - start + 1} of {end - start}" if page_numbers else None
+            lines = _page_lines(rng, 40)
+            if scanned:
+                page_pdf = _scan_page_pdf(title, lines, p == start, footer, rng)
+            else:
+                page_pdf = _text_page_pdf(title, lines, p == start, footer)
+            readers.append(PdfReader(BytesIO(page_pdf)))
+            writer.add_page(readers[-1].pages[0])
+    with open(path, "wb") as f:
+        writer.write(f)
+    return starts
+
+def has_start_banner(img) -> bool:
+    """True if a rendered page has the document-start banner."""
+    thumb = img.convert("L").resize((100, 100))
+    top = round(100 * (BANNER_TOP + 4) / PAGE_HEIGHT)
+    bottom = round(100 * (BANNER_TOP + BANNER_HEIGHT - 4) / PAGE_HEIGHT)
+    band = [thumb.getpixel((x, y)) for y in range(top, bottom + 1) for x in range(20, 80)]
+    return sum(band) / len(band) < 100
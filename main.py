@@ -1,18 +1,36 @@
+import argparse
 import os
+import signal
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 from src.anthropic_client import AnthropicClient
-from src.instructor_client import InstructorClient, DocumentMetadata
-from src.doc_segmenter import segment_document
-from src.pdf_utils import extract_pages_as_images, add_bookmarks, split_documents
-from src.db import init_db, insert_document
+from src.instructor_client import InstructorClient
+from src.doc_segmenter import iter_segments, BoundaryPrefilter
+from src.pdf_utils import PageSource, ImageEncoding, ImageProfile, PdfOutputs, extract_pages_text
+from src.db import init_db, DocumentWriter, search_documents, compress_text_storage
 from anthropic import Anthropic
-from src.doc_extractor import extract_document_data
-from src.transcriber import DocumentTranscriber
+from src.doc_extractor import extract_single_document, prefetch_batch
+from src.dedup import DuplicateIndex
+from src.transcriber import DocumentTranscriber, TextLayerCheck
 from openai import OpenAI
 from src.openai_client import OpenAIClient
+from src.cache import ResponseCache
+from src.checkpoint import PipelineCheckpoint, segment_key
+from src.batch import BatchRunner, AnthropicBatchBackend, OpenAIBatchBackend
+from src.metrics import metrics
+from src.rate_limit import configure_scheduler, scheduler_for, http_client
+from src.watcher import FolderWatcher, move_aside
 
-def process_single_pdf(pdf_path: str, output_dir: str, db_path: str, api_client, instructor_client, model_client, model_provider):
+def process_single_pdf(pdf_path: str, output_dir: str, db_path: str, api_client, instructor_client, model_client, model_provider,
+                       cache=None, spill_pages=False, page_memory_budget=512 * 1024 * 1024, page_workers=1,
+                       prefilter=None, image_profile=ImageProfile(), segmentation_profile=None,
+                       segmentation_mode="pairwise", segmentation_window=8, segmentation_overlap=2, resume=True,
+                       text_layer_check=None, text_mode="llm", batch_runner=None, document_workers=2,
+                       metadata_mode="text", duplicate_options=None):
     # Get the PDF filename without extension to use as subdirectory name
     pdf_name = Path(pdf_path).stem
     pdf_output_dir = os.path.join(output_dir, pdf_name)
@@ -22,60 +40,285 @@ def process_single_pdf(pdf_path: str, output_dir: str, db_path: str, api_client,
     print(f"\nProcessing {pdf_path}")
     print(f"Output will be saved to {pdf_output_dir}")
 
-    # Extract pages as images
-    print("Extracting pages from PDF...")
-    pdf_images = extract_pages_as_images(pdf_path)
-    print(f"Extracted {len(pdf_images)} pages")
+    # Progress is checkpointed per stage so a re-run picks up where this one stopped
+    checkpoint = PipelineCheckpoint(db_path, pdf_path) if resume else None
+    if checkpoint is not None and checkpoint.is_complete():
+        print(f"Skipping {pdf_path}: already processed")
+        return len(checkpoint.get("segments") or [])
 
-    # Segment the PDF into documents
-    print("Segmenting PDF into separate documents...")
-    segments = segment_document(api_client, pdf_images) 
-    print(f"Found {len(segments)} distinct documents")
+    # Pages are rendered lazily in chunks within the memory budget. Segmentation only judges layout, so
+    # unless its profile matches it gets its own low-resolution render, and full-resolution pages are only
+    # rendered for the pages transcription and metadata actually send
+    image_profile = image_profile.for_provider(model_provider)
+    segmentation_profile = (segmentation_profile or image_profile).for_provider(model_provider)
+    separate = segmentation_profile != image_profile
+    print("Opening PDF pages...")
+    with PageSource(pdf_path, dpi=image_profile.dpi, spill_to_disk=spill_pages,
+                    memory_budget=page_memory_budget * 3 // 4 if separate else page_memory_budget,
+                    encoding=image_profile.encoding) as pages, \
+            (PageSource(pdf_path, dpi=segmentation_profile.dpi, spill_to_disk=spill_pages,
+                        memory_budget=page_memory_budget // 4, encoding=segmentation_profile.encoding)
+             if separate else nullcontext(pages)) as segmentation_pages:
+        print(f"PDF has {len(pages)} pages")
 
-    # Initialize transcriber
-    transcriber = DocumentTranscriber(model_client, model_provider)
-    
-    # Extract metadata and transcribe
-    print("Extracting metadata from documents...")
-    docs_data = extract_document_data(instructor_client, transcriber, pdf_path, segments, pdf_output_dir)
-    print(f"Extracted metadata for {len(docs_data)} documents")
-
-    # Create bookmarks in the original PDF
-    print("Adding bookmarks to PDF...")
-    doc_titles = [d[0].title for d in docs_data]
-    doc_dates = [d[0].date for d in docs_data]
-    doc_start_pages = [s[0] for s in segments]
-    add_bookmarks(pdf_path, doc_start_pages, doc_titles, output_pdf, doc_dates)
-    print("Bookmarks added successfully")
-
-    # Split documents into separate PDFs
-    print("Splitting into separate PDFs...")
-    doc_pdfs = list(split_documents(pdf_path, segments, pdf_output_dir, doc_titles, doc_dates))
-    print(f"Created {len(doc_pdfs)} separate PDF files")
-
-    # Insert metadata into DB
-    print("Inserting document metadata into database...")
-    for doc_path, (doc_meta, full_text, full_markdown, page_markdowns) in zip(doc_pdfs, docs_data):
-        insert_document(
-            db_path, 
-            doc_meta.title, 
-            doc_meta.date, 
-            doc_meta.summary, 
-            os.path.basename(doc_path), 
-            doc_meta.tags,
-            full_text,
-            full_markdown,
-            page_markdowns
-        )
-        print(f"Inserted metadata for document: {doc_meta.title}")
+        # The text layer feeds both the boundary pre-classifier and extraction
+        print("Extracting text layer...")
+        with metrics.stage("text_layer"):
+            page_texts = extract_pages_text(pdf_path)
+
+        transcriber = DocumentTranscriber(model_client, model_provider, cache=cache, max_workers=page_workers,
+                                          text_layer_check=text_layer_check, text_mode=text_mode)
+
+        # Segment the PDF into documents, streaming each one out as soon as its closing boundary is found
+        saved_segments = checkpoint.get("segments") if checkpoint is not None else None
+        if saved_segments is not None:
+            print("Reusing checkpointed segmentation")
+            segment_stream = [tuple(segment) for segment in saved_segments]
+        else:
+            print("Segmenting PDF into separate documents...")
+            segment_stream = iter_segments(api_client, segmentation_pages, max_workers=page_workers, page_texts=page_texts,
+                                           prefilter=prefilter, mode=segmentation_mode, window_size=segmentation_window,
+                                           window_overlap=segmentation_overlap, batch_runner=batch_runner)
+
+        duplicates = DuplicateIndex(db_path, **duplicate_options) if duplicate_options is not None else None
+        if batch_runner is not None:
+            # Batching needs every request up front, so segmentation finishes before documents start
+            segment_stream = list(metrics.timed("segmentation", segment_stream))
+            prefetch_batch(batch_runner, instructor_client, transcriber, pages, segment_stream, page_texts, checkpoint,
+                           metadata_mode, duplicates)
+
+        saved_files = checkpoint.get_all("files") if checkpoint is not None else {}
+        inserted = checkpoint.get_all("db") if checkpoint is not None else {}
+        db_lock = threading.Lock()
+
+        def finish_document(i, segment):
+            """Transcribe, describe, split and store one document while later ones are still being found."""
+            # Documents stored earlier, including earlier ones from this PDF, may already cover these pages
+            duplicate = duplicates.match(pages, page_texts, segment) if duplicates is not None else None
+            doc = extract_single_document(instructor_client, transcriber, pages, page_texts, segment, pdf_output_dir,
+                                          checkpoint, metadata_mode, duplicate)
+            doc_meta, full_text, full_markdown, page_markdowns = doc
+            # Results are keyed by page range, so they can't be matched to the wrong document if a
+            # re-run segments differently before the segments are checkpointed
+            doc_path = saved_files.get(segment_key(segment))
+            if doc_path and os.path.exists(doc_path):
+                print(f"Reusing previously written PDF for document {i+1}")
+            else:
+                doc_path = outputs.split(segment[0], segment[1], pdf_output_dir, doc_meta.title, doc_meta.date)
+                if checkpoint is not None:
+                    checkpoint.save("files", doc_path, segment_key(segment))
+            if segment_key(segment) in inserted:
+                print(f"Document {i+1} already in database")
+            else:
+                # Each document is inserted with its checkpoint in one transaction on the PDF's writer
+                with db_lock, metrics.stage("db_insert"):
+                    try:
+                        doc_id = writer.insert_documents([dict(
+                            title=doc_meta.title,
+                            date=doc_meta.date,
+                            summary=doc_meta.summary,
+                            original_filename=os.path.basename(doc_path),
+                            tags=doc_meta.tags,
+                            full_text=full_text,
+                            markdown_transcription=full_markdown,
+                            page_transcriptions=page_markdowns,
+                            page_texts=page_texts[segment[0]:segment[1]+1],
+                            **(dict(duplicate_of=duplicate.document[0] if duplicate.document else None,
+                                    page_duplicates=duplicate.page_links(),
+                                    page_fingerprints=duplicate.fingerprints) if duplicate is not None else {}),
+                        )], commit=False)[0]
+                        if checkpoint is not None:
+                            checkpoint.save("db", doc_id, segment_key(segment), conn=writer.conn)
+                        writer.commit()
+                    except Exception:
+                        writer.rollback()
+                        raise
+                print(f"Inserted metadata for document {i+1}")
+            return doc
 
+        # Documents are processed by their own workers while segmentation carries on
+        print(f"Processing documents as they are found with {document_workers} worker(s)...")
+        with PdfOutputs(pdf_path) as outputs, DocumentWriter(db_path, shared=True) as writer:
+            with ThreadPoolExecutor(max_workers=max(document_workers, 1)) as executor:
+                segments, futures = [], []
+                # Only finding the segments is timed, not the document workers running alongside;
+                # in batch mode they were already found (and timed) above
+                found = metrics.timed("segmentation", segment_stream) if batch_runner is None else segment_stream
+                for i, segment in enumerate(found):
+                    segments.append(segment)
+                    futures.append(executor.submit(finish_document, i, segment))
+                print(f"Found {len(segments)} distinct documents")
+                if checkpoint is not None and saved_segments is None:
+                    checkpoint.save("segments", segments)
+                docs_data = [future.result() for future in futures]
+            print(f"Extracted metadata for {len(docs_data)} documents")
+            if text_layer_check is not None:
+                print(f"Transcribed {transcriber.text_pages} pages from their text layer without images")
+
+            # The bookmarked copy needs every title, so it is written last
+            if os.path.exists(output_pdf) and all(segment_key(segment) in saved_files for segment in segments):
+                print("Reusing previously written bookmarked PDF")
+            else:
+                print("Adding bookmarks...")
+                outputs.bookmarked(segments, [d[0].title for d in docs_data], [d[0].date for d in docs_data], output_pdf)
+
+    if checkpoint is not None:
+        checkpoint.mark_complete()
     return len(segments)
 
+def create_clients(model_provider: str, cache=None):
+    """Build the segmentation, raw model and instructor clients for a provider.
+
+    All of them share the provider's request scheduler, which does the retrying
+    and reads the rate limit headers of every response, so the SDK clients' own
+    retries are turned off.
+    """
+    scheduler = scheduler_for(model_provider)
+    if model_provider == "anthropic":
+        api_client = AnthropicClient(cache=cache)
+        model_client = Anthropic(max_retries=0, http_client=http_client(model_provider, scheduler))
+    else:
+        api_client = OpenAIClient(cache=cache)
+        model_client = OpenAI(max_retries=0, http_client=http_client(model_provider, scheduler))
+    instructor_client = InstructorClient(model_client, model_provider, cache=cache)
+    return api_client, model_client, instructor_client
+
+def create_batch_runner(model_provider: str, model_client, cache, poll_interval=60):
+    """Batch runner over the provider's batch API, feeding results into `cache`."""
+    if model_provider == "anthropic":
+        backend = AnthropicBatchBackend(model_client)
+    else:
+        backend = OpenAIBatchBackend(model_client)
+    return BatchRunner(backend, cache, poll_interval=poll_interval)
+
+# Per-process state for the PDF worker pool; each worker builds its own clients
+_worker_state = {}
+
+def _init_pdf_worker(model_provider: str, cache_path: str, cache_max_bytes: int, batch_poll_interval=None,
+                     scheduler_options=None):
+    if scheduler_options is not None:
+        configure_scheduler(model_provider, **scheduler_options)
+    cache = ResponseCache(cache_path, max_bytes=cache_max_bytes)
+    api_client, model_client, instructor_client = create_clients(model_provider, cache)
+    batch_runner = None
+    if batch_poll_interval is not None:
+        batch_runner = create_batch_runner(model_provider, model_client, cache, batch_poll_interval)
+    _worker_state.update(
+        model_provider=model_provider,
+        cache=cache,
+        api_client=api_client,
+        model_client=model_client,
+        instructor_client=instructor_client,
+        batch_runner=batch_runner,
+    )
+
+def _process_pdf_in_worker(pdf_path: str, output_dir: str, db_path: str, options: dict):
+    cache = _worker_state["cache"]
+    hits, misses = cache.hits, cache.misses
+    # Metrics are collected per task and merged into the parent's registry
+    metrics.reset()
+    num_docs = process_single_pdf(
+        pdf_path,
+        output_dir,
+        db_path,
+        _worker_state["api_client"],
+        _worker_state["instructor_client"],
+        _worker_state["model_client"],
+        _worker_state["model_provider"],
+        cache,
+        batch_runner=_worker_state.get("batch_runner"),
+        **options
+    )
+    return num_docs, cache.hits - hits, cache.misses - misses, metrics.snapshot()
+
+def scheduler_options_from_env(processes: int = 1) -> dict:
+    """Rate limits for the shared request scheduler; worker processes split the account's limits evenly."""
+    rpm = os.environ.get("RATE_LIMIT_RPM", "")
+    tpm = os.environ.get("RATE_LIMIT_TPM", "")
+    return dict(
+        rpm=int(rpm) if rpm else None,
+        tpm=int(tpm) if tpm else None,
+        max_concurrency=int(os.environ.get("MAX_CONCURRENT_REQUESTS", "8")),
+        max_retries=int(os.environ.get("API_MAX_RETRIES", "5")),
+        share=1 / max(processes, 1),
+    )
+
+def image_profile_from_env(prefix: str, dpi: int, grayscale: bool) -> ImageProfile:
+    """A stage's image profile from PREFIX_DPI, PREFIX_MAX_EDGE, PREFIX_GRAYSCALE, PREFIX_BINARIZE and
+    PREFIX_CROP_MARGINS; the file format and quality are shared by every stage."""
+    def flag(name, default=False):
+        return os.environ.get(f"{prefix}_{name}", str(default)).lower() in ("1", "true", "yes")
+
+    max_edge = os.environ.get(f"{prefix}_MAX_EDGE", "")
+    return ImageProfile(
+        dpi=int(os.environ.get(f"{prefix}_DPI", str(dpi))),
+        encoding=ImageEncoding(
+            format=os.environ.get("IMAGE_FORMAT", "JPEG").upper(),
+            quality=int(os.environ.get("IMAGE_QUALITY", "85")),
+            grayscale=flag("GRAYSCALE", grayscale),
+            binarize=flag("BINARIZE"),
+            crop_margins=flag("CROP_MARGINS"),
+            max_long_edge=int(max_edge) if max_edge else None,
+        ),
+    )
+
+def pipeline_options_from_env() -> dict:
+    """Per-PDF pipeline options passed through to process_single_pdf."""
+    prefilter = None
+    if os.environ.get("BOUNDARY_PREFILTER", "true").lower() in ("1", "true", "yes"):
+        prefilter = BoundaryPrefilter(
+            continuation_threshold=float(os.environ.get("PREFILTER_CONTINUATION_THRESHOLD", "0.9")),
+            new_document_threshold=float(os.environ.get("PREFILTER_NEW_DOCUMENT_THRESHOLD", "0.2")),
+        )
+    duplicate_options = None
+    if os.environ.get("NEAR_DUPLICATES", "").lower() in ("1", "true", "yes"):
+        duplicate_options = dict(
+            min_text_similarity=float(os.environ.get("DUPLICATE_TEXT_SIMILARITY", "0.9")),
+            max_image_distance=int(os.environ.get("DUPLICATE_IMAGE_DISTANCE", "12")),
+            max_ink_difference=float(os.environ.get("DUPLICATE_INK_DIFFERENCE", "0.12")),
+        )
+    text_fast_path = os.environ.get("TEXT_FAST_PATH", "llm").lower()
+    text_layer_check = None
+    if text_fast_path in ("llm", "local"):
+        text_layer_check = TextLayerCheck(
+            min_chars=int(os.environ.get("TEXT_MIN_CHARS", "300")),
+            min_word_ratio=float(os.environ.get("TEXT_MIN_WORD_RATIO", "0.7")),
+        )
+    return dict(
+        spill_pages=os.environ.get("SPILL_PAGES", "").lower() in ("1", "true", "yes"),
+        page_memory_budget=int(os.environ.get("PAGE_MEMORY_MB", "512")) * 1024 * 1024,
+        page_workers=int(os.environ.get("PAGE_WORKERS", "4")),
+        prefilter=prefilter,
+        image_profile=image_profile_from_env("IMAGE", dpi=150, grayscale=False),
+        segmentation_profile=image_profile_from_env("SEGMENTATION", dpi=72, grayscale=True),
+        segmentation_mode=os.environ.get("SEGMENTATION_MODE", "pairwise").lower(),
+        segmentation_window=int(os.environ.get("SEGMENTATION_WINDOW", "8")),
+        segmentation_overlap=int(os.environ.get("SEGMENTATION_OVERLAP", "2")),
+        resume=os.environ.get("RESUME", "true").lower() in ("1", "true", "yes"),
+        document_workers=int(os.environ.get("DOCUMENT_WORKERS", "2")),
+        text_layer_check=text_layer_check,
+        text_mode=text_fast_path,
+        metadata_mode=os.environ.get("METADATA_MODE", "text").lower(),
+        duplicate_options=duplicate_options,
+    )
+
 def main():
     # Configuration
     input_dir = "input_dir"
     output_dir = "output_dir"
     db_path = "documents.db"
+    cache_path = "llm_cache.db"
+    cache_max_bytes = int(os.environ.get("LLM_CACHE_MAX_MB", "1024")) * 1024 * 1024
+    pdf_workers = int(os.environ.get("PDF_WORKERS", "1"))
+    # Batch mode sends requests through the provider's discounted batch API and
+    # waits for the results; it suits offline bulk ingestion, not quick runs
+    execution_mode = os.environ.get("EXECUTION_MODE", "interactive").lower()
+    batch_poll_interval = int(os.environ.get("BATCH_POLL_SECONDS", "60")) if execution_mode == "batch" else None
+    # Per-stage timings, token counts and payload sizes for the whole run
+    metrics_report = os.environ.get("METRICS_REPORT", "run_report.json")
+    metrics_prom_file = os.environ.get("METRICS_PROM_FILE", "")
+    options = pipeline_options_from_env()
+    scheduler_options = scheduler_options_from_env(pdf_workers)
     
     # Get model choice from environment or user input
     model_provider = os.environ.get("MODEL_PROVIDER", "").lower()
@@ -87,21 +330,9 @@ def main():
     Path(output_dir).mkdir(exist_ok=True)
     
     # Initialize database
-    init_db(db_path)
+    init_db(db_path, text_storage=os.environ.get("TEXT_STORAGE") or None)
     print("Database initialized")
 
-    # Initialize API clients based on chosen provider
-    print("Initializing API clients...")
-    if model_provider == "anthropic":
-        api_client = AnthropicClient()
-        model_client = Anthropic()
-    else:
-        api_client = OpenAIClient()
-        model_client = OpenAI()
-    
-    instructor_client = InstructorClient(model_client, model_provider)
-    print(f"Initialized {model_provider.title()} clients")
-
     # Get all PDF files from input directory
     pdf_files = list(Path(input_dir).glob("*.pdf"))
     if not pdf_files:
@@ -110,29 +341,218 @@ def main():
 
     print(f"Found {len(pdf_files)} PDF files to process")
     total_documents = 0
+    cache_hits = cache_misses = 0
+
+    if pdf_workers > 1:
+        # Each worker process initializes its own API clients and cache connection
+        print(f"Processing PDFs with {pdf_workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=pdf_workers, initializer=_init_pdf_worker,
+                                 initargs=(model_provider, cache_path, cache_max_bytes, batch_poll_interval,
+                                           scheduler_options)) as executor:
+            futures = {
+                executor.submit(_process_pdf_in_worker, str(pdf_file), output_dir, db_path, options): pdf_file
+                for pdf_file in pdf_files
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                pdf_file = futures[future]
+                try:
+                    num_docs, hits, misses, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    total_documents += num_docs
+                    cache_hits += hits
+                    cache_misses += misses
+                    print(f"[{done}/{len(pdf_files)}] Finished {pdf_file} ({num_docs} documents)")
+                except Exception as e:
+                    print(f"[{done}/{len(pdf_files)}] Error processing {pdf_file}: {str(e)}")
+    else:
+        # Responses are cached on disk so re-runs only pay for changed requests
+        cache = ResponseCache(cache_path, max_bytes=cache_max_bytes)
+
+        # Initialize API clients based on chosen provider
+        print("Initializing API clients...")
+        configure_scheduler(model_provider, **scheduler_options)
+        api_client, model_client, instructor_client = create_clients(model_provider, cache)
+        print(f"Initialized {model_provider.title()} clients")
+        batch_runner = None
+        if batch_poll_interval is not None:
+            batch_runner = create_batch_runner(model_provider, model_client, cache, batch_poll_interval)
+            print("Using batch execution mode")
 
-    # Process each PDF
-    for pdf_file in pdf_files:
-        try:
-            num_docs = process_single_pdf(
-                str(pdf_file),
-                output_dir,
-                db_path,
-                api_client,
-                instructor_client,
-                model_client,
-                model_provider
-            )
-            total_documents += num_docs
-        except Exception as e:
-            print(f"Error processing {pdf_file}: {str(e)}")
-            continue
+        # Process each PDF
+        for done, pdf_file in enumerate(pdf_files, 1):
+            try:
+                num_docs = process_single_pdf(
+                    str(pdf_file),
+                    output_dir,
+                    db_path,
+                    api_client,
+                    instructor_client,
+                    model_client,
+                    model_provider,
+                    cache,
+                    batch_runner=batch_runner,
+                    **options
+                )
+                total_documents += num_docs
+                print(f"[{done}/{len(pdf_files)}] Finished {pdf_file} ({num_docs} documents)")
+            except Exception as e:
+                print(f"Error processing {pdf_file}: {str(e)}")
+                continue
+        cache_hits, cache_misses = cache.hits, cache.misses
 
     print("\nProcess complete.")
     print(f"Processed {len(pdf_files)} PDF files")
     print(f"Found total of {total_documents} documents")
+    print(f"Response cache: {cache_hits} hits, {cache_misses} misses")
     print("Output directory:", output_dir)
     print("Metadata in DB:", db_path)
 
+    for name, stage in sorted(metrics.snapshot()["stages"].items()):
+        print(f"  {name}: {stage['wall_seconds']:.1f}s wall, {stage['cpu_seconds']:.1f}s CPU over {stage['count']} run(s)")
+    calls = metrics.snapshot()["calls"].values()
+    print(f"Prompt cache: {sum(c['cache_hits'] for c in calls)} of {sum(c['count'] for c in calls)} model calls hit, "
+          f"{sum(c['cache_read_tokens'] for c in calls)} tokens read, {sum(c['cache_write_tokens'] for c in calls)} written")
+    counters = metrics.snapshot()["counters"]
+    if counters.get("duplicate_pages") or counters.get("duplicate_documents"):
+        print(f"Near duplicates: reused {counters.get('duplicate_pages', 0)} page transcriptions and "
+              f"{counters.get('duplicate_documents', 0)} documents' metadata")
+    if metrics_report:
+        metrics.write_json(metrics_report, pdf_files=len(pdf_files), documents=total_documents,
+                           cache_hits=cache_hits, cache_misses=cache_misses)
+        print("Run report:", metrics_report)
+    if metrics_prom_file:
+        metrics.write_prometheus(metrics_prom_file)
+
+def _stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+def watch(poll_interval=2.0, settle_seconds=5.0, done_dir="processed_dir", failed_dir="failed_dir", max_files=None):
+    """Process PDFs as they land in input_dir until interrupted.
+
+    Files are picked up once they have finished being written, processed by a
+    persistent pool of workers whose clients stay warm between files, and then
+    moved to `done_dir` (or `failed_dir` if processing failed) so they are not
+    picked up again. `max_files` stops the loop after that many files.
+    """
+    input_dir = "input_dir"
+    output_dir = "output_dir"
+    db_path = "documents.db"
+    cache_path = "llm_cache.db"
+    cache_max_bytes = int(os.environ.get("LLM_CACHE_MAX_MB", "1024")) * 1024 * 1024
+    pdf_workers = max(int(os.environ.get("PDF_WORKERS", "1")), 1)
+    metrics_prom_file = os.environ.get("METRICS_PROM_FILE", "")
+    options = pipeline_options_from_env()
+    scheduler_options = scheduler_options_from_env(pdf_workers)
+    # A service can't prompt, so the provider must come from the environment
+    model_provider = os.environ.get("MODEL_PROVIDER", "anthropic").lower()
+    if model_provider not in ("anthropic", "openai"):
+        raise ValueError(f"MODEL_PROVIDER must be anthropic or openai, not {model_provider!r}")
+
+    Path(input_dir).mkdir(exist_ok=True)
+    Path(output_dir).mkdir(exist_ok=True)
+    init_db(db_path, text_storage=os.environ.get("TEXT_STORAGE") or None)
+
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=pdf_workers, initializer=_init_pdf_worker,
+                                   initargs=(model_provider, cache_path, cache_max_bytes, None, scheduler_options))
+
+    watcher = FolderWatcher(input_dir, settle_seconds=settle_seconds, poll_interval=poll_interval)
+    print(f"Watching {input_dir} ({'inotify' if watcher.uses_inotify else 'polling'}) with {pdf_workers} worker(s)")
+    previous_handler = signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    executor = start_pool()
+    in_flight = {}
+    attempts = {}
+    finished = 0
+    try:
+        while max_files is None or finished < max_files:
+            for path in watcher.ready_files():
+                print(f"Queued {path}")
+                in_flight[executor.submit(_process_pdf_in_worker, path, output_dir, db_path, options)] = path
+
+            pool_broken = False
+            for future in [f for f in in_flight if f.done()]:
+                path = in_flight.pop(future)
+                try:
+                    num_docs, _, _, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    print(f"Finished {path} ({num_docs} documents) -> {move_aside(path, done_dir)}")
+                except BrokenProcessPool:
+                    # A worker died; every queued file fails with it, so retry each once on a fresh pool
+                    pool_broken = True
+                    attempts[path] = attempts.get(path, 0) + 1
+                    if attempts[path] < 2:
+                        print(f"Worker pool failed while processing {path}; retrying")
+                        watcher.forget(path)
+                        continue
+                    print(f"Error processing {path}: worker crashed -> {move_aside(path, failed_dir)}")
+                except Exception as e:
+                    print(f"Error processing {path}: {str(e)} -> {move_aside(path, failed_dir)}")
+                watcher.forget(path)
+                attempts.pop(path, None)
+                finished += 1
+                if metrics_prom_file:
+                    metrics.write_prometheus(metrics_prom_file)
+
+            if pool_broken:
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = start_pool()
+            if max_files is None or finished < max_files:
+                watcher.wait()
+    except KeyboardInterrupt:
+        print(f"Stopping; waiting for {len(in_flight)} PDF(s) in progress...")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        watcher.close()
+        signal.signal(signal.SIGTERM, previous_handler)
+    print(f"Watcher stopped after {finished} PDF files")
+    return finished
+
+def run_search(db_path: str, query: str, limit: int = 20, raw: bool = False):
+    results = search_documents(db_path, query, limit=limit, raw=raw)
+    if not results:
+        print(f"No documents match '{query}'")
+        return
+    for rank, result in enumerate(results, 1):
+        print(f"\n{rank}. {result['date']} - {result['title']} ({result['original_filename']})")
+        print(f"   {result['snippet']}")
+        for page in result["pages"]:
+            print(f"   p.{page['page_number']}: {page['snippet']}")
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Segment, transcribe and index PDFs of documents.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("process", help="Process every PDF in input_dir (the default)")
+    watch_parser = subparsers.add_parser("watch", help="Keep running and process PDFs as they arrive in input_dir")
+    watch_parser.add_argument("--poll", type=float, default=2.0, help="Seconds between directory rescans")
+    watch_parser.add_argument("--settle", type=float, default=5.0,
+                              help="Seconds a file must stay unchanged before it is processed")
+    watch_parser.add_argument("--done-dir", default="processed_dir")
+    watch_parser.add_argument("--failed-dir", default="failed_dir")
+    search_parser = subparsers.add_parser("search", help="Full-text search over processed documents")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--raw", action="store_true", help="Treat the query as FTS5 syntax")
+    search_parser.add_argument("--db", default="documents.db")
+    compress_parser = subparsers.add_parser("compress-db",
+                                            help="Convert an existing database to compressed, deduplicated text storage")
+    compress_parser.add_argument("--db", default="documents.db")
+    compress_parser.add_argument("--no-vacuum", dest="vacuum", action="store_false",
+                                 help="Skip the final VACUUM that returns the freed space to the file system")
+    args = parser.parse_args(argv)
+
+    if args.command == "search":
+        init_db(args.db)
+        run_search(args.db, args.query, limit=args.limit, raw=args.raw)
+    elif args.command == "compress-db":
+        init_db(args.db)
+        before = os.path.getsize(args.db)
+        converted = compress_text_storage(args.db, vacuum=args.vacuum)
+        print(f"Converted {converted} documents; {args.db} went from {before / 2**20:.1f} MB "
+              f"to {os.path.getsize(args.db) / 2**20:.1f} MB")
+    elif args.command == "watch":
+        watch(poll_interval=args.poll, settle_seconds=args.settle, done_dir=args.done_dir, failed_dir=args.failed_dir)
+    else:
+        main()
+
 if __name__ == "__main__":
-    main()
+    cli()
@@ -2,71 +2,111 @@ import os
 import base64
 import time
 from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT, APIError, RateLimitError
+from .cache import ResponseCache
+from .metrics import metrics, usage_tokens, payload_bytes, cache_usage
+from .prompt_cache import cached_system
+from .rate_limit import scheduler_for, http_client, estimate_tokens
+from .doc_segmenter import parse_document_starts, SEGMENTATION_GUIDE
 
 class AnthropicClient:
-    def __init__(self, api_key=None, max_retries=3, retry_delay=1):
+    def __init__(self, api_key=None, cache=None, scheduler=None):
         self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
-        self.client = Anthropic(api_key=self.api_key)
-        self.max_retries = max_retries
-        self.retry_delay = retry_delay
+        # Retries are left to the shared scheduler rather than the SDK
+        self.scheduler = scheduler or scheduler_for("anthropic")
+        self.client = Anthropic(api_key=self.api_key, max_retries=0, http_client=http_client("anthropic", self.scheduler))
+        self.cache = cache
     
     def call_model(self, model: str, messages: list, system: str, max_tokens=8000, temperature=0):
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                return self.client.messages.create(
-                    model=model,
-                    max_tokens=max_tokens,
-                    system=system,
-                    messages=messages,
-                    temperature=temperature,
-                )
-            except RateLimitError as e:
-                retries += 1
-                if retries == self.max_retries:
-                    raise Exception(f"Rate limit exceeded after {retries} retries") from e
-                print(f"Rate limit hit, retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay * (2 ** (retries - 1)))  # Exponential backoff
-            except APIError as e:
-                retries += 1
-                if retries == self.max_retries:
-                    raise Exception(f"API error after {retries} retries: {str(e)}") from e
-                print(f"API error occurred, retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay)
-            except Exception as e:
-                raise Exception(f"Unexpected error during API call: {str(e)}") from e
+        def send():
+            started = time.perf_counter()
+            resp = self.client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                # The system prompt is identical for every call of a segmentation mode, so it is served from the prompt cache
+                system=cached_system(system),
+                messages=messages,
+                temperature=temperature,
+            )
+            metrics.observe_call("segmentation", time.perf_counter() - started, *usage_tokens(resp),
+                                 payload_bytes(messages, system), **cache_usage(resp))
+            return resp
 
-    def is_new_document(self, prev_image_b64: str, curr_image_b64: str) -> bool:
-        try:
-            # System instruction to ensure consistent logic
-            system_prompt = """You are a document segmentation assistant. Given two consecutive pages (previous and current), determine if the current page starts a new document. 
+        return self.scheduler.call(send, estimate_tokens(messages, system), "Segmentation call")
+
+    def segmentation_request(self, prev_image_b64: str, curr_image_b64: str, media_type: str = "image/png") -> dict:
+        """Build the pairwise boundary request: its cache key, provider request body and answer parser."""
+        # System instruction to ensure consistent logic
+        system_prompt = """You are a document segmentation assistant. Given two consecutive pages (previous and current), determine if the current page starts a new document. 
 Output only 'YES' or 'NO'.
 Consider big structural changes like a new cover page, a new heading, or a drastically different layout as signs of a new doc start."""
-            
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Previous page image:"},
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": prev_image_b64}},
-                        {"type": "text", "text": "\nCurrent page image:"},
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": curr_image_b64}},
-                        {"type": "text", "text": "\nDoes the current page start a new document? Respond YES or NO."}
-                    ]
-                }
-            ]
 
-            resp = self.call_model(
-                model="claude-3-5-sonnet-latest", 
-                messages=messages,
-                system=system_prompt,
-                max_tokens=8000,
-                temperature=0
-            )
-            answer = resp.content[0].text.strip().upper()
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Previous page image:"},
+                    {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": prev_image_b64}},
+                    {"type": "text", "text": "\nCurrent page image:"},
+                    {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": curr_image_b64}},
+                    {"type": "text", "text": "\nDoes the current page start a new document? Respond YES or NO."}
+                ]
+            }
+        ]
+
+        model = "claude-3-5-sonnet-latest"
+        prompt = SEGMENTATION_GUIDE + system_prompt + "".join(item["text"] for item in messages[0]["content"] if item["type"] == "text")
+        return {
+            "key": ResponseCache.make_key("anthropic", model, prompt, [prev_image_b64, curr_image_b64]),
+            "body": {"model": model, "max_tokens": 8000, "system": f"{SEGMENTATION_GUIDE}\n\n{system_prompt}",
+                     "messages": messages, "temperature": 0},
+            "parse": lambda text: text.strip().upper(),
+        }
+
+    def window_request(self, images_b64: list[str], media_type: str = "image/png") -> dict:
+        """Build the windowed segmentation request; the parser rejects answers without the expected JSON."""
+        system_prompt = """You are a document segmentation assistant. Given a sequence of consecutive pages from a scanned PDF, identify every page that starts a new document.
+Consider big structural changes like a new cover page, a new heading, or a drastically different layout as signs of a new doc start.
+Page 1 may continue a document from before the window, so never report Page 1.
+Output only JSON of the form {"new_document_pages": [page numbers]}, using an empty list if no page starts a new document."""
+
+        content = []
+        for i, image_b64 in enumerate(images_b64, 1):
+            content.append({"type": "text", "text": f"Page {i}:"})
+            content.append({"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_b64}})
+        content.append({"type": "text", "text": f"\nWhich of pages 2-{len(images_b64)} start a new document? Respond with JSON only."})
+        messages = [{"role": "user", "content": content}]
+
+        def parse(text):
+            answer = text.strip()
+            parse_document_starts(answer, len(images_b64))
+            return answer
+
+        model = "claude-3-5-sonnet-latest"
+        prompt = SEGMENTATION_GUIDE + system_prompt + "".join(item["text"] for item in content if item["type"] == "text")
+        return {
+            "key": ResponseCache.make_key("anthropic", model, prompt, images_b64),
+            "body": {"model": model, "max_tokens": 1000, "system": f"{SEGMENTATION_GUIDE}\n\n{system_prompt}",
+                     "messages": messages, "temperature": 0},
+            "parse": parse,
+        }
+
+    def _answer(self, request: dict) -> str:
+        if self.cache is not None:
+            cached = self.cache.get(request["key"])
+            if cached is not None:
+                return cached
+        resp = self.call_model(**request["body"])
+        answer = request["parse"](resp.content[0].text)
+        if self.cache is not None:
+            self.cache.put(request["key"], answer)
+        return answer
+
+    def is_new_document(self, prev_image_b64: str, curr_image_b64: str, media_type: str = "image/png") -> bool:
+        try:
+            answer = self._answer(self.segmentation_request(prev_image_b64, curr_image_b64, media_type))
             return "YES" in answer
         except (RateLimitError, APIError) as e:
-            # Let these propagate up since call_model already handles retries
+            # Let these propagate up since the scheduler already retried them
             raise
         except Exception as e:
             # Handle any other unexpected errors (like malformed responses, etc)
@@ -74,3 +114,15 @@ Consider big structural changes like a new cover page, a new heading, or a drast
             # Default to treating it as not a new document in case of errors
             # This is safer than potentially splitting documents incorrectly
             return False
+
+    def find_document_starts(self, images_b64: list[str], media_type: str = "image/png") -> list[int]:
+        """Return the 0-based positions (after the first) in a window of consecutive pages that start a new document."""
+        try:
+            answer = self._answer(self.window_request(images_b64, media_type))
+            return parse_document_starts(answer, len(images_b64))
+        except (RateLimitError, APIError) as e:
+            raise
+        except Exception as e:
+            print(f"Unexpected error in find_document_starts: {str(e)}")
+            # As with is_new_document, default to no new documents in this window
+            return []
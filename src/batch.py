@@ -0,0 +1,213 @@
+import io
+import json
+import re
+import time
+from abc import ABC, abstractmethod
+from .metrics import metrics
+from .prompt_cache import cached_system
+from .rate_limit import scheduler_for
+
+def json_instruction(response_model) -> dict:
+    """A trailing prompt block asking for the response model's JSON, for requests sent without tool calling."""
+    schema = json.dumps(response_model.model_json_schema())
+    return {"type": "text", "text": f"\nRespond with only a JSON object matching this schema:\n{schema}"}
+
+def parse_json_response(text: str, response_model):
+    """Validate the JSON object in a free-text answer against `response_model`."""
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        raise ValueError(f"No JSON object in batch answer: {text[:200]}")
+    return response_model.model_validate_json(match.group(0))
+
+def _drop_none(value):
+    if isinstance(value, dict):
+        return {k: _drop_none(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_drop_none(v) for v in value]
+    return value
+
+def _params(body: dict) -> dict:
+    """Message Batches params for a request body, with its system prompt cached as in interactive calls."""
+    params = _drop_none(body)
+    if params.get("system"):
+        params["system"] = cached_system(params["system"])
+    return params
+
+class BatchBackend(ABC):
+    """A provider's asynchronous batch endpoint.
+
+    Requests are `{"custom_id": ..., "body": ...}` dicts where the body holds
+    model, max_tokens, messages and optionally system and temperature.
+    `provider` names the request scheduler its calls share.
+    """
+
+    provider = None
+
+    @abstractmethod
+    def submit(self, requests: list[dict]) -> str:
+        """Submit a batch and return its id."""
+
+    @abstractmethod
+    def is_done(self, batch_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    def results(self, batch_id: str) -> dict:
+        """Map custom_id to answer text for every request that succeeded."""
+
+class AnthropicBatchBackend(BatchBackend):
+    """Message Batches API."""
+
+    provider = "anthropic"
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests):
+        batch = self.client.messages.batches.create(requests=[
+            {"custom_id": r["custom_id"], "params": _params(r["body"])} for r in requests
+        ])
+        return batch.id
+
+    def is_done(self, batch_id):
+        return self.client.messages.batches.retrieve(batch_id).processing_status == "ended"
+
+    def results(self, batch_id):
+        answers = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                answers[entry.custom_id] = entry.result.message.content[0].text
+            else:
+                print(f"Batch request {entry.custom_id} {entry.result.type}")
+        return answers
+
+class OpenAIBatchBackend(BatchBackend):
+    """Batch API over /v1/chat/completions, submitted as an uploaded JSONL file."""
+
+    provider = "openai"
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests):
+        from .openai_client import format_messages
+
+        lines = []
+        for r in requests:
+            body = r["body"]
+            payload = {
+                "model": body["model"],
+                "messages": format_messages(body["messages"], body.get("system")),
+                "max_tokens": body["max_tokens"],
+            }
+            if "temperature" in body:
+                payload["temperature"] = body["temperature"]
+            lines.append(json.dumps({"custom_id": r["custom_id"], "method": "POST", "url": "/v1/chat/completions",
+                                     "body": payload}))
+        upload = self.client.files.create(file=("batch.jsonl", io.BytesIO("\n".join(lines).encode('utf-8'))),
+                                          purpose="batch")
+        batch = self.client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def is_done(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status in ("completed", "failed", "expired", "cancelled")
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"Batch {batch_id} finished with status {batch.status}")
+            return {}
+        answers = {}
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") == 200:
+                answers[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                print(f"Batch request {entry['custom_id']} failed: {entry.get('error')}")
+        return answers
+
+class BatchRunner:
+    """Runs model requests through a batch backend and feeds the answers into the response cache.
+
+    Requests come from the clients' request builders (`key`, `body`, `parse`).
+    Anything already cached is skipped; parsed answers are stored under the same
+    key the interactive call would use, so the normal pipeline then finds them in
+    the cache. Requests that fail or time out are left uncached and fall back to
+    interactive calls. Status polls and result downloads go through the
+    provider's request scheduler, which retries transient API errors.
+    """
+
+    def __init__(self, backend, cache, poll_interval=60, max_wait=24 * 3600,
+                 max_requests=10000, max_bytes=200 * 1024 * 1024, scheduler=None):
+        if cache is None:
+            raise ValueError("Batch mode needs a response cache")
+        self.backend = backend
+        self.scheduler = scheduler or scheduler_for(backend.provider)
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.submitted = 0
+        self.completed = 0
+
+    def _chunks(self, requests):
+        chunk, size = [], 0
+        for request in requests:
+            request_size = len(json.dumps(request["body"]))
+            if chunk and (len(chunk) >= self.max_requests or size + request_size > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(request)
+            size += request_size
+        if chunk:
+            yield chunk
+
+    def run(self, requests) -> int:
+        """Batch every uncached request and wait for the results; returns how many were cached."""
+        pending = {}
+        for request in requests:
+            if request is not None and request["key"] not in pending and not self.cache.contains(request["key"]):
+                pending[request["key"]] = request
+        if not pending:
+            return 0
+
+        batch_ids = []
+        for chunk in self._chunks(pending.values()):
+            batch_ids.append(self.backend.submit([{"custom_id": r["key"], "body": r["body"]} for r in chunk]))
+            print(f"Submitted batch {batch_ids[-1]} with {len(chunk)} requests")
+        self.submitted += len(pending)
+        metrics.count("batch_requests", len(pending))
+
+        cached = 0
+        started = time.time()
+        deadline = started + self.max_wait
+        waiting = list(batch_ids)
+        while waiting:
+            for batch_id in list(waiting):
+                if not self.scheduler.call(lambda: self.backend.is_done(batch_id), description="Batch status poll"):
+                    continue
+                waiting.remove(batch_id)
+                answers = self.scheduler.call(lambda: self.backend.results(batch_id), description="Batch results")
+                for key, text in answers.items():
+                    try:
+                        self.cache.put(key, pending[key]["parse"](text))
+                        cached += 1
+                    except Exception as e:
+                        print(f"Discarding unusable batch answer for {key}: {str(e)}")
+            if not waiting:
+                break
+            if time.time() >= deadline:
+                print(f"Gave up waiting on {len(waiting)} batch(es); their requests will run interactively")
+                break
+            print(f"Waiting on {len(waiting)} batch(es)...")
+            time.sleep(self.poll_interval)
+
+        metrics.add_stage("batch_wait", time.time() - started, 0.0)
+        self.completed += cached
+        print(f"Batch results cached for {cached}/{len(pending)} requests")
+        return cached
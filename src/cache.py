@@ -0,0 +1,111 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache for model responses.
+
+    Entries are keyed by a hash of the provider, model, prompt and image data, so a
+    re-run only pays for requests whose inputs actually changed. The store is kept
+    under `max_bytes` by evicting the least recently used entries. Its size is
+    tracked as a running total, re-read from the database every `RESYNC_WRITES`
+    writes to pick up entries other processes added.
+    """
+
+    RESYNC_WRITES = 1000
+
+    def __init__(self, path: str = "llm_cache.db", max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                size INTEGER,
+                last_access REAL
+            );
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+            self._conn.commit()
+            self._total_bytes = self._stored_bytes(self._conn)
+        return self._conn
+
+    @staticmethod
+    def _stored_bytes(conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str, images: list[str] = ()) -> str:
+        """Hash everything that determines a response into a single cache key."""
+        h = hashlib.sha256()
+        for part in (provider, model, prompt):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        for image_b64 in images:
+            h.update(hashlib.sha256(image_b64.encode('ascii')).digest())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key: str) -> bool:
+        """Check for an entry without touching hit/miss counters or recency."""
+        with self._lock:
+            conn = self._connection()
+            return conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key: str, value: str):
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            conn = self._connection()
+            replaced = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?,?,?,?)",
+                (key, value, size, time.time())
+            )
+            self._writes += 1
+            if self._writes % self.RESYNC_WRITES == 0:
+                self._total_bytes = self._stored_bytes(conn)
+            else:
+                self._total_bytes += size - (replaced[0] if replaced else 0)
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        if self._total_bytes <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= size
+            evicted += 1
+        print(f"Evicted {evicted} entries from response cache")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import sqlite3
+from .db import connect
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def segment_key(segment) -> str:
+    """Item key for a document's stage results: its page range, which stays valid however the segments are numbered."""
+    start, end = segment
+    return f"{start}-{end}"
+
+class PipelineCheckpoint:
+    """Per-PDF pipeline progress stored in the documents database.
+
+    Progress is keyed by the PDF's content hash, so a re-run skips PDFs that
+    already finished and resumes partial ones from the last completed stage.
+    Stage results are stored as JSON under (stage, item_key), e.g. one entry per
+    transcribed page or per document (see segment_key) whose metadata was extracted.
+    """
+
+    def __init__(self, db_path: str, pdf_path: str):
+        self.db_path = db_path
+        self.pdf_path = pdf_path
+        self.file_hash = file_sha256(pdf_path)
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect(self.db_path)
+
+    def is_complete(self) -> bool:
+        conn = self._connect()
+        row = conn.execute("SELECT status FROM pdf_runs WHERE file_hash = ?", (self.file_hash,)).fetchone()
+        conn.close()
+        return row is not None and row[0] == "complete"
+
+    def _set_status(self, conn: sqlite3.Connection, status: str):
+        conn.execute(
+            """INSERT INTO pdf_runs (file_hash, pdf_path, status, updated_at) VALUES (?,?,?,datetime('now'))
+               ON CONFLICT(file_hash) DO UPDATE SET pdf_path = excluded.pdf_path, status = excluded.status,
+               updated_at = excluded.updated_at""",
+            (self.file_hash, self.pdf_path, status)
+        )
+
+    def get(self, stage: str, item_key: str = ""):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT payload FROM pdf_checkpoints WHERE file_hash = ? AND stage = ? AND item_key = ?",
+            (self.file_hash, stage, str(item_key))
+        ).fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else None
+
+    def get_all(self, stage: str) -> dict:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT item_key, payload FROM pdf_checkpoints WHERE file_hash = ? AND stage = ?",
+            (self.file_hash, stage)
+        ).fetchall()
+        conn.close()
+        return {key: json.loads(payload) for key, payload in rows}
+
+    def save(self, stage: str, value, item_key: str = "", conn: sqlite3.Connection = None):
+        """Record a stage result; pass `conn` to make it part of the caller's transaction."""
+        own_conn = conn is None
+        if own_conn:
+            conn = self._connect()
+        self._set_status(conn, "in_progress")
+        conn.execute(
+            "INSERT OR REPLACE INTO pdf_checkpoints (file_hash, stage, item_key, payload) VALUES (?,?,?,?)",
+            (self.file_hash, stage, str(item_key), json.dumps(value))
+        )
+        if own_conn:
+            conn.commit()
+            conn.close()
+
+    def mark_complete(self):
+        conn = self._connect()
+        self._set_status(conn, "complete")
+        conn.commit()
+        conn.close()
@@ -0,0 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(fn, items, max_workers: int = 1) -> list:
+    """Apply `fn` to every item using up to `max_workers` threads, keeping input order.
+
+    Exceptions propagate as they would from a plain loop. With `max_workers <= 1`
+    the calls run sequentially on the calling thread.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def ordered_imap(fn, items, max_workers: int = 1):
+    """Like `ordered_map`, but yields each result as soon as it and every earlier one are done."""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        yield from executor.map(fn, items)
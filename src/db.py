@@ -1,8 +1,164 @@
 import sqlite3
-from pathlib import Path
+import zlib
 
-def init_db(db_path: str):
-    conn = sqlite3.connect(db_path)
+TEXT_STORAGE_MODES = ("plain", "compressed")
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8")) if text is not None else None
+
+def decompress_text(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8") if blob is not None else None
+
+def assemble_markdown(page_markdowns: list[str]) -> str:
+    """A document's markdown transcription: its pages between `--- PDF PAGE n ---` markers."""
+    return "\n\n".join(f"--- PDF PAGE {i} ---\n\n{markdown.strip()}\n\n--- END OF PDF PAGE {i} ---"
+                       for i, markdown in enumerate(page_markdowns, 1))
+
+class _PageAggregate:
+    """SQL aggregate over (page_number, text) rows, combining the texts in page order."""
+
+    def __init__(self):
+        self.pages = []
+
+    def step(self, page_number, text):
+        self.pages.append((page_number, text))
+
+    def finalize(self):
+        if not self.pages or any(text is None for _, text in self.pages):
+            return None
+        return self.combine([text for _, text in sorted(self.pages)])
+
+class _JoinPageText(_PageAggregate):
+    combine = staticmethod("\n\n".join)
+
+class _JoinPageMarkdown(_PageAggregate):
+    combine = staticmethod(assemble_markdown)
+
+def connect(db_path: str, check_same_thread=True) -> sqlite3.Connection:
+    """Open a connection in WAL mode so readers can query while ingestion is running.
+
+    The connection also gets the SQL functions the `documents_text` and
+    `document_pages_text` views use to read compressed text.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+    conn.create_function("inflate", 1, decompress_text, deterministic=True)
+    conn.create_aggregate("join_page_text", 2, _JoinPageText)
+    conn.create_aggregate("join_page_markdown", 2, _JoinPageMarkdown)
+    return conn
+
+def get_text_storage(conn: sqlite3.Connection) -> str:
+    row = conn.execute("SELECT value FROM db_settings WHERE key = 'text_storage'").fetchone()
+    return row[0] if row else "plain"
+
+def set_text_storage(conn: sqlite3.Connection, mode: str):
+    if mode not in TEXT_STORAGE_MODES:
+        raise ValueError(f"text storage must be one of {', '.join(TEXT_STORAGE_MODES)}, not {mode!r}")
+    conn.execute("INSERT OR REPLACE INTO db_settings (key, value) VALUES ('text_storage', ?)", (mode,))
+
+# Plain views read the base columns only, so any SQLite client can query them and the
+# full-text indexes built on them; a page that reused another's transcription may
+# still point at it. Compressed views need the functions `connect` registers.
+_PLAIN_TEXT_VIEWS = ("""
+    CREATE VIEW document_pages_text AS
+        SELECT p.id, p.document_id, p.page_number,
+               COALESCE(p.markdown_text, (SELECT s.markdown_text FROM document_pages s
+                                          WHERE s.id = p.duplicate_of)) AS markdown_text,
+               NULL AS page_text
+        FROM document_pages p;
+""", """
+    CREATE VIEW documents_text AS
+        SELECT d.id, d.title, d.date, d.summary, d.original_filename, d.duplicate_of,
+               d.full_text, d.markdown_transcription
+        FROM documents d;
+""")
+
+# In compressed storage each page's markdown and text layer are kept once, zlib-compressed, and the
+# document-level text is rebuilt from them; pages that reused another page's transcription point at it
+# instead of storing a copy. These views give every row its text whichever way it was stored.
+_COMPRESSED_TEXT_VIEWS = ("""
+    CREATE VIEW document_pages_text AS
+        SELECT p.id, p.document_id, p.page_number,
+               COALESCE(p.markdown_text, inflate(p.markdown_zlib),
+                        (SELECT COALESCE(s.markdown_text, inflate(s.markdown_zlib))
+                         FROM document_pages s WHERE s.id = p.duplicate_of)) AS markdown_text,
+               inflate(p.text_zlib) AS page_text
+        FROM document_pages p;
+""", """
+    CREATE VIEW documents_text AS
+        SELECT d.id, d.title, d.date, d.summary, d.original_filename, d.duplicate_of,
+               COALESCE(d.full_text, inflate(d.full_text_zlib),
+                        (SELECT join_page_text(t.page_number, t.page_text)
+                         FROM document_pages_text t WHERE t.document_id = d.id)) AS full_text,
+               COALESCE(d.markdown_transcription, inflate(d.markdown_zlib),
+                        (SELECT join_page_markdown(t.page_number, t.markdown_text)
+                         FROM document_pages_text t WHERE t.document_id = d.id)) AS markdown_transcription
+        FROM documents d;
+""")
+
+def _has_compressed_text(cur: sqlite3.Cursor) -> bool:
+    return cur.execute(
+        """SELECT EXISTS (SELECT 1 FROM documents WHERE full_text_zlib IS NOT NULL OR markdown_zlib IS NOT NULL)
+               OR EXISTS (SELECT 1 FROM document_pages WHERE markdown_zlib IS NOT NULL OR text_zlib IS NOT NULL)"""
+    ).fetchone()[0]
+
+def _create_text_views(cur: sqlite3.Cursor):
+    """(Re)create the text views for the database's storage mode.
+
+    The compressed views stay once compressed text has been written, even if
+    the mode is later set back to plain.
+    """
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name='document_pages_text'")
+    row = cur.fetchone()
+    current = None if row is None else ("compressed" if "inflate(" in row[0] else "plain")
+    compressed = get_text_storage(cur.connection) == "compressed"
+    if not compressed and current == "compressed":
+        compressed = _has_compressed_text(cur)
+    if current == ("compressed" if compressed else "plain"):
+        return
+    cur.execute("DROP VIEW IF EXISTS documents_text")
+    cur.execute("DROP VIEW IF EXISTS document_pages_text")
+    for sql in (_COMPRESSED_TEXT_VIEWS if compressed else _PLAIN_TEXT_VIEWS):
+        cur.execute(sql)
+
+def normalize_tag(tag: str) -> str:
+    """Fold case and whitespace so "Rate Case", "rate  case" and " RATE CASE" are one tag."""
+    return " ".join(tag.split()).casefold()
+
+def _link_tags(cur: sqlite3.Cursor, rows: list[tuple[int, str]]):
+    """Add (document_id, tag) pairs to the tag dictionary and link table."""
+    rows = [(doc_id, tag.strip(), normalize_tag(tag)) for doc_id, tag in rows if tag and normalize_tag(tag)]
+    cur.executemany(
+        "INSERT OR IGNORE INTO tag_names (name, label) VALUES (?,?)",
+        [(name, " ".join(label.split())) for _, label, name in rows]
+    )
+    cur.executemany(
+        "INSERT OR IGNORE INTO document_tags (document_id, tag_id) SELECT ?, id FROM tag_names WHERE name = ?",
+        [(doc_id, name) for doc_id, _, name in rows]
+    )
+
+def _index_pages(cur: sqlite3.Cursor, doc_ids: list[int], fingerprints: dict):
+    """Add page fingerprints, keyed by (document_id, page_number), to the near-duplicate index."""
+    placeholders = ",".join("?" * len(doc_ids))
+    cur.execute(f"SELECT id, document_id, page_number FROM document_pages WHERE document_id IN ({placeholders})", doc_ids)
+    rows = [(page_id, fingerprints[(doc_id, page_number)]) for page_id, doc_id, page_number in cur.fetchall()
+            if (doc_id, page_number) in fingerprints]
+    cur.executemany(
+        "INSERT OR REPLACE INTO page_fingerprints (page_id, image_hash, text_signature, ink_mask) VALUES (?,?,?,?)",
+        [(page_id, fp["image_hash"], fp["text_signature"], fp.get("ink_mask")) for page_id, fp in rows]
+    )
+    cur.executemany(
+        "INSERT OR IGNORE INTO fingerprint_bands (band, bucket, page_id) VALUES (?,?,?)",
+        [(band, bucket, page_id) for page_id, fp in rows for band, bucket in fp["bands"]]
+    )
+
+def init_db(db_path: str, text_storage: str = None):
+    """Create or upgrade the database; `text_storage` ("plain" or "compressed") sets how new text is stored."""
+    conn = connect(db_path)
     cur = conn.cursor()
     
     # Check if the documents table exists
@@ -19,7 +175,10 @@ def init_db(db_path: str):
             summary TEXT,
             original_filename TEXT,
             full_text TEXT,
-            markdown_transcription TEXT
+            markdown_transcription TEXT,
+            duplicate_of INTEGER REFERENCES documents(id),
+            full_text_zlib BLOB,
+            markdown_zlib BLOB
         );
         """)
     else:
@@ -29,6 +188,11 @@ def init_db(db_path: str):
         if 'markdown_transcription' not in columns:
             # Add the new column
             cur.execute("ALTER TABLE documents ADD COLUMN markdown_transcription TEXT;")
+        if 'duplicate_of' not in columns:
+            cur.execute("ALTER TABLE documents ADD COLUMN duplicate_of INTEGER REFERENCES documents(id);")
+        for column in ('full_text_zlib', 'markdown_zlib'):
+            if column not in columns:
+                cur.execute(f"ALTER TABLE documents ADD COLUMN {column} BLOB;")
     
     # Create or ensure other tables exist
     cur.execute("""
@@ -37,47 +201,454 @@ def init_db(db_path: str):
         document_id INTEGER,
         page_number INTEGER,
         markdown_text TEXT,
+        duplicate_of INTEGER REFERENCES document_pages(id),
+        markdown_zlib BLOB,
+        text_zlib BLOB,
         FOREIGN KEY(document_id) REFERENCES documents(id)
     );
     """)
+    cur.execute("PRAGMA table_info(document_pages)")
+    columns = [column[1] for column in cur.fetchall()]
+    if 'duplicate_of' not in columns:
+        cur.execute("ALTER TABLE document_pages ADD COLUMN duplicate_of INTEGER REFERENCES document_pages(id);")
+    for column in ('markdown_zlib', 'text_zlib'):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE document_pages ADD COLUMN {column} BLOB;")
 
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS tags (
+    CREATE TABLE IF NOT EXISTS db_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """)
+    if text_storage is not None:
+        set_text_storage(conn, text_storage)
+
+    _create_text_views(cur)
+
+    # Near-duplicate index over transcribed pages (see dedup.py): an image hash and text
+    # signature per page (an ink mask instead for pages without a text layer), and the
+    # locality-sensitive hash bands they are looked up by. Rows that reused another's
+    # results link to it through duplicate_of.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS page_fingerprints (
+        page_id INTEGER PRIMARY KEY,
+        image_hash BLOB,
+        text_signature BLOB,
+        ink_mask BLOB,
+        FOREIGN KEY(page_id) REFERENCES document_pages(id)
+    );
+    """)
+    cur.execute("PRAGMA table_info(page_fingerprints)")
+    if 'ink_mask' not in [column[1] for column in cur.fetchall()]:
+        cur.execute("ALTER TABLE page_fingerprints ADD COLUMN ink_mask BLOB;")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fingerprint_bands (
+        band INTEGER,
+        bucket INTEGER,
+        page_id INTEGER,
+        PRIMARY KEY(band, bucket, page_id)
+    ) WITHOUT ROWID;
+    """)
+
+    # Tags are stored once in a dictionary of case/whitespace-folded names and
+    # linked to documents through an indexed link table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tag_names (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        label TEXT
+    );
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS document_tags (
         document_id INTEGER,
-        tag TEXT,
-        FOREIGN KEY(document_id) REFERENCES documents(id)
+        tag_id INTEGER,
+        PRIMARY KEY(document_id, tag_id),
+        FOREIGN KEY(document_id) REFERENCES documents(id),
+        FOREIGN KEY(tag_id) REFERENCES tag_names(id)
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_document_tags_tag ON document_tags(tag_id, document_id)")
+
+    # Migrate the old free-text tags table and replace it with a compatible view
+    cur.execute("SELECT type FROM sqlite_master WHERE name='tags'")
+    row = cur.fetchone()
+    if row is not None and row[0] == 'table':
+        cur.execute("SELECT document_id, tag FROM tags")
+        _link_tags(cur, cur.fetchall())
+        cur.execute("DROP TABLE tags")
+        row = None
+    if row is None:
+        cur.execute("""
+        CREATE VIEW tags AS
+            SELECT dt.rowid AS id, dt.document_id, t.label AS tag
+            FROM document_tags dt JOIN tag_names t ON t.id = dt.tag_id;
+        """)
+
+    # Pipeline progress per input PDF, keyed by the file's content hash
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS pdf_runs (
+        file_hash TEXT PRIMARY KEY,
+        pdf_path TEXT,
+        status TEXT,
+        updated_at TEXT
+    );
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS pdf_checkpoints (
+        file_hash TEXT,
+        stage TEXT,
+        item_key TEXT,
+        payload TEXT,
+        PRIMARY KEY(file_hash, stage, item_key),
+        FOREIGN KEY(file_hash) REFERENCES pdf_runs(file_hash)
     );
     """)
+
+    # Full-text indexes over the transcriptions, kept in sync by DocumentWriter. They read
+    # their content (for snippets) through the text views, so compressed rows work too; in
+    # plain storage those views use no custom functions and any SQLite client can search.
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='documents_fts'")
+    row = cur.fetchone()
+    if row is not None and "documents_text" not in row[0]:
+        # Indexes from before compressed storage read the tables directly and are rebuilt once
+        print("Rebuilding full-text indexes over the text views...")
+        cur.execute("DROP TABLE documents_fts")
+        cur.execute("DROP TABLE IF EXISTS document_pages_fts")
+        row = None
+    if row is None:
+        cur.execute("""
+        CREATE VIRTUAL TABLE documents_fts USING fts5(
+            title, summary, full_text, markdown_transcription,
+            content='documents_text', content_rowid='id', tokenize='porter unicode61'
+        );
+        """)
+        cur.execute("""
+        CREATE VIRTUAL TABLE document_pages_fts USING fts5(
+            markdown_text,
+            content='document_pages_text', content_rowid='id', tokenize='porter unicode61'
+        );
+        """)
+        # Index anything that was ingested before the FTS tables existed
+        cur.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')")
+        cur.execute("INSERT INTO document_pages_fts(document_pages_fts) VALUES('rebuild')")
     
     conn.commit()
     conn.close()
 
+class DocumentWriter:
+    """Writes documents, pages and tags over a single connection.
+
+    `insert_documents` adds the documents it is given in one transaction with
+    bulk `executemany` inserts for pages and tags. The pipeline calls it once per
+    finished document, so a PDF is committed document by document; pass
+    `commit=False` to add more writes (such as the document's checkpoint) to the
+    same transaction before calling `commit()`. Leaving the context manager with
+    an exception rolls back.
+    A `shared` writer may be used from several threads, one at a time; the
+    callers serialize access themselves.
+
+    Documents may also carry `duplicate_of` (the stored document whose results
+    they reused), `page_duplicates` (the same per page) and `page_fingerprints`;
+    pages transcribed afresh are added to the near-duplicate index. In the
+    database's compressed text storage, `page_texts` (each page's text layer)
+    lets `full_text` be rebuilt from the pages instead of stored.
+    """
+
+    def __init__(self, db_path: str, shared=False):
+        self.conn = connect(db_path, check_same_thread=not shared)
+        self.compress = get_text_storage(self.conn) == "compressed"
+
+    def _stored_page_markdown(self, page_id: int) -> str:
+        row = self.conn.execute("SELECT markdown_text FROM document_pages_text WHERE id = ?", (page_id,)).fetchone()
+        return row[0] if row else None
+
+    def _compressed_rows(self, doc: dict, page_duplicates: list):
+        """Document columns (full_text, markdown, their blobs) and per-page (markdown, blob, text blob) to store."""
+        page_markdowns = doc["page_transcriptions"]
+        page_texts = doc.get("page_texts")
+        # Document-level text is only stored when it can't be rebuilt exactly from the pages
+        rebuilds_text = page_texts is not None and "\n\n".join(page_texts) == doc["full_text"]
+        rebuilds_markdown = assemble_markdown(page_markdowns) == doc["markdown_transcription"]
+        document = (None, None, None if rebuilds_text else compress_text(doc["full_text"]),
+                    None if rebuilds_markdown else compress_text(doc["markdown_transcription"]))
+        pages = []
+        for j, (markdown, duplicate_of) in enumerate(zip(page_markdowns, page_duplicates)):
+            shared = duplicate_of is not None and self._stored_page_markdown(duplicate_of) == markdown
+            pages.append((None, None if shared else compress_text(markdown),
+                          compress_text(page_texts[j]) if page_texts is not None else None))
+        return document, pages
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.conn.rollback()
+        self.close()
+
+    def insert_documents(self, documents: list[dict], commit=True) -> list[int]:
+        """Insert documents given as dicts with the keyword arguments of `insert_document`."""
+        cur = self.conn.cursor()
+        doc_ids = []
+        page_rows = []
+        tag_rows = []
+        fingerprints = {}
+        try:
+            for doc in documents:
+                page_duplicates = doc.get("page_duplicates") or [None] * len(doc["page_transcriptions"])
+                if self.compress:
+                    document, pages = self._compressed_rows(doc, page_duplicates)
+                else:
+                    document = (doc["full_text"], doc["markdown_transcription"], None, None)
+                    pages = [(markdown, None, None) for markdown in doc["page_transcriptions"]]
+                cur.execute(
+                    """INSERT INTO documents 
+                       (title, date, summary, original_filename, full_text, markdown_transcription,
+                        full_text_zlib, markdown_zlib, duplicate_of) 
+                       VALUES (?,?,?,?,?,?,?,?,?)""", 
+                    (doc["title"], doc["date"], doc["summary"], doc["original_filename"], *document,
+                     doc.get("duplicate_of"))
+                )
+                doc_id = cur.lastrowid
+                doc_ids.append(doc_id)
+                page_rows.extend(
+                    (doc_id, page_num, *page, duplicate_of)
+                    for page_num, (page, duplicate_of) in enumerate(zip(pages, page_duplicates), 1)
+                )
+                for page_num, fingerprint in enumerate(doc.get("page_fingerprints") or [], 1):
+                    if page_duplicates[page_num - 1] is None and doc["page_transcriptions"][page_num - 1]:
+                        fingerprints[(doc_id, page_num)] = fingerprint
+                tag_rows.extend((doc_id, tag) for tag in doc["tags"])
+
+            cur.executemany(
+                """INSERT INTO document_pages (document_id, page_number, markdown_text, markdown_zlib, text_zlib, duplicate_of)
+                   VALUES (?,?,?,?,?,?)""",
+                page_rows
+            )
+            _link_tags(cur, tag_rows)
+            if fingerprints:
+                _index_pages(cur, doc_ids, fingerprints)
+
+            # Keep the full-text indexes in sync within the same transaction
+            placeholders = ",".join("?" * len(doc_ids))
+            cur.execute(
+                f"""INSERT INTO documents_fts (rowid, title, summary, full_text, markdown_transcription)
+                    SELECT id, title, summary, full_text, markdown_transcription FROM documents_text WHERE id IN ({placeholders})""",
+                doc_ids
+            )
+            cur.execute(
+                f"""INSERT INTO document_pages_fts (rowid, markdown_text)
+                    SELECT id, markdown_text FROM document_pages_text WHERE document_id IN ({placeholders})""",
+                doc_ids
+            )
+        except Exception:
+            self.conn.rollback()
+            raise
+        if commit:
+            self.conn.commit()
+        return doc_ids
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
 def insert_document(db_path: str, title: str, date: str, summary: str, original_filename: str, 
                    tags: list[str], full_text: str, markdown_transcription: str, page_transcriptions: list[str]):
-    conn = sqlite3.connect(db_path)
+    with DocumentWriter(db_path) as writer:
+        doc_ids = writer.insert_documents([dict(
+            title=title,
+            date=date,
+            summary=summary,
+            original_filename=original_filename,
+            tags=tags,
+            full_text=full_text,
+            markdown_transcription=markdown_transcription,
+            page_transcriptions=page_transcriptions,
+        )])
+    return doc_ids[0]
+
+def get_page_markdowns(db_path: str, document_id: int) -> list[str]:
+    """A document's page transcriptions in page order, however they are stored."""
+    conn = connect(db_path)
+    rows = conn.execute("SELECT markdown_text FROM document_pages_text WHERE document_id = ? ORDER BY page_number",
+                        (document_id,)).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+def _document_text(db_path: str, document_id: int, column: str) -> str:
+    conn = connect(db_path)
+    row = conn.execute(f"SELECT {column} FROM documents_text WHERE id = ?", (document_id,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_full_text(db_path: str, document_id: int) -> str:
+    """A document's text layer, rebuilt from its pages in compressed storage."""
+    return _document_text(db_path, document_id, "full_text")
+
+def get_markdown_transcription(db_path: str, document_id: int) -> str:
+    """A document's full markdown transcription, rebuilt from its pages in compressed storage."""
+    return _document_text(db_path, document_id, "markdown_transcription")
+
+def compress_text_storage(db_path: str, batch_size: int = 200, vacuum: bool = True) -> int:
+    """Move an existing database to compressed text storage; returns the number of documents converted.
+
+    Page markdown is compressed, pages that repeat their `duplicate_of` source
+    drop their copy, and document-level text that the pages rebuild exactly is
+    dropped; the rest is compressed in place. Documents are converted in
+    batches of `batch_size`, each in its own transaction, so the migration can
+    be interrupted and run again. New documents are stored compressed from then on.
+    """
+    conn = connect(db_path)
+    set_text_storage(conn, "compressed")
+    _create_text_views(conn.cursor())
+    conn.commit()
+    doc_ids = [row[0] for row in conn.execute(
+        """SELECT id FROM documents WHERE full_text IS NOT NULL OR markdown_transcription IS NOT NULL
+           UNION SELECT document_id FROM document_pages WHERE markdown_text IS NOT NULL ORDER BY 1""")]
+    for i in range(0, len(doc_ids), batch_size):
+        for doc_id in doc_ids[i:i + batch_size]:
+            pages = conn.execute(
+                """SELECT p.id, t.markdown_text, t.page_text, p.markdown_text IS NOT NULL, p.duplicate_of
+                   FROM document_pages p JOIN document_pages_text t ON t.id = p.id
+                   WHERE p.document_id = ? ORDER BY p.page_number""",
+                (doc_id,)
+            ).fetchall()
+            full_text, markdown = conn.execute(
+                "SELECT full_text, markdown_transcription FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            page_texts = [page[2] for page in pages]
+            if full_text is not None:
+                rebuilt = pages and None not in page_texts and "\n\n".join(page_texts) == full_text
+                conn.execute("UPDATE documents SET full_text = NULL, full_text_zlib = ? WHERE id = ?",
+                             (None if rebuilt else compress_text(full_text), doc_id))
+            if markdown is not None:
+                rebuilt = assemble_markdown([page[1] or "" for page in pages]) == markdown
+                conn.execute("UPDATE documents SET markdown_transcription = NULL, markdown_zlib = ? WHERE id = ?",
+                             (None if rebuilt else compress_text(markdown), doc_id))
+            for page_id, page_markdown, _, plain, duplicate_of in pages:
+                if not plain:
+                    continue
+                source = conn.execute("SELECT markdown_text FROM document_pages_text WHERE id = ?",
+                                      (duplicate_of,)).fetchone() if duplicate_of is not None else None
+                shared = source is not None and source[0] == page_markdown
+                conn.execute("UPDATE document_pages SET markdown_text = NULL, markdown_zlib = ? WHERE id = ?",
+                             (None if shared else compress_text(page_markdown), page_id))
+        conn.commit()
+        print(f"Compressed {min(i + batch_size, len(doc_ids))}/{len(doc_ids)} documents")
+    if vacuum:
+        # Freed pages are only returned to the file system by a vacuum
+        conn.execute("VACUUM")
+    conn.close()
+    return len(doc_ids)
+
+def _fts_query(query: str) -> str:
+    """Quote each term so user input is matched literally rather than parsed as FTS5 syntax."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+def search_documents(db_path: str, query: str, limit: int = 20, pages_per_document: int = 3, raw: bool = False) -> list[dict]:
+    """Full-text search over documents and their pages, ranked by BM25.
+
+    Each result has the document's id, title, date, original filename, BM25
+    score (lower is better) and a highlighted snippet, plus up to
+    `pages_per_document` matching pages with their own snippets. Pass
+    `raw=True` to use FTS5 query syntax (AND/OR/NEAR, prefix*) directly.
+    """
+    match = query if raw else _fts_query(query)
+    if not match:
+        return []
+    conn = connect(db_path)
     cur = conn.cursor()
-    
-    # Insert main document
     cur.execute(
-        """INSERT INTO documents 
-           (title, date, summary, original_filename, full_text, markdown_transcription) 
-           VALUES (?,?,?,?,?,?)""", 
-        (title, date, summary, original_filename, full_text, markdown_transcription)
+        """SELECT d.id, d.title, d.date, d.original_filename,
+                  bm25(documents_fts, 10.0, 5.0, 1.0, 1.0) AS score,
+                  snippet(documents_fts, -1, '[', ']', '...', 16)
+           FROM documents_fts
+           JOIN documents d ON d.id = documents_fts.rowid
+           WHERE documents_fts MATCH ?
+           ORDER BY score
+           LIMIT ?""",
+        (match, limit)
     )
-    doc_id = cur.lastrowid
-    
-    # Insert individual page transcriptions
-    for page_num, page_markdown in enumerate(page_transcriptions, 1):
+    results = [
+        dict(document_id=row[0], title=row[1], date=row[2], original_filename=row[3],
+             score=row[4], snippet=row[5], pages=[])
+        for row in cur.fetchall()
+    ]
+
+    for result in results:
         cur.execute(
-            "INSERT INTO document_pages (document_id, page_number, markdown_text) VALUES (?,?,?)",
-            (doc_id, page_num, page_markdown)
+            """SELECT p.page_number, bm25(document_pages_fts) AS score,
+                      snippet(document_pages_fts, 0, '[', ']', '...', 16)
+               FROM document_pages_fts
+               JOIN document_pages p ON p.id = document_pages_fts.rowid
+               WHERE document_pages_fts MATCH ? AND p.document_id = ?
+               ORDER BY score
+               LIMIT ?""",
+            (match, result["document_id"], pages_per_document)
         )
-    
-    # Insert tags
-    for tag in tags:
-        cur.execute("INSERT INTO tags (document_id, tag) VALUES (?,?)", (doc_id, tag))
-    
-    conn.commit()
+        result["pages"] = [dict(page_number=row[0], score=row[1], snippet=row[2]) for row in cur.fetchall()]
+
+    conn.close()
+    return results
+
+def get_document_tags(db_path: str, document_id: int) -> list[str]:
+    conn = connect(db_path)
+    rows = conn.execute(
+        """SELECT t.label FROM document_tags dt JOIN tag_names t ON t.id = dt.tag_id
+           WHERE dt.document_id = ? ORDER BY t.name""",
+        (document_id,)
+    ).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+def find_documents_by_tags(db_path: str, tags: list[str]) -> list[int]:
+    """Ids of documents carrying every one of `tags` (compared case- and whitespace-insensitively)."""
+    names = sorted({normalize_tag(tag) for tag in tags})
+    if not names:
+        return []
+    conn = connect(db_path)
+    placeholders = ",".join("?" * len(names))
+    rows = conn.execute(
+        f"""SELECT dt.document_id FROM document_tags dt JOIN tag_names t ON t.id = dt.tag_id
+            WHERE t.name IN ({placeholders})
+            GROUP BY dt.document_id HAVING COUNT(*) = ?
+            ORDER BY dt.document_id""",
+        names + [len(names)]
+    ).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+def tag_facets(db_path: str, selected_tags: list[str] = (), limit: int = 50) -> list[tuple[str, int]]:
+    """Tag counts over the documents that carry all `selected_tags`, most common first.
+
+    With no selection the counts cover every document; the selected tags
+    themselves are left out of the result.
+    """
+    names = sorted({normalize_tag(tag) for tag in selected_tags})
+    conn = connect(db_path)
+    if names:
+        placeholders = ",".join("?" * len(names))
+        scope = f"""WHERE dt.document_id IN (
+                       SELECT s.document_id FROM document_tags s JOIN tag_names st ON st.id = s.tag_id
+                       WHERE st.name IN ({placeholders})
+                       GROUP BY s.document_id HAVING COUNT(*) = ?)
+                    AND t.name NOT IN ({placeholders})"""
+        params = names + [len(names)] + names
+    else:
+        scope, params = "", []
+    rows = conn.execute(
+        f"""SELECT t.label, COUNT(*) AS n FROM document_tags dt JOIN tag_names t ON t.id = dt.tag_id
+            {scope}
+            GROUP BY t.id ORDER BY n DESC, t.name LIMIT ?""",
+        params + [limit]
+    ).fetchall()
     conn.close()
-    return doc_id
+    return [(row[0], row[1]) for row in rows]
@@ -0,0 +1,182 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from .db import connect
+
+HASH_SIZE = 16  # Difference hash grid; HASH_SIZE ** 2 bits per page
+SHINGLE_WORDS = 5
+MINHASH_PERMUTATIONS = 64
+TEXT_BANDS = 16  # MinHash LSH bands of MINHASH_PERMUTATIONS // TEXT_BANDS values each
+IMAGE_BANDS = 16  # Image hash bands; any two hashes within IMAGE_BANDS - 1 bits share at least one
+MAX_CANDIDATES = 200
+INK_MASK_SIZE = (192, 256)  # Ink mask compared pixel by pixel for pages without a text layer
+
+_MERSENNE = (1 << 61) - 1
+_rng = np.random.default_rng(20240611)
+_MINHASH_A = _rng.integers(1, 1 << 31, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _rng.integers(0, 1 << 31, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_WORD_RE = re.compile(r"\w+")
+
+def image_hash(img) -> bytes:
+    """Difference hash of a page: whether each pixel of a small grayscale copy is darker than its right neighbour."""
+    pixels = np.asarray(img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE)), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()
+
+def hash_distance(a: bytes, b: bytes) -> int:
+    return int(np.unpackbits(np.frombuffer(a, np.uint8) ^ np.frombuffer(b, np.uint8)).sum())
+
+def ink_mask(img) -> bytes:
+    """Which pixels of a downscaled grayscale copy carry ink, packed and compressed.
+
+    The threshold is relative to the page's own background, so the same page
+    rendered at another resolution or contrast gives nearly the same mask.
+    """
+    pixels = np.asarray(img.convert("L").resize(INK_MASK_SIZE, Image.BOX), dtype=np.float32)
+    return zlib.compress(np.packbits(pixels < np.median(pixels) - 12).tobytes())
+
+def ink_difference(a: bytes, b: bytes) -> float:
+    """Fraction of the inked pixels in either mask that differ between the two."""
+    a = np.unpackbits(np.frombuffer(zlib.decompress(a), np.uint8)).astype(bool)
+    b = np.unpackbits(np.frombuffer(zlib.decompress(b), np.uint8)).astype(bool)
+    return float((a ^ b).sum() / max((a | b).sum(), 1))
+
+def text_signature(text: str):
+    """MinHash signature of a page's word shingles, or None when the page has no text layer."""
+    words = _WORD_RE.findall((text or "").casefold())
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))}
+    ids = np.array([zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64)
+    hashed = (np.outer(_MINHASH_A, ids) + _MINHASH_B[:, None]) % _MERSENNE
+    return (hashed.min(axis=1) & 0xFFFFFFFF).astype("<u4").tobytes()
+
+def text_similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return float((np.frombuffer(a, "<u4") == np.frombuffer(b, "<u4")).mean())
+
+def _bucket(band: int, data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(bytes([band]) + data, digest_size=8).digest(), "big", signed=True)
+
+def fingerprint_bands(fingerprint: dict) -> list[tuple[int, int]]:
+    """(band, bucket) pairs under which a page is indexed and looked up."""
+    bands = []
+    signature = fingerprint["text_signature"]
+    if signature is not None:
+        width = len(signature) // TEXT_BANDS
+        bands.extend((band, _bucket(band, signature[band * width:(band + 1) * width])) for band in range(TEXT_BANDS))
+    digest = fingerprint["image_hash"]
+    width = len(digest) // IMAGE_BANDS
+    for band in range(IMAGE_BANDS):
+        part = digest[band * width:(band + 1) * width]
+        # Blank regions hash to all zero bits, which would make most pages candidates for each other
+        if any(part):
+            bands.append((TEXT_BANDS + band, _bucket(TEXT_BANDS + band, part)))
+    return bands
+
+def page_fingerprint(img, text: str) -> dict:
+    """A page's image hash, text signature (or ink mask) and index bands, as stored by DocumentWriter."""
+    fingerprint = dict(image_hash=image_hash(img), text_signature=text_signature(text))
+    # Scans have nothing but the image to go on, and a 256-bit hash can't tell pages of one layout apart
+    fingerprint["ink_mask"] = ink_mask(img) if fingerprint["text_signature"] is None else None
+    fingerprint["bands"] = fingerprint_bands(fingerprint)
+    return fingerprint
+
+class DuplicateMatch:
+    """Known near-duplicates of one document's pages.
+
+    `fingerprints` has an entry per page, `pages` the matching stored page as
+    (page_id, markdown) or None, and `document` the matching stored document as
+    (document_id, metadata dict) when every page matched one document in order.
+    """
+
+    def __init__(self, fingerprints: list[dict], pages: list, document=None):
+        self.fingerprints = fingerprints
+        self.pages = pages
+        self.document = document
+
+    def transcriptions(self) -> dict:
+        """Reusable transcriptions keyed by position in the document."""
+        return {j: page[1] for j, page in enumerate(self.pages) if page is not None}
+
+    def page_links(self) -> list:
+        return [page[0] if page is not None else None for page in self.pages]
+
+class DuplicateIndex:
+    """Finds pages and documents already in the database that a new document repeats.
+
+    Every transcribed page is stored with a difference hash of its image and a
+    MinHash of its text layer's word shingles, indexed by locality-sensitive
+    hash bands. A page matches a stored one when the image hashes differ in at
+    most `max_image_distance` bits and, if the pages have a text layer, their
+    estimated shingle similarity is at least `min_text_similarity`. Pages
+    without a text layer must also have ink masks that differ in at most
+    `max_ink_difference` of their inked pixels. Pages with a text layer never
+    match pages without one.
+    """
+
+    def __init__(self, db_path: str, min_text_similarity=0.9, max_image_distance=12, max_ink_difference=0.12):
+        self.db_path = db_path
+        self.min_text_similarity = min_text_similarity
+        self.max_image_distance = max_image_distance
+        self.max_ink_difference = max_ink_difference
+
+    def _similar(self, fingerprint: dict, image: bytes, signature, mask) -> bool:
+        if hash_distance(fingerprint["image_hash"], image) > self.max_image_distance:
+            return False
+        if fingerprint["text_signature"] is None and signature is None:
+            return (mask is not None and fingerprint["ink_mask"] is not None
+                    and ink_difference(fingerprint["ink_mask"], mask) <= self.max_ink_difference)
+        if fingerprint["text_signature"] is None or signature is None:
+            return False
+        return text_similarity(fingerprint["text_signature"], signature) >= self.min_text_similarity
+
+    def find_page(self, conn, fingerprint: dict):
+        """The closest stored near-duplicate as (page_id, document_id, page_number, markdown), or None."""
+        bands = fingerprint["bands"]
+        if not bands:
+            return None
+        values = ",".join("(?,?)" for _ in bands)
+        rows = conn.execute(
+            f"""SELECT p.id, p.document_id, p.page_number, p.markdown_text, f.image_hash, f.text_signature, f.ink_mask
+                FROM page_fingerprints f JOIN document_pages_text p ON p.id = f.page_id
+                WHERE f.page_id IN (SELECT b.page_id FROM fingerprint_bands b
+                                    JOIN (VALUES {values}) q ON b.band = q.column1 AND b.bucket = q.column2)
+                LIMIT ?""",
+            [v for band in bands for v in band] + [MAX_CANDIDATES]
+        ).fetchall()
+        matches = [row for row in rows if row[3] and self._similar(fingerprint, row[4], row[5], row[6])]
+        if not matches:
+            return None
+        best = min(matches, key=lambda row: (hash_distance(fingerprint["image_hash"], row[4]), row[0]))
+        return best[:4]
+
+    def _document(self, conn, matches: list):
+        """The stored document repeated page for page by `matches`, as (document_id, metadata), or None."""
+        if not matches or any(m is None for m in matches):
+            return None
+        doc_id = matches[0][1]
+        if any(m[1] != doc_id or m[2] != j for j, m in enumerate(matches, 1)):
+            return None
+        if conn.execute("SELECT COUNT(*) FROM document_pages WHERE document_id = ?", (doc_id,)).fetchone()[0] != len(matches):
+            return None
+        title, date, summary = conn.execute("SELECT title, date, summary FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        tags = [row[0] for row in conn.execute(
+            "SELECT t.label FROM document_tags dt JOIN tag_names t ON t.id = dt.tag_id WHERE dt.document_id = ? ORDER BY t.name",
+            (doc_id,))]
+        return doc_id, dict(title=title, date=date, summary=summary, tags=tags)
+
+    def match(self, pages, page_texts: list[str], segment) -> DuplicateMatch:
+        """Fingerprint a document's pages and look up stored near-duplicates of each page and of the whole."""
+        start, end = segment
+        fingerprints = [page_fingerprint(pages[p], page_texts[p]) for p in range(start, end + 1)]
+        conn = connect(self.db_path)
+        try:
+            matches = [self.find_page(conn, fingerprint) for fingerprint in fingerprints]
+            document = self._document(conn, matches)
+        finally:
+            conn.close()
+        return DuplicateMatch(fingerprints, [(m[0], m[3]) if m else None for m in matches], document)
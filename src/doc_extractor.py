@@ -1,6 +1,8 @@
-import base64
-from .pdf_utils import extract_pages_as_images, extract_pages_text
-from io import BytesIO
+from functools import partial
+from .pdf_utils import PageSource, extract_pages_text
+from .instructor_client import DocumentMetadata
+from .metrics import metrics
+from .checkpoint import segment_key
 import os
 from pathlib import Path
 
@@ -30,51 +32,141 @@ def save_markdown_files(output_dir: str, doc_title: str, doc_date: str, full_mar
             with open(page_path, 'w', encoding='utf-8') as f:
                 f.write(page_markdown)
 
-def extract_document_data(instructor_client, transcriber, pdf_path, segments, output_dir: str):
-    # Extract both images and text
-    print(f"Starting metadata extraction for {len(segments)} document segments")
-    pdf_images = extract_pages_as_images(pdf_path)
-    pdf_texts = extract_pages_text(pdf_path)
+def _checkpointed_pages(checkpoint, start, end):
+    """Checkpointed transcriptions for a segment (keyed by position in it) and a callback recording new ones."""
+    if checkpoint is None:
+        return {}, None
+    saved = checkpoint.get_all("transcription")
+    completed = {p - start: saved[str(p)] for p in range(start, end+1) if str(p) in saved}
+    return completed, lambda j, markdown: checkpoint.save("transcription", markdown, start + j)
+
+def _reusable_pages(checkpoint, start, end, duplicate=None):
+    """Checkpointed transcriptions for a segment, plus any a known near-duplicate supplies for the rest."""
+    completed, on_page = _checkpointed_pages(checkpoint, start, end)
+    if duplicate is not None:
+        completed = {**duplicate.transcriptions(), **completed}
+    return completed, on_page
+
+def prefetch_batch(batch_runner, instructor_client, transcriber, pages, segments, pdf_texts, checkpoint=None,
+                   metadata_mode="images", duplicates=None):
+    """Run every model request the extraction stage will make through the batch runner first.
+
+    Page transcriptions go in one batch; metadata prompts include those
+    transcriptions, so they follow in a second batch. The results land in the
+    response cache, where extract_document_data then finds them. Pages and
+    documents with a near-duplicate in `duplicates` are left out.
+    """
+    matches = {}
+
+    def duplicate(i):
+        if duplicates is not None and i not in matches:
+            matches[i] = duplicates.match(pages, pdf_texts, segments[i])
+        return matches.get(i)
+
+    def page_requests():
+        for i, (start, end) in enumerate(segments):
+            completed, _ = _reusable_pages(checkpoint, start, end, duplicate(i))
+            for p in range(start, end+1):
+                if p - start not in completed:
+                    yield transcriber.page_request(partial(pages.encoded, p), pdf_texts[p], pages.media_type)
+
+    def metadata_requests():
+        for i, (start, end) in enumerate(segments):
+            if checkpoint is not None and checkpoint.get("metadata", segment_key((start, end))) is not None:
+                continue
+            if duplicate(i) is not None and duplicate(i).document is not None:
+                continue
+            pages_data = [(partial(pages.encoded, p), pdf_texts[p]) for p in range(start, end+1)]
+            completed, on_page = _reusable_pages(checkpoint, start, end, duplicate(i))
+            _, page_markdowns = transcriber.transcribe_document(pages_data, pages.media_type, completed, on_page)
+            yield instructor_client.metadata_request(pages_data, page_markdowns, pages.media_type, metadata_mode)
+
+    print("Batching page transcriptions...")
+    batch_runner.run(page_requests())
+    print("Batching metadata extraction...")
+    batch_runner.run(metadata_requests())
+
+def extract_single_document(instructor_client, transcriber, pages, pdf_texts, segment, output_dir: str,
+                            checkpoint=None, metadata_mode="images", duplicate=None):
+    """Transcribe one document segment, extract its metadata and save its markdown files.
+
+    Returns (metadata, full_text, full_markdown, page_markdowns). Documents are
+    independent, so several can be in flight at once. With metadata_mode "text"
+    the metadata comes from the transcriptions alone, and the page images are
+    only sent if that answer fails validation. A `duplicate` match (see
+    dedup.py) supplies stored transcriptions and metadata for the pages and
+    document it covers; whatever it was not used for is dropped from it, so
+    the caller can record links to what was actually reused.
+    """
+    start, end = segment
+    doc_texts = pdf_texts[start:end+1]
     
-    # Get the PDF filename without extension to use as subdirectory name
-    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-    pdf_output_dir = output_dir
+    # Combine all text pages for this document
+    full_text = "\n\n".join(doc_texts)
     
-    docs_data = []
-    for i, (start, end) in enumerate(segments):
-        print(f"\nProcessing document {i+1}/{len(segments)} (pages {start}-{end})")
-        doc_pages = pdf_images[start:end+1]
-        doc_texts = pdf_texts[start:end+1]
-        
-        # Combine all text pages for this document
-        full_text = "\n\n".join(doc_texts)
-        
-        print(f"Converting {len(doc_pages)} pages to base64")
-        pages_data = []
-        for j, (page_img, page_text) in enumerate(zip(doc_pages, doc_texts)):
-            print(f"Converting page {j+1}/{len(doc_pages)}")
-            # Convert image to base64
-            buf = BytesIO()
-            page_img.save(buf, format='PNG')
-            page_b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-            # Store both image and text
-            pages_data.append((page_b64, page_text))
-            
-        # First: Generate markdown transcription
-        print("Generating markdown transcription...")
-        full_markdown, page_markdowns = transcriber.transcribe_document(pages_data)
-        
-        # Then: Extract metadata using both original data and markdown
-        print("Extracting metadata from pages...")
-        metadata = instructor_client.extract_metadata(pages_data, page_markdowns)
-        print(f"Successfully extracted metadata: {metadata.title}")
-        
-        # Save markdown files to output directory
-        print("Saving markdown files...")
-        save_markdown_files(pdf_output_dir, metadata.title, metadata.date, 
-                          full_markdown, page_markdowns)
+    # Resume from any checkpointed page transcriptions and metadata
+    completed, on_page = _checkpointed_pages(checkpoint, start, end)
+    saved_metadata = checkpoint.get("metadata", segment_key(segment)) if checkpoint is not None else None
+    if duplicate is not None:
+        duplicate.pages = [None if j in completed else page for j, page in enumerate(duplicate.pages)]
+        if saved_metadata is not None:
+            duplicate.document = None
+        if duplicate.transcriptions():
+            print(f"Reusing {len(duplicate.transcriptions())} transcriptions from near-duplicate pages")
+            metrics.count("duplicate_pages", len(duplicate.transcriptions()))
+        completed = {**duplicate.transcriptions(), **completed}
+    reused_metadata = duplicate.document[1] if duplicate is not None and duplicate.document is not None else None
+    
+    # Pages are only encoded when a request actually sends their image: pages transcribed from their
+    # text layer or reused from elsewhere, and text-only metadata, never touch it
+    pages_data = [(partial(pages.encoded, start + j), page_text) for j, page_text in enumerate(doc_texts)]
         
-        docs_data.append((metadata, full_text, full_markdown, page_markdowns))
+    # First: Generate markdown transcription
+    print("Generating markdown transcription...")
+    with metrics.stage("transcription"):
+        full_markdown, page_markdowns = transcriber.transcribe_document(pages_data, pages.media_type, completed, on_page)
+    
+    # Then: Extract metadata using both original data and markdown
+    if saved_metadata is not None:
+        print("Reusing checkpointed metadata")
+        metadata = DocumentMetadata.model_validate(saved_metadata)
+    elif reused_metadata is not None:
+        print(f"Reusing metadata of near-duplicate document {duplicate.document[0]}")
+        metrics.count("duplicate_documents")
+        metadata = DocumentMetadata.model_validate(reused_metadata)
+    else:
+        print(f"Extracting metadata from {'transcriptions' if metadata_mode == 'text' else 'pages'}...")
+        with metrics.stage("metadata"):
+            metadata = instructor_client.extract_metadata(pages_data, page_markdowns, pages.media_type, metadata_mode)
+        if checkpoint is not None:
+            checkpoint.save("metadata", metadata.model_dump(), segment_key(segment))
+    print(f"Successfully extracted metadata: {metadata.title}")
+    
+    # Save markdown files to output directory
+    print("Saving markdown files...")
+    save_markdown_files(output_dir, metadata.title, metadata.date, 
+                      full_markdown, page_markdowns)
+    
+    return metadata, full_text, full_markdown, page_markdowns
+
+def extract_document_data(instructor_client, transcriber, pdf_path, segments, output_dir: str, pages=None, page_texts=None,
+                          checkpoint=None, batch_runner=None, metadata_mode="images"):
+    # Reuse the caller's rendered pages when given, otherwise render them here
+    if pages is None:
+        with PageSource(pdf_path) as pages:
+            return extract_document_data(instructor_client, transcriber, pdf_path, segments, output_dir, pages, page_texts,
+                                         checkpoint, batch_runner, metadata_mode)
+
+    print(f"Starting metadata extraction for {len(segments)} document segments")
+    pdf_texts = page_texts if page_texts is not None else extract_pages_text(pdf_path)
+    if batch_runner is not None:
+        prefetch_batch(batch_runner, instructor_client, transcriber, pages, segments, pdf_texts, checkpoint, metadata_mode)
+    
+    docs_data = []
+    for i, segment in enumerate(segments):
+        print(f"\nProcessing document {i+1}/{len(segments)} (pages {segment[0]}-{segment[1]})")
+        docs_data.append(extract_single_document(instructor_client, transcriber, pages, pdf_texts, segment, output_dir,
+                                                 checkpoint, metadata_mode))
     
     print(f"\nCompleted metadata extraction for all {len(segments)} documents")
     return docs_data
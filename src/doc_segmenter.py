@@ -1,5 +1,51 @@
 import base64
+import json
+import re
 from io import BytesIO
+import numpy as np
+from .concurrency import ordered_imap
+from .pdf_utils import PageSource
+
+PAGE_OF_RE = re.compile(r"\bpage\s+(\d{1,4})\s+of\s+(\d{1,4})\b", re.IGNORECASE)
+BARE_PAGE_NUMBER_RE = re.compile(r"^\s*-?\s*(\d{1,4})\s*-?\s*$")
+# Page numbers sit in headers and footers, so only this many lines at each end of a page are searched
+PAGE_NUMBER_LINES = 3
+
+# Shared by the pairwise and window prompts of both providers, ahead of their mode-specific
+# instructions, so it is one cacheable prefix (see prompt_cache.py)
+SEGMENTATION_GUIDE = """You are a document segmentation assistant working on PDFs assembled for legal document review. Each PDF is a stack of separate documents that were scanned or printed one after another into a single file: pleadings, motions, orders, pre-filed testimony and its exhibits, discovery requests and responses, correspondence, emails, contracts, reports, spreadsheets and presentation slides. Your job is to find the pages where one document ends and the next begins, so that every document can be bookmarked and split out on its own.
+
+Look at each page the way a paralegal flipping through the stack would. A page starts a new document when it could only sensibly be the first page of something. Strong signs of a new document:
+- A cover page, title page or slip sheet (for example a page that says only "EXHIBIT 4" or "ATTACHMENT B").
+- A letterhead, a memo block (To / From / Date / Re), or a fax cover sheet at the top of the page.
+- A case caption: the tribunal's name (such as "BEFORE THE LOUISIANA PUBLIC SERVICE COMMISSION"), the parties, a docket or case number and the title of the filing.
+- An email header block with From, Sent, To and Subject lines, unless it is an earlier message quoted further down the same thread.
+- Page numbering that restarts at 1, or a "Page 1 of N" footer.
+- A drastically different layout, paper size, orientation, typeface or scan quality from the page before, together with a heading that introduces new content.
+- A new table of contents, a new agreement title ("POWER PURCHASE AGREEMENT"), or a new data request number heading a response.
+
+Strong signs that a page continues the previous document:
+- Sequential page numbers in the same style and position, or a running header or footer that matches the previous page.
+- A sentence, list, table or numbered paragraph that carries over from the bottom of the previous page.
+- Words such as "(continued)" or "Continued from previous page", or a table repeating its column headings.
+- Signature blocks, certificates of service, verification pages, notary blocks and distribution lists. These close the document they follow; they do not start a new one.
+- Blank pages, separator pages with no content and scanner artifacts. Treat them as part of the document before them unless they are clearly a slip sheet labelled for what follows.
+- Attachments referred to inside a letter or pleading as "enclosed" belong to it only when they have no cover or slip sheet of their own. An attachment with its own slip sheet or title page is a new document.
+
+How common document types in these files begin and end:
+- Pleadings and motions open with a caption and a title, run through numbered paragraphs, and end with a signature block and a certificate of service. Exhibits filed with them usually follow behind their own slip sheets.
+- Pre-filed testimony opens with a cover page naming the witness and the docket, often followed by a table of contents, and is laid out as numbered questions and answers on line-numbered pages. Its exhibits are separate documents, each with its own label.
+- Orders and rulings open with the tribunal's caption and end with the commissioners' or judge's signatures and the date of issue.
+- Discovery requests list numbered requests; each response set opens with a caption or a cover letter and usually restates each request before its answer. A single response with its own heading and page numbering, produced on its own, is its own document.
+- Letters open with a letterhead, a date and an addressee, and end with a signature and any "cc" list. Emails open with a header block, and printed threads keep going across pages until the next printed header that is not quoted.
+- Contracts and agreements open with a title and recitals, continue through articles and sections, and end with signature pages, after which schedules and appendices usually follow with their own headings.
+- Spreadsheets, financial schedules and slide decks often change layout from page to page; printed spreadsheet pages that share column headings or a workbook title belong together, and each slide of a deck belongs to the deck until a new title slide appears.
+
+Bates numbers and production stamps usually run across document boundaries, so a continuing Bates sequence is not by itself a sign of continuation. A change in the Bates prefix, however, usually does mean a new document from another producing party.
+
+When the signals conflict, prefer the reading that keeps a coherent document together: a heading in the middle of a report is a new section, not a new document, and a letter's second page without letterhead is a continuation. When a page is genuinely ambiguous and nothing on it introduces new content, treat it as a continuation. Splitting a document in two is harder for the reviewing attorney to notice and fix than a missed boundary.
+
+Judge only from what is visible on the pages you are given. Do not explain your reasoning or describe the pages; answer exactly in the format requested below."""
 
 def pil_to_base64(img):
     print(f"Converting image to base64...")
@@ -9,31 +55,262 @@ def pil_to_base64(img):
     print(f"Successfully converted image to base64 string of length {len(b64_str)}")
     return b64_str
 
-def segment_document(anthropic_client, pdf_images):
+def encoded_page(pdf_images, index: int) -> tuple[str, str]:
+    """Return (base64, media_type) for a page, reusing the PageSource's shared encoding when available."""
+    if isinstance(pdf_images, PageSource):
+        return pdf_images.encoded(index), pdf_images.media_type
+    return pil_to_base64(pdf_images[index]), "image/png"
+
+def parse_document_starts(answer: str, window_len: int) -> list[int]:
+    """Parse a windowed segmentation answer into sorted 0-based window positions (excluding the first page)."""
+    match = re.search(r"\{.*\}", answer, re.DOTALL)
+    if not match:
+        raise ValueError(f"No JSON object in segmentation answer: {answer[:200]}")
+    pages = json.loads(match.group(0)).get("new_document_pages", [])
+    return sorted({int(p) - 1 for p in pages if 2 <= int(p) <= window_len})
+
+def page_windows(page_count: int, window_size: int, overlap: int) -> list[tuple[int, int]]:
+    """Overlapping (start, end) page windows covering every adjacent page pair."""
+    if window_size < 2:
+        raise ValueError("window_size must be at least 2")
+    if not 0 <= overlap < window_size - 1:
+        raise ValueError("overlap must be between 0 and window_size - 2")
+    windows = []
+    step = window_size - 1 - overlap
+    start = 0
+    while start < page_count - 1:
+        end = min(start + window_size - 1, page_count - 1)
+        windows.append((start, end))
+        if end == page_count - 1:
+            break
+        start += step
+    return windows
+
+def page_number(text: str):
+    """Return (number, total) from a page's text layer, with total None for bare footer numbers."""
+    lines = [line for line in (text or "").splitlines() if line.strip()]
+    edges = lines if len(lines) <= 2 * PAGE_NUMBER_LINES else lines[:PAGE_NUMBER_LINES] + lines[-PAGE_NUMBER_LINES:]
+    match = PAGE_OF_RE.search("\n".join(edges))
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    for line in lines[-1:] + lines[:1]:
+        match = BARE_PAGE_NUMBER_RE.match(line)
+        if match:
+            return int(match.group(1)), None
+    return None
+
+class BoundaryPrefilter:
+    """Cheap local scoring of adjacent page pairs so only ambiguous pairs go to the model.
+
+    Each pair is classified as an obvious continuation, an obvious new document or
+    ambiguous. Text-layer "Page k of n" numbering settles a pair on its own.
+    Pages are also compared on a difference hash, ink layout profiles and the
+    header band of small grayscale thumbnails, but consecutive documents built
+    from one template look alike, so the visual score only settles a pair when
+    bare page numbers agree with it: a similarity at or above
+    `continuation_threshold` with numbering that carries on is a continuation,
+    and one at or below `new_document_threshold` with numbering restarting at 1
+    is a new document. Everything else goes to the model.
+    """
+
+    def __init__(self, continuation_threshold=0.9, new_document_threshold=0.2, thumbnail_size=64):
+        self.continuation_threshold = continuation_threshold
+        self.new_document_threshold = new_document_threshold
+        self.thumbnail_size = thumbnail_size
+
+    def _fingerprint(self, img):
+        """A page's grayscale thumbnail (0-1) and difference-hash grid, from one grayscale conversion."""
+        gray = img.convert("L")
+        size = self.thumbnail_size
+        thumb = np.asarray(gray.resize((size, size)), dtype=np.float32) / 255.0
+        return thumb, np.asarray(gray.resize((9, 8)), dtype=np.float32)
+
+    def similarities(self, pdf_images, pages=None) -> np.ndarray:
+        """Visual similarity in [0, 1] of each page in `pages` (default: every page after the first) to the page before it.
+
+        Only the pages involved are fingerprinted, so scoring a few pairs does not render the whole PDF.
+        """
+        pages = list(range(1, len(pdf_images)) if pages is None else pages)
+        if not pages:
+            return np.zeros(0, dtype=np.float32)
+        fingerprints = {}
+        for i in sorted({p for page in pages for p in (page - 1, page)}):
+            fingerprints[i] = self._fingerprint(pdf_images[i])
+        prev_thumbs, prev_hashes = (np.stack(a) for a in zip(*(fingerprints[i - 1] for i in pages)))
+        curr_thumbs, curr_hashes = (np.stack(a) for a in zip(*(fingerprints[i] for i in pages)))
+
+        # Difference hash: fraction of differing gradient bits
+        prev_bits = prev_hashes[:, :, 1:] > prev_hashes[:, :, :-1]
+        curr_bits = curr_hashes[:, :, 1:] > curr_hashes[:, :, :-1]
+        hash_dist = (curr_bits != prev_bits).reshape(len(pages), -1).mean(axis=1)
+
+        # Layout: where the ink sits along rows and columns
+        def profiles(thumbs):
+            ink = (thumbs < 0.5).astype(np.float32)
+            return np.concatenate([ink.mean(axis=2), ink.mean(axis=1)], axis=1)
+
+        prev_profiles, curr_profiles = profiles(prev_thumbs), profiles(curr_thumbs)
+        diff = np.abs(curr_profiles - prev_profiles).sum(axis=1)
+        mass = curr_profiles.sum(axis=1) + prev_profiles.sum(axis=1)
+        layout_dist = np.where(mass > 0, diff / np.maximum(mass, 1e-6), 0.0)
+
+        # Header band, where letterheads and captions live
+        header_rows = max(self.thumbnail_size // 8, 1)
+        header_dist = np.abs(curr_thumbs[:, :header_rows, :] - prev_thumbs[:, :header_rows, :]).mean(axis=(1, 2)) * 2.0
+
+        dist = 0.4 * hash_dist + 0.4 * layout_dist + 0.2 * np.minimum(header_dist, 1.0)
+        return 1.0 - np.clip(dist, 0.0, 1.0)
+
+    def classify(self, pdf_images, page_texts=None) -> list:
+        """For each page after the first: True (new document), False (continuation) or None (ask the model)."""
+        numbers = [page_number(text) for text in page_texts] if page_texts else [None] * len(pdf_images)
+        decisions, candidates = [], {}
+        for i in range(1, len(pdf_images)):
+            prev_num, curr_num = numbers[i-1], numbers[i]
+            continues = bool(curr_num and prev_num and curr_num[0] == prev_num[0] + 1 and curr_num[1] == prev_num[1])
+            restarts = bool(curr_num and prev_num and curr_num[0] == 1)
+            if continues and curr_num[1] is not None:
+                decisions.append(False)
+            elif curr_num and curr_num[0] == 1 and curr_num[1] is not None:
+                decisions.append(True)
+            else:
+                decisions.append(None)
+                # The visual score can only settle a pair whose bare numbering carries on or restarts
+                if continues or restarts:
+                    candidates[i] = (continues, restarts)
+        if candidates:
+            scores = self.similarities(pdf_images, list(candidates))
+            for (i, (continues, restarts)), similarity in zip(candidates.items(), scores):
+                if continues and similarity >= self.continuation_threshold:
+                    decisions[i-1] = False
+                elif restarts and similarity <= self.new_document_threshold:
+                    decisions[i-1] = True
+        return decisions
+
+def _segment_pairs(client, pdf_images, decisions, max_workers, batch_runner=None):
+    """Ask the model about each undecided adjacent page pair.
+
+    Yields (page, is_new) for every page after the first, in page order, as soon
+    as that page's decision is final.
+    """
+    ambiguous = [i for i in range(1, len(pdf_images)) if decisions[i-1] is None]
+    if batch_runner is not None:
+        def pair_request(i):
+            prev_image_b64, media_type = encoded_page(pdf_images, i-1)
+            curr_image_b64, _ = encoded_page(pdf_images, i)
+            return client.segmentation_request(prev_image_b64, curr_image_b64, media_type)
+
+        print(f"Batching {len(ambiguous)} page pair checks...")
+        batch_runner.run(pair_request(i) for i in ambiguous)
+
+    def check_page(i):
+        print(f"\nProcessing page {i}/{len(pdf_images)-1}")
+        prev_image_b64, media_type = encoded_page(pdf_images, i-1)
+        curr_image_b64, _ = encoded_page(pdf_images, i)
+        print(f"Checking if page {i} starts a new document...")
+        return client.is_new_document(prev_image_b64, curr_image_b64, media_type)
+
+    # Page pairs are independent, so they can be checked concurrently
+    answers = ordered_imap(check_page, ambiguous, max_workers)
+    for i in range(1, len(pdf_images)):
+        if decisions[i-1] is None:
+            decisions[i-1] = next(answers)
+        yield i, decisions[i-1]
+
+def _segment_windows(client, pdf_images, decisions, max_workers, window_size, overlap, batch_runner=None):
+    """Ask the model about overlapping windows of pages, one request per window.
+
+    A boundary seen by two overlapping windows is taken from the window where it
+    sits furthest from the edges, which has the most context on both sides. Like
+    _segment_pairs, yields (page, is_new) in page order; a page is final once no
+    later window covers it.
+    """
+    windows = [
+        (start, end) for start, end in page_windows(len(pdf_images), window_size, overlap)
+        if any(decisions[i-1] is None for i in range(start + 1, end + 1))
+    ]
+    print(f"Checking {len(windows)} windows of up to {window_size} pages")
+
+    def window_images(window):
+        start, end = window
+        images_b64 = []
+        media_type = "image/png"
+        for i in range(start, end + 1):
+            image_b64, media_type = encoded_page(pdf_images, i)
+            images_b64.append(image_b64)
+        return images_b64, media_type
+
+    if batch_runner is not None:
+        print(f"Batching {len(windows)} window checks...")
+        batch_runner.run(client.window_request(*window_images(window)) for window in windows)
+
+    def check_window(window):
+        start, end = window
+        print(f"\nProcessing pages {start}-{end}")
+        images_b64, media_type = window_images(window)
+        return {start + pos for pos in client.find_document_starts(images_b64, media_type)}
+
+    settled = {i for i in range(1, len(pdf_images)) if decisions[i-1] is not None}
+    best = {}
+    next_page = 1
+    results = ordered_imap(check_window, windows, max_workers)
+    for w, ((start, end), starts) in enumerate(zip(windows, results)):
+        for i in range(start + 1, end + 1):
+            if i in settled:
+                continue
+            margin = min(i - start, end - i)
+            if i not in best or margin > best[i]:
+                best[i] = margin
+                decisions[i-1] = i in starts
+        # A window decides pages after its first, so the next window's first page is already final
+        final_until = windows[w+1][0] if w + 1 < len(windows) else len(pdf_images) - 1
+        while next_page <= final_until:
+            yield next_page, decisions[next_page-1]
+            next_page += 1
+    while next_page < len(pdf_images):
+        yield next_page, decisions[next_page-1]
+        next_page += 1
+
+def iter_segments(anthropic_client, pdf_images, max_workers=1, page_texts=None, prefilter=None,
+                  mode="pairwise", window_size=8, window_overlap=2, batch_runner=None):
+    """Yield (start, end) document segments in order, each as soon as its closing boundary is known."""
     print(f"\nStarting document segmentation for {len(pdf_images)} pages")
     # pdf_images: list of PIL images of each page
     # We'll assume page 0 is start of first doc
-    segments = []
-    doc_start_pages = [0]
-    print("Analyzing pages for document boundaries...")
-    for i in range(1, len(pdf_images)):
-        print(f"\nProcessing page {i}/{len(pdf_images)-1}")
-        prev_image_b64 = pil_to_base64(pdf_images[i-1])
-        curr_image_b64 = pil_to_base64(pdf_images[i])
-        print(f"Checking if page {i} starts a new document...")
-        if anthropic_client.is_new_document(prev_image_b64, curr_image_b64):
+
+    # Settle obvious pairs locally; only ambiguous ones are sent to the model
+    decisions = [None] * max(len(pdf_images) - 1, 0)
+    if prefilter is not None and len(pdf_images) > 1:
+        print("Pre-classifying page pairs locally...")
+        decisions = prefilter.classify(pdf_images, page_texts)
+        skipped = sum(d is not None for d in decisions)
+        print(f"Pre-classifier settled {skipped}/{len(decisions)} page pairs locally")
+        if mode != "window":
+            print(f"Skipping {skipped} model calls")
+
+    print(f"Analyzing pages for document boundaries ({mode} mode) with {max_workers} worker(s)...")
+    if mode == "window":
+        stream = _segment_windows(anthropic_client, pdf_images, decisions, max_workers, window_size, window_overlap,
+                                  batch_runner)
+    else:
+        stream = _segment_pairs(anthropic_client, pdf_images, decisions, max_workers, batch_runner)
+
+    start = 0
+    for i, is_new in stream:
+        if is_new:
             print(f"Found new document starting at page {i}")
-            doc_start_pages.append(i)
-    
-    print(f"\nFound {len(doc_start_pages)} document start pages: {doc_start_pages}")
-    # doc_start_pages now has start pages of each doc
-    # Convert into (start,end) tuples
-    doc_segments = []
-    print("\nConverting start pages into document segments...")
-    for idx, start in enumerate(doc_start_pages):
-        end = doc_start_pages[idx+1]-1 if idx+1 < len(doc_start_pages) else len(pdf_images)-1
-        doc_segments.append((start, end))
+            print(f"Document ready: pages {start}-{i-1}")
+            yield start, i - 1
+            start = i
+    print(f"Document ready: pages {start}-{len(pdf_images)-1}")
+    yield start, len(pdf_images) - 1
+
+def segment_document(anthropic_client, pdf_images, max_workers=1, page_texts=None, prefilter=None,
+                     mode="pairwise", window_size=8, window_overlap=2, batch_runner=None):
+    doc_segments = list(iter_segments(anthropic_client, pdf_images, max_workers, page_texts, prefilter, mode,
+                                      window_size, window_overlap, batch_runner))
+    print(f"\nFound {len(doc_segments)} document start pages: {[start for start, _ in doc_segments]}")
+    for idx, (start, end) in enumerate(doc_segments):
         print(f"Document {idx+1}: pages {start}-{end}")
-    
     print(f"\nSegmentation complete. Found {len(doc_segments)} documents")
     return doc_segments
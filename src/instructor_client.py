@@ -1,10 +1,17 @@
 import instructor
 from pydantic import BaseModel
 from typing import List
+from datetime import date
 import time
-from anthropic import Anthropic, APIError, RateLimitError
+from anthropic import Anthropic
 import base64
 from openai import OpenAI
+from .batch import json_instruction, parse_json_response
+from .cache import ResponseCache
+from .metrics import metrics, usage_tokens, payload_bytes, cache_usage
+from .pdf_utils import resolve_image
+from .prompt_cache import system_message, cache_options
+from .rate_limit import scheduler_for, estimate_tokens, api_error
 
 class DocumentMetadata(BaseModel):
     title: str
@@ -12,70 +19,181 @@ class DocumentMetadata(BaseModel):
     summary: str
     tags: List[str]
 
+# The system prompt of every metadata request, in both modes, so they share one cacheable
+# prefix (see prompt_cache.py); the document's pages follow in the user turn
+METADATA_PROMPT = """Extract the following information from the given document:
+1. Document Title (use a short but descriptive title)
+2. The date the document was created, or in the case of legal pleadings, the date the document was originally filed, in the format YYYY-MM-DD. If you cannot tell very obviously when the document was created or filed, enter the date as Unknown. Don't guess. Not all dates correspond to the date the document was created or filed, it could just be a date referenced in the document for other reasons.
+3. Document Summary. When you are summarizing the document, keep the following in mind: We represent OxyChem in this proceeding.OxyChem’s interest is ensuring that the cost of these facilities does not get passed on to Entergy’s other customers. OxyChem has 3 large plants in Louisiana, one of which has a CCGT that provides all of its power and the other two of which take all their power from Entergy. OxyChem also has a long-term Purchased Power Agreement (PPA) through which it supplies Entergy with excess power from its CCGT. So, OxyChem may contest whether Entergy should have put the power supply for this new customer out for solicitation through an RFP into which OxyChem could have bid.
+4. Document Tags - Use the Type of Tags You'd Expect An Attorney to Assign in a Document Review Project
+
+The document is given page by page, as page images with their transcriptions or as transcriptions alone. Very long documents may be given as their first and last pages only; base your answer on what is given and do not speculate about the pages left out.
+
+Title
+- Name the kind of document and what it is about, the way it would appear in an exhibit list or a privilege log, for example "Direct Testimony of Jane Smith on Behalf of Entergy Louisiana", "Staff's First Set of Data Requests to Entergy", "Letter from Entergy to LPSC Staff Regarding Confidential Filing" or "Power Purchase Agreement Between OxyChem and Entergy".
+- Use the document's own title when it has a clear one, shortened if it is very long. Include the party or witness when that is what distinguishes the document from others like it.
+- Do not put the date, the docket number or a Bates number in the title; they are recorded elsewhere.
+
+Date
+- For pleadings, motions, testimony and other filings, use the date on the filing stamp or the date of filing; if there is no stamp, use the date in the certificate of service or next to the signature.
+- For orders and rulings, use the date the order was issued or signed. For letters and memos, use the date line. For emails, use the sent date of the latest message in the thread. For transcripts, use the date of the hearing or deposition. For contracts, use the effective date, or else the date of the last signature.
+- Dates that are only referenced in the text, such as deadlines, hearing dates set by an order, contract terms or the dates of earlier filings, are not the document's date.
+- Write the date as YYYY-MM-DD. If only a month and year are shown, or you are not sure which date applies, write Unknown rather than guessing.
+
+Summary
+- Write two to five sentences in plain language: what the document is, who prepared it and for whom, and what it says or asks for.
+- Then note anything that bears on OxyChem's interests described above, such as how the cost of the new facilities is to be recovered or allocated, whether other customers bear any of it, whether the power supply was or should have been put out for an RFP or other solicitation, and anything about OxyChem's plants, its CCGT or its PPA with Entergy. If the document has nothing relevant to those interests, say so in one short sentence.
+- Mention specific dollar amounts, megawatt figures, rates and dates when the document states them.
+- Do not quote long passages, and do not include opinions that the document does not support.
+
+Tags
+- Give three to eight short tags in Title Case.
+- Start with the document type: Pleading, Motion, Order, Testimony, Exhibit, Data Request, Data Response, Correspondence, Email, Contract, Transcript, Report, Presentation, Financial Schedule or Public Comment.
+- Add the parties or witnesses it principally concerns, such as Entergy Louisiana, OxyChem, LPSC Staff or an intervenor's name.
+- Add the issues it addresses, using consistent names such as Cost Recovery, Cost Allocation, Rate Impact, RFP, Solicitation, Power Purchase Agreement, CCGT, Generation, Transmission, Customer Contract, Prudence, Public Interest or Procedural Schedule.
+- Add Confidential or Highly Sensitive when the document is marked that way, and Privileged when it appears to be attorney-client communication or work product.
+- Reuse these names whenever they fit rather than inventing synonyms, so that the same tag groups the same documents across the whole review."""
+
+def select_text_pages(page_texts: list[str], max_chars: int = 60000, head_pages: int = 6,
+                      tail_pages: int = 2) -> list[tuple[int, str]]:
+    """Pick (index, text) pages for a text-only metadata prompt.
+
+    Documents that fit in `max_chars` are sent whole. Longer ones keep their first
+    `head_pages` and last `tail_pages` pages, where titles, dates, signatures and
+    filing stamps sit, and each kept page is cut to an equal share of the budget.
+    """
+    selected = list(enumerate(page_texts))
+    if sum(len(text) for text in page_texts) <= max_chars:
+        return selected
+    if len(selected) > head_pages + tail_pages:
+        selected = selected[:head_pages] + (selected[-tail_pages:] if tail_pages else [])
+    if sum(len(text) for _, text in selected) > max_chars:
+        share = max_chars // len(selected)
+        selected = [(i, text[:share]) for i, text in selected]
+    return selected
+
+def metadata_is_plausible(metadata: DocumentMetadata) -> bool:
+    """Sanity checks a text-only answer has to pass; anything else is asked again with the page images."""
+    if not metadata.title.strip() or not metadata.summary.strip():
+        return False
+    if metadata.date == "Unknown":
+        return True
+    try:
+        date.fromisoformat(metadata.date)
+        return len(metadata.date) == 10
+    except ValueError:
+        return False
+
 class InstructorClient:
-    def __init__(self, model_client, provider="anthropic", max_retries=3, retry_delay=1):
+    def __init__(self, model_client, provider="anthropic", cache=None, scheduler=None):
         self.provider = provider
+        self.cache = cache
+        self.scheduler = scheduler or scheduler_for(provider)
         if provider == "anthropic":
             self.client = instructor.from_anthropic(model_client)
         else:
             self.client = instructor.patch(model_client)
-        self.max_retries = max_retries
-        self.retry_delay = retry_delay
     
-    def extract_metadata(self, pages_data: list[tuple[str, str]], page_markdowns: list[str]) -> DocumentMetadata:
-        retries = 0
-        last_error = None
-        
-        while retries < self.max_retries:
+    def metadata_request(self, pages_data: list[tuple[str, str]], page_markdowns: list[str], media_type: str = "image/png",
+                         mode: str = "images") -> dict:
+        """Build the metadata request: its cache key, messages, batch request body and answer parser.
+
+        mode "text" asks from the transcriptions and text layer alone; "images" also sends every page image.
+        Images may be given as callables (see resolve_image), which are only called in "images" mode.
+        """
+        if mode == "text":
+            return self.text_metadata_request(page_markdowns, [text for _, text in pages_data])
+        pages_data = [(resolve_image(image), text) for image, text in pages_data]
+        content = [
+            item for idx, ((page_b64, _), page_markdown) in enumerate(zip(pages_data, page_markdowns)) for item in [
+                {"type": "image_url" if self.provider == "openai" else "image",
+                 "image_url" if self.provider == "openai" else "source": {
+                     "url" if self.provider == "openai" else "type": f"data:{media_type};base64,{page_b64}" if self.provider == "openai" else "base64",
+                     "detail": "high" if self.provider == "openai" else None,
+                     "media_type": media_type if self.provider == "anthropic" else None,
+                     "data": page_b64 if self.provider == "anthropic" else None
+                 }},
+                {"type": "text", "text": f"Page {idx+1} formatted content:\n{page_markdown}\n---"}
+            ]
+        ]
+
+        return self._request(content, [page_b64 for page_b64, _ in pages_data])
+
+    def text_metadata_request(self, page_markdowns: list[str], page_texts: list[str]) -> dict:
+        """Metadata request built from page transcriptions alone, falling back to the text layer for blank ones."""
+        page_contents = [markdown if markdown.strip() else (text or "") for markdown, text in zip(page_markdowns, page_texts)]
+        selected = select_text_pages(page_contents)
+        content = []
+        if len(selected) < len(page_contents):
+            content.append({"type": "text", "text": f"The document has {len(page_contents)} pages; only its first and "
+                                                    f"last pages are included below.\n"})
+        previous = -1
+        for idx, text in selected:
+            if idx > previous + 1:
+                content.append({"type": "text", "text": f"[Pages {previous+2}-{idx} omitted]\n---"})
+            content.append({"type": "text", "text": f"Page {idx+1} content:\n{text}\n---"})
+            previous = idx
+        return self._request(content, [], check=metadata_is_plausible)
+
+    def _request(self, content, images, check=None) -> dict:
+        model = "claude-3-5-sonnet-latest" if self.provider == "anthropic" else "gpt-4o"
+        prompt = METADATA_PROMPT + "".join(item["text"] for item in content if item["type"] == "text")
+        messages = [system_message(self.provider, METADATA_PROMPT), {"role": "user", "content": content}]
+        batch_messages = [{"role": "user", "content": content + [json_instruction(DocumentMetadata)]}]
+
+        def parse(text):
+            metadata = parse_json_response(text, DocumentMetadata)
+            if check is not None and not check(metadata):
+                raise ValueError(f"Implausible metadata: {metadata.title!r} dated {metadata.date!r}")
+            return metadata.model_dump_json()
+
+        return {
+            "key": ResponseCache.make_key(self.provider, model, prompt, images),
+            "messages": messages,
+            "body": {"model": model, "max_tokens": 8000, "system": METADATA_PROMPT, "messages": batch_messages},
+            "parse": parse,
+        }
+
+    def extract_metadata(self, pages_data: list[tuple[str, str]], page_markdowns: list[str], media_type: str = "image/png",
+                         mode: str = "images") -> DocumentMetadata:
+        if mode == "text":
             try:
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Extract the following information from the given document:\n1. Document Title (use a short but descriptive title)\n2. The date the document was created, or in the case of legal pleadings, the date the document was originally filed, in the format YYYY-MM-DD. If you cannot tell very obviously when the document was created or filed, enter the date as Unknown. Don't guess. Not all dates correspond to the date the document was created or filed, it could just be a date referenced in the document for other reasons.\n3. Document Summary. When you are summarizing the document, keep the following in mind: We represent OxyChem in this proceeding.OxyChem’s interest is ensuring that the cost of these facilities does not get passed on to Entergy’s other customers. OxyChem has 3 large plants in Louisiana, one of which has a CCGT that provides all of its power and the other two of which take all their power from Entergy. OxyChem also has a long-term Purchased Power Agreement (PPA) through which it supplies Entergy with excess power from its CCGT. So, OxyChem may contest whether Entergy should have put the power supply for this new customer out for solicitation through an RFP into which OxyChem could have bid.\n4. Document Tags - Use the Type of Tags You'd Expect An Attorney to Assign in a Document Review Project\n"},
-                        ] + [
-                            item for idx, ((page_b64, _), page_markdown) in enumerate(zip(pages_data, page_markdowns)) for item in [
-                                {"type": "image_url" if self.provider == "openai" else "image",
-                                 "image_url" if self.provider == "openai" else "source": {
-                                     "url" if self.provider == "openai" else "type": f"data:image/png;base64,{page_b64}" if self.provider == "openai" else "base64",
-                                     "detail": "high" if self.provider == "openai" else None,
-                                     "media_type": "image/png" if self.provider == "anthropic" else None,
-                                     "data": page_b64 if self.provider == "anthropic" else None
-                                 }},
-                                {"type": "text", "text": f"Page {idx+1} formatted content:\n{page_markdown}\n---"}
-                            ]
-                        ]
-                    }
-                ]
-                
-                model = "claude-3-5-sonnet-latest" if self.provider == "anthropic" else "gpt-4o"
-                return self.client.chat.completions.create(
-                    model=model,
-                    max_tokens=8000,
-                    messages=messages,
-                    response_model=DocumentMetadata,
-                )
-            except RateLimitError as e:
-                retries += 1
-                last_error = e
-                if retries == self.max_retries:
-                    break
-                print(f"Rate limit hit, retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay * (2 ** (retries - 1)))  # Exponential backoff
-            except APIError as e:
-                retries += 1
-                last_error = e
-                if retries == self.max_retries:
-                    break
-                print(f"API error occurred, retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay)
+                metadata = self._complete(self.text_metadata_request(page_markdowns, [text for _, text in pages_data]))
+                if metadata_is_plausible(metadata):
+                    return metadata
+                problem = f"implausible answer {metadata.title!r} dated {metadata.date!r}"
             except Exception as e:
-                # For unexpected errors, fail immediately
-                raise Exception(f"Unexpected error during metadata extraction: {str(e)}") from e
-        
-        # If we've exhausted retries, raise the last error
-        if last_error:
-            if isinstance(last_error, RateLimitError):
-                raise Exception(f"Rate limit exceeded after {retries} retries") from last_error
-            else:
-                raise Exception(f"API error after {retries} retries: {str(last_error)}") from last_error
+                # Exhausted API retries would fail the same way with images
+                if api_error(e) is not None:
+                    raise
+                problem = str(e)
+            print(f"Text-only metadata failed validation ({problem}); retrying with page images")
+            metrics.count("metadata_image_fallbacks")
+        return self._complete(self.metadata_request(pages_data, page_markdowns, media_type))
+
+    def _complete(self, request: dict) -> DocumentMetadata:
+        if self.cache is not None:
+            cached = self.cache.get(request["key"])
+            if cached is not None:
+                return DocumentMetadata.model_validate_json(cached)
+
+        def send():
+            started = time.perf_counter()
+            metadata = self.client.chat.completions.create(
+                model=request["body"]["model"],
+                max_tokens=8000,
+                messages=request["messages"],
+                response_model=DocumentMetadata,
+                **cache_options(self.provider, "metadata"),
+            )
+            metrics.observe_call("metadata", time.perf_counter() - started, *usage_tokens(metadata),
+                                 payload_bytes(request["messages"]), **cache_usage(metadata))
+            return metadata
+
+        try:
+            metadata = self.scheduler.call(send, estimate_tokens(request["messages"]), "Metadata extraction")
+        except Exception as e:
+            raise Exception(f"Metadata extraction failed: {str(e)}") from e
+        if self.cache is not None:
+            self.cache.put(request["key"], metadata.model_dump_json())
+        return metadata
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the model call latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+CALL_FIELDS = ("count", "latency_seconds", "input_tokens", "output_tokens", "request_bytes",
+               "cache_hits", "cache_read_tokens", "cache_write_tokens")
+
+def usage_tokens(response) -> tuple[int, int]:
+    """(input, output) token counts from an Anthropic or OpenAI response, or instructor's raw response."""
+    raw = getattr(response, "_raw_response", response)
+    usage = getattr(raw, "usage", None)
+    counts = []
+    for names in (("input_tokens", "prompt_tokens"), ("output_tokens", "completion_tokens")):
+        value = next((getattr(usage, name) for name in names if isinstance(getattr(usage, name, None), int)), 0)
+        counts.append(value)
+    return counts[0], counts[1]
+
+def cache_usage(response) -> dict:
+    """Prompt cache tokens read and written by a call, as observe_call keyword arguments.
+
+    Anthropic reports both; OpenAI only reports cached (read) prompt tokens.
+    """
+    raw = getattr(response, "_raw_response", response)
+    usage = getattr(raw, "usage", None)
+    read = getattr(usage, "cache_read_input_tokens", None)
+    if not isinstance(read, int):
+        read = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    written = getattr(usage, "cache_creation_input_tokens", None)
+    return dict(cache_read_tokens=read if isinstance(read, int) else 0,
+                cache_write_tokens=written if isinstance(written, int) else 0)
+
+def payload_bytes(messages, system=None) -> int:
+    """Approximate request size: the JSON-encoded messages and system prompt."""
+    return len(json.dumps(messages, default=str)) + len(system or "")
+
+class Metrics:
+    """Run-wide timing, token and payload counters.
+
+    Stages record wall time and the CPU time of the thread that runs them, so
+    stages running at once on different threads are not charged with each
+    other's work; a stage that waits on worker threads does not include their
+    CPU, which their own stages (render, encode, ...) record. Model calls record latency (bucketed into a
+    histogram), tokens and payload size per call kind, and `count` keeps plain
+    counters such as retries. Snapshots from worker processes are combined with
+    `merge`. Use the module-level `metrics` registry rather than creating one per
+    component.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.calls = {}
+            self.counters = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed(self, name: str, iterable):
+        """Yield from `iterable`, recording only the time spent producing its items as one `name` stage."""
+        wall = cpu = 0.0
+        items = iter(iterable)
+        try:
+            while True:
+                started, started_cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    wall += time.perf_counter() - started
+                    cpu += time.thread_time() - started_cpu
+                yield item
+        finally:
+            self.add_stage(name, wall, cpu)
+
+    def add_stage(self, name: str, wall_seconds: float, cpu_seconds: float, count: int = 1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            stage["count"] += count
+            stage["wall_seconds"] += wall_seconds
+            stage["cpu_seconds"] += cpu_seconds
+
+    def observe_call(self, kind: str, latency: float, input_tokens: int = 0, output_tokens: int = 0,
+                     request_bytes: int = 0, cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+        with self._lock:
+            call = self._call(kind)
+            call["count"] += 1
+            call["latency_seconds"] += latency
+            call["input_tokens"] += input_tokens
+            call["output_tokens"] += output_tokens
+            call["request_bytes"] += request_bytes
+            call["cache_hits"] += 1 if cache_read_tokens else 0
+            call["cache_read_tokens"] += cache_read_tokens
+            call["cache_write_tokens"] += cache_write_tokens
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    call["latency_buckets"][i] += 1
+                    break
+
+    def _call(self, kind: str) -> dict:
+        return self.calls.setdefault(kind, {
+            "count": 0, "latency_seconds": 0.0, "input_tokens": 0, "output_tokens": 0, "request_bytes": 0,
+            "cache_hits": 0, "cache_read_tokens": 0, "cache_write_tokens": 0,
+            "latency_buckets": [0] * len(LATENCY_BUCKETS),
+        })
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps({"stages": self.stages, "calls": self.calls, "counters": self.counters}))
+
+    def merge(self, snapshot: dict):
+        for name, stage in snapshot.get("stages", {}).items():
+            self.add_stage(name, stage["wall_seconds"], stage["cpu_seconds"], stage["count"])
+        with self._lock:
+            for kind, other in snapshot.get("calls", {}).items():
+                call = self._call(kind)
+                for field in CALL_FIELDS:
+                    call[field] += other.get(field, 0)
+                call["latency_buckets"] = [a + b for a, b in zip(call["latency_buckets"], other["latency_buckets"])]
+            for name, value in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def write_json(self, path: str, **extra):
+        report = dict(extra, **self.snapshot())
+        _write_atomic(path, json.dumps(report, indent=2))
+
+    def write_prometheus(self, path: str):
+        """Write the metrics in Prometheus text format, for node_exporter's textfile collector."""
+        snap = self.snapshot()
+        lines = [
+            "# HELP bookmarker_stage_wall_seconds Wall-clock time spent in each pipeline stage.",
+            "# TYPE bookmarker_stage_wall_seconds counter",
+        ]
+        lines += [f'bookmarker_stage_wall_seconds{{stage="{name}"}} {s["wall_seconds"]:.6f}'
+                  for name, s in sorted(snap["stages"].items())]
+        lines += [
+            "# HELP bookmarker_stage_cpu_seconds CPU time of the thread running each pipeline stage.",
+            "# TYPE bookmarker_stage_cpu_seconds counter",
+        ]
+        lines += [f'bookmarker_stage_cpu_seconds{{stage="{name}"}} {s["cpu_seconds"]:.6f}'
+                  for name, s in sorted(snap["stages"].items())]
+        lines += [
+            "# HELP bookmarker_model_call_seconds Model call latency.",
+            "# TYPE bookmarker_model_call_seconds histogram",
+        ]
+        for kind, call in sorted(snap["calls"].items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, call["latency_buckets"]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'bookmarker_model_call_seconds_bucket{{kind="{kind}",le="{le}"}} {cumulative}')
+            lines.append(f'bookmarker_model_call_seconds_sum{{kind="{kind}"}} {call["latency_seconds"]:.6f}')
+            lines.append(f'bookmarker_model_call_seconds_count{{kind="{kind}"}} {call["count"]}')
+        for field, help_text in (("input_tokens", "Input tokens sent to the model."),
+                                 ("output_tokens", "Output tokens returned by the model."),
+                                 ("request_bytes", "Request payload bytes sent to the model."),
+                                 ("cache_hits", "Model calls that read part of their prompt from the provider's prompt cache."),
+                                 ("cache_read_tokens", "Input tokens read from the provider's prompt cache."),
+                                 ("cache_write_tokens", "Input tokens written to the provider's prompt cache.")):
+            lines += [f"# HELP bookmarker_model_{field}_total {help_text}",
+                      f"# TYPE bookmarker_model_{field}_total counter"]
+            lines += [f'bookmarker_model_{field}_total{{kind="{kind}"}} {call[field]}'
+                      for kind, call in sorted(snap["calls"].items())]
+        for name, value in sorted(snap["counters"].items()):
+            lines += [f"# TYPE bookmarker_{name}_total counter", f"bookmarker_{name}_total {value}"]
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+def _write_atomic(path: str, text: str):
+    # Scrapers must never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+metrics = Metrics()
@@ -2,93 +2,161 @@ import os
 import time
 from openai import OpenAI
 from typing import List
+from .cache import ResponseCache
+from .metrics import metrics, usage_tokens, payload_bytes, cache_usage
+from .prompt_cache import cache_options
+from .rate_limit import scheduler_for, http_client, estimate_tokens, api_error
+from .doc_segmenter import parse_document_starts, SEGMENTATION_GUIDE
+
+def format_messages(messages: list, system: str = None) -> list:
+    """Convert Anthropic-style messages (with a separate system prompt) to OpenAI chat messages."""
+    formatted_messages = []
+    if system:
+        formatted_messages.append({"role": "system", "content": system})
+
+    for msg in messages:
+        formatted_content = []
+        for item in msg["content"]:
+            if item["type"] == "text":
+                formatted_content.append({
+                    "type": "text",
+                    "text": item["text"]
+                })
+            elif item["type"] == "image":
+                formatted_content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{item['source']['media_type']};base64,{item['source']['data']}",
+                        "detail": "high"
+                    }
+                })
+            else:
+                # Already in OpenAI form (e.g. image_url blocks built by the transcriber)
+                formatted_content.append(item)
+        formatted_messages.append({
+            "role": msg["role"],
+            "content": formatted_content
+        })
+    return formatted_messages
 
 class OpenAIClient:
-    def __init__(self, api_key=None, max_retries=3, retry_delay=1):
+    def __init__(self, api_key=None, cache=None, scheduler=None):
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=self.api_key)
-        self.max_retries = max_retries
-        self.retry_delay = retry_delay
+        # Retries are left to the shared scheduler rather than the SDK
+        self.scheduler = scheduler or scheduler_for("openai")
+        self.client = OpenAI(api_key=self.api_key, max_retries=0, http_client=http_client("openai", self.scheduler))
+        self.cache = cache
     
     def call_model(self, model: str, messages: list, system: str, max_tokens=8000, temperature=0):
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                # Convert messages to OpenAI format
-                formatted_messages = []
-                if system:
-                    formatted_messages.append({"role": "system", "content": system})
-                
-                for msg in messages:
-                    formatted_content = []
-                    for item in msg["content"]:
-                        if item["type"] == "text":
-                            formatted_content.append({
-                                "type": "text",
-                                "text": item["text"]
-                            })
-                        elif item["type"] == "image":
-                            formatted_content.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{item['source']['data']}",
-                                    "detail": "high"
-                                }
-                            })
-                    formatted_messages.append({
-                        "role": msg["role"],
-                        "content": formatted_content
-                    })
+        formatted_messages = format_messages(messages, system)
 
-                response = self.client.chat.completions.create(
-                    model=model,
-                    messages=formatted_messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                )
-                
-                # Convert OpenAI response to Anthropic-like format for compatibility
-                return type('Response', (), {
-                    'content': [
-                        type('Content', (), {'text': response.choices[0].message.content})()
-                    ]
-                })()
-                
-            except Exception as e:
-                retries += 1
-                if retries == self.max_retries:
-                    raise Exception(f"API error after {retries} retries: {str(e)}") from e
-                print(f"API error occurred, retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay * (2 ** (retries - 1)))  # Exponential backoff
+        def send():
+            started = time.perf_counter()
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=formatted_messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **cache_options("openai", "segmentation"),
+            )
+            metrics.observe_call("segmentation", time.perf_counter() - started, *usage_tokens(response),
+                                 payload_bytes(formatted_messages), **cache_usage(response))
+            return response
 
-    def is_new_document(self, prev_image_b64: str, curr_image_b64: str) -> bool:
-        try:
-            system_prompt = """You are a document segmentation assistant. Given two consecutive pages (previous and current), determine if the current page starts a new document. 
+        response = self.scheduler.call(send, estimate_tokens(formatted_messages), "Segmentation call")
+        # Convert OpenAI response to Anthropic-like format for compatibility
+        return type('Response', (), {
+            'content': [
+                type('Content', (), {'text': response.choices[0].message.content})()
+            ]
+        })()
+
+    def segmentation_request(self, prev_image_b64: str, curr_image_b64: str, media_type: str = "image/png") -> dict:
+        """Build the pairwise boundary request: its cache key, provider request body and answer parser."""
+        system_prompt = """You are a document segmentation assistant. Given two consecutive pages (previous and current), determine if the current page starts a new document. 
 Output only 'YES' or 'NO'.
 Consider big structural changes like a new cover page, a new heading, or a drastically different layout as signs of a new doc start."""
-            
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Previous page image:"},
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": prev_image_b64}},
-                        {"type": "text", "text": "\nCurrent page image:"},
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": curr_image_b64}},
-                        {"type": "text", "text": "\nDoes the current page start a new document? Respond YES or NO."}
-                    ]
-                }
-            ]
 
-            resp = self.call_model(
-                model="gpt-4o", 
-                messages=messages,
-                system=system_prompt,
-                max_tokens=8000,
-                temperature=0
-            )
-            answer = resp.content[0].text.strip().upper()
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Previous page image:"},
+                    {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": prev_image_b64}},
+                    {"type": "text", "text": "\nCurrent page image:"},
+                    {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": curr_image_b64}},
+                    {"type": "text", "text": "\nDoes the current page start a new document? Respond YES or NO."}
+                ]
+            }
+        ]
+
+        model = "gpt-4o"
+        prompt = SEGMENTATION_GUIDE + system_prompt + "".join(item["text"] for item in messages[0]["content"] if item["type"] == "text")
+        return {
+            "key": ResponseCache.make_key("openai", model, prompt, [prev_image_b64, curr_image_b64]),
+            "body": {"model": model, "max_tokens": 8000, "system": f"{SEGMENTATION_GUIDE}\n\n{system_prompt}",
+                     "messages": messages, "temperature": 0},
+            "parse": lambda text: text.strip().upper(),
+        }
+
+    def window_request(self, images_b64: list[str], media_type: str = "image/png") -> dict:
+        """Build the windowed segmentation request; the parser rejects answers without the expected JSON."""
+        system_prompt = """You are a document segmentation assistant. Given a sequence of consecutive pages from a scanned PDF, identify every page that starts a new document.
+Consider big structural changes like a new cover page, a new heading, or a drastically different layout as signs of a new doc start.
+Page 1 may continue a document from before the window, so never report Page 1.
+Output only JSON of the form {"new_document_pages": [page numbers]}, using an empty list if no page starts a new document."""
+
+        content = []
+        for i, image_b64 in enumerate(images_b64, 1):
+            content.append({"type": "text", "text": f"Page {i}:"})
+            content.append({"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_b64}})
+        content.append({"type": "text", "text": f"\nWhich of pages 2-{len(images_b64)} start a new document? Respond with JSON only."})
+        messages = [{"role": "user", "content": content}]
+
+        def parse(text):
+            answer = text.strip()
+            parse_document_starts(answer, len(images_b64))
+            return answer
+
+        model = "gpt-4o"
+        prompt = SEGMENTATION_GUIDE + system_prompt + "".join(item["text"] for item in content if item["type"] == "text")
+        return {
+            "key": ResponseCache.make_key("openai", model, prompt, images_b64),
+            "body": {"model": model, "max_tokens": 1000, "system": f"{SEGMENTATION_GUIDE}\n\n{system_prompt}",
+                     "messages": messages, "temperature": 0},
+            "parse": parse,
+        }
+
+    def _answer(self, request: dict) -> str:
+        if self.cache is not None:
+            cached = self.cache.get(request["key"])
+            if cached is not None:
+                return cached
+        resp = self.call_model(**request["body"])
+        answer = request["parse"](resp.content[0].text)
+        if self.cache is not None:
+            self.cache.put(request["key"], answer)
+        return answer
+
+    def is_new_document(self, prev_image_b64: str, curr_image_b64: str, media_type: str = "image/png") -> bool:
+        try:
+            answer = self._answer(self.segmentation_request(prev_image_b64, curr_image_b64, media_type))
             return "YES" in answer
         except Exception as e:
+            # Let these propagate up since the scheduler already retried them
+            if api_error(e) is not None:
+                raise
             print(f"Unexpected error in is_new_document: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
+
+    def find_document_starts(self, images_b64: list[str], media_type: str = "image/png") -> list[int]:
+        """Return the 0-based positions (after the first) in a window of consecutive pages that start a new document."""
+        try:
+            answer = self._answer(self.window_request(images_b64, media_type))
+            return parse_document_starts(answer, len(images_b64))
+        except Exception as e:
+            if api_error(e) is not None:
+                raise
+            print(f"Unexpected error in find_document_starts: {str(e)}")
+            # As with is_new_document, default to no new documents in this window
+            return []
@@ -1,7 +1,97 @@
+import base64
 import tempfile
 import os
+import shutil
+import threading
+from collections import OrderedDict
+from io import BytesIO
 from PyPDF2 import PdfReader, PdfWriter
+from typing import Optional
+from PIL import Image, ImageFilter
+from pydantic import BaseModel
 import pdfplumber
+from .metrics import metrics
+
+class ImageEncoding(BaseModel):
+    """How page images are preprocessed and encoded before being sent to a model."""
+    format: str = "PNG"  # PNG, JPEG or WEBP
+    quality: int = 85  # Ignored for PNG
+    grayscale: bool = False
+    binarize: bool = False  # Pure black and white; implies grayscale
+    crop_margins: bool = False  # Trim blank margins around the page content
+    max_long_edge: Optional[int] = None  # Downscale so the longer side fits, in pixels
+    max_pixels: Optional[int] = None  # Downscale so width * height fits
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+# Sizes beyond which each provider downscales images itself, so larger uploads only cost bytes. Anthropic
+# resizes past a 1568px edge or about 1.15 megapixels; OpenAI's high detail mode fits the short side to 768px,
+# which for portrait pages is roughly 768x1024.
+PROVIDER_IMAGE_LIMITS = {
+    "anthropic": dict(max_long_edge=1568, max_pixels=1_150_000),
+    "openai": dict(max_long_edge=2048, max_pixels=768 * 1024),
+}
+
+class ImageProfile(BaseModel):
+    """Render resolution and preprocessing of page images for one pipeline stage."""
+    dpi: int = 150
+    encoding: ImageEncoding = ImageEncoding()
+
+    def for_provider(self, provider: str) -> "ImageProfile":
+        """This profile with its size limits tightened to what `provider` would downscale to anyway."""
+        limits = PROVIDER_IMAGE_LIMITS.get(provider, {})
+        update = {}
+        for field, limit in limits.items():
+            current = getattr(self.encoding, field)
+            update[field] = limit if current is None else min(current, limit)
+        return self.model_copy(update={"encoding": self.encoding.model_copy(update=update)})
+
+def crop_margins(img, threshold=235, padding=12):
+    """Crop to the page content, ignoring isolated specks of scanner noise; blank pages are left alone."""
+    gray = img.convert("L")
+    # Shrink first so the despeckle filter stays cheap on full-resolution pages
+    scale = max(max(gray.size) // 400, 1)
+    small = gray.reduce(scale) if scale > 1 else gray
+    ink = small.point(lambda p: 255 if p < threshold else 0).filter(ImageFilter.MedianFilter(3))
+    box = ink.getbbox()
+    if box is None:
+        return img
+    left, top, right, bottom = (v * scale for v in box)
+    return img.crop((max(left - padding, 0), max(top - padding, 0),
+                     min(right + padding, img.width), min(bottom + padding, img.height)))
+
+def preprocess_image(img, encoding: ImageEncoding = ImageEncoding()):
+    """Apply the cropping, resizing and color reduction of `encoding` to a PIL image."""
+    if encoding.crop_margins:
+        img = crop_margins(img)
+    scale = 1.0
+    if encoding.max_long_edge:
+        scale = min(scale, encoding.max_long_edge / max(img.size))
+    if encoding.max_pixels:
+        scale = min(scale, (encoding.max_pixels / (img.width * img.height)) ** 0.5)
+    if scale < 1.0:
+        img = img.resize((max(int(img.width * scale), 1), max(int(img.height * scale), 1)), Image.LANCZOS)
+    if encoding.binarize:
+        return img.convert("L").point(lambda p: 255 if p >= 160 else 0)
+    if encoding.grayscale:
+        return img.convert("L")
+    return img.convert("RGB") if img.mode not in ("RGB", "L") else img
+
+def encode_image(img, encoding: ImageEncoding = ImageEncoding()) -> str:
+    """Encode a PIL image as a base64 string according to `encoding`."""
+    img = preprocess_image(img, encoding)
+    buf = BytesIO()
+    if encoding.format.upper() == "PNG":
+        img.save(buf, format="PNG")
+    else:
+        img.save(buf, format=encoding.format.upper(), quality=encoding.quality)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+def resolve_image(image) -> str:
+    """A page's base64 image, given either as the string or as a callable that encodes the page on demand."""
+    return image() if callable(image) else image
 
 def extract_pages_as_images(pdf_path: str, dpi=150):
     print(f"Converting PDF {pdf_path} to images at {dpi} DPI...")
@@ -10,14 +100,156 @@ def extract_pages_as_images(pdf_path: str, dpi=150):
     print(f"Successfully converted {len(pages)} pages to images")
     return pages
 
-def add_bookmarks(original_pdf_path: str, doc_start_pages: list[int], doc_titles: list[str], output_path: str, doc_dates: list[str]):
-    # doc_start_pages, doc_titles, and doc_dates must have the same length
-    print(f"Adding bookmarks to PDF {original_pdf_path}")
-    print(f"Will add {len(doc_start_pages)} bookmarks")
-    reader = PdfReader(open(original_pdf_path, 'rb'))
+class PageSource:
+    """Renders the pages of a PDF on demand and shares them between pipeline stages.
+
+    Pages are rendered in chunks of `chunk_size` using pdf2image's
+    `first_page`/`last_page`, and only as many rendered pages as fit in
+    `memory_budget` bytes are kept; the least recently used are dropped and
+    re-rendered if needed again. With `spill_to_disk=True` rendered pages are
+    written to a temporary directory so dropped pages are reloaded from disk
+    instead of re-rendered. Use as a context manager; everything is released on
+    exit.
+
+    `encoded(i)` returns the page encoded per `encoding` as base64. Each page is
+    encoded at most once while its encoding fits in `encoded_budget` bytes, so
+    every stage that sends the page to a model reuses the same payload.
+    """
+
+    def __init__(self, pdf_path: str, dpi=150, spill_to_disk=False, chunk_size=8, memory_budget=512 * 1024 * 1024,
+                 encoding: ImageEncoding = ImageEncoding(), encoded_budget=256 * 1024 * 1024):
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.spill_to_disk = spill_to_disk
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.encoding = encoding
+        self.encoded_budget = encoded_budget
+        self.renders = 0
+        self.encodes = 0
+        self._page_count = None
+        self._images = OrderedDict()
+        self._image_bytes = 0
+        self._encoded = OrderedDict()
+        self._encoded_bytes = 0
+        self._paths = {}
+        self._tmpdir = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        if self._page_count is None:
+            from pdf2image import pdfinfo_from_path
+            self._page_count = int(pdfinfo_from_path(self.pdf_path)["Pages"])
+        return self._page_count
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"page index {index} out of range")
+        with self._lock:
+            if index in self._images:
+                self._images.move_to_end(index)
+                return self._images[index]
+            if index in self._paths:
+                img = Image.open(self._paths[index])
+                img.load()
+                self._remember(index, img)
+                return img
+            self._render_chunk(index)
+            return self._images[index]
+
+    @property
+    def media_type(self) -> str:
+        return self.encoding.media_type
+
+    def encoded(self, index: int) -> str:
+        """Base64 encoding of page `index`, shared by every stage."""
+        with self._lock:
+            if index in self._encoded:
+                self._encoded.move_to_end(index)
+                return self._encoded[index]
+        # Encode outside the lock so concurrent workers can encode different pages
+        img = self[index]
+        with metrics.stage("encode"):
+            page_b64 = encode_image(img, self.encoding)
+        metrics.count("encoded_bytes", len(page_b64))
+        with self._lock:
+            self.encodes += 1
+            if index not in self._encoded:
+                self._encoded[index] = page_b64
+                self._encoded_bytes += len(page_b64)
+                while self._encoded_bytes > self.encoded_budget and len(self._encoded) > 1:
+                    _, evicted = self._encoded.popitem(last=False)
+                    self._encoded_bytes -= len(evicted)
+        return page_b64
+
+    def _render_chunk(self, index: int):
+        # Never render more pages at once than the memory budget can hold
+        first = index + 1
+        last = min(index + self.chunk_size, len(self))
+        if self._images:
+            per_page = max(self._image_bytes // max(len(self._images), 1), 1)
+            last = min(last, first + max(self.memory_budget // per_page, 1) - 1)
+        print(f"Rendering pages {first}-{last} of {self.pdf_path} at {self.dpi} DPI...")
+        self.renders += 1
+        metrics.count("rendered_pages", last - first + 1)
+        with metrics.stage("render"):
+            self._convert(index, first, last)
+
+    def _convert(self, index: int, first: int, last: int):
+        from pdf2image import convert_from_path
+        if self.spill_to_disk:
+            if self._tmpdir is None:
+                self._tmpdir = tempfile.mkdtemp(prefix="bookmarker_pages_")
+            paths = convert_from_path(self.pdf_path, dpi=self.dpi, first_page=first, last_page=last,
+                                      output_folder=self._tmpdir, fmt="png", paths_only=True)
+            for offset, path in enumerate(paths):
+                self._paths[index + offset] = path
+            img = Image.open(self._paths[index])
+            img.load()
+            self._remember(index, img)
+        else:
+            images = convert_from_path(self.pdf_path, dpi=self.dpi, first_page=first, last_page=last)
+            # Insert the requested page last so it is the most recently used
+            for offset, img in reversed(list(enumerate(images))):
+                self._remember(index + offset, img)
+
+    def _remember(self, index: int, img):
+        self._images[index] = img
+        self._image_bytes += _image_nbytes(img)
+        while self._image_bytes > self.memory_budget and len(self._images) > 1:
+            _, evicted = self._images.popitem(last=False)
+            self._image_bytes -= _image_nbytes(evicted)
+
+    def close(self):
+        with self._lock:
+            self._images.clear()
+            self._image_bytes = 0
+            self._encoded.clear()
+            self._encoded_bytes = 0
+            self._paths = {}
+            if self._tmpdir is not None:
+                shutil.rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+
+def _image_nbytes(img) -> int:
+    return img.width * img.height * len(img.getbands())
+
+def _write_bookmarked(reader: PdfReader, doc_start_pages: list[int], doc_titles: list[str], output_path: str, doc_dates: list[str]):
     writer = PdfWriter()
     print("Copying pages to new PDF...")
-    for page_num, page in enumerate(reader.pages):
+    for page in reader.pages:
         writer.add_page(page)
     # Add bookmarks
     print("Adding bookmark entries...")
@@ -31,30 +263,83 @@ def add_bookmarks(original_pdf_path: str, doc_start_pages: list[int], doc_titles
     print(f"Writing bookmarked PDF to {output_path}")
     with open(output_path, "wb") as f:
         writer.write(f)
+
+def _write_split(reader: PdfReader, start: int, end: int, output_dir: str, title: str, doc_date: str) -> str:
+    print(f"\nProcessing document: {title}")
+    print(f"Pages {start} to {end}")
+    writer = PdfWriter()
+    for p in range(start, end+1):
+        writer.add_page(reader.pages[p])
+    # Format filename: YYYY-MM-DD - Document Title.pdf
+    # Fall back if date empty
+    date_str = doc_date if doc_date else "undated"
+    safe_title = title.replace('/', '-').replace('\\', '-').replace(':','-')
+    out_filename = f"{date_str} - {safe_title}.pdf"
+    out_path = os.path.join(output_dir, out_filename)
+    print(f"Writing document to {out_path}")
+    with open(out_path, 'wb') as f:
+        writer.write(f)
+    print(f"Successfully wrote document: {out_filename}")
+    return out_path
+
+def add_bookmarks(original_pdf_path: str, doc_start_pages: list[int], doc_titles: list[str], output_path: str, doc_dates: list[str]):
+    # doc_start_pages, doc_titles, and doc_dates must have the same length
+    print(f"Adding bookmarks to PDF {original_pdf_path}")
+    print(f"Will add {len(doc_start_pages)} bookmarks")
+    with open(original_pdf_path, 'rb') as f:
+        _write_bookmarked(PdfReader(f), doc_start_pages, doc_titles, output_path, doc_dates)
     print("Successfully added bookmarks")
 
 def split_documents(original_pdf_path: str, segments: list[tuple[int,int]], output_dir: str, doc_titles: list[str], doc_dates: list[str]):
     # segments is list of (start_page, end_page) (0-based)
     # doc_titles & doc_dates correspond to those segments
     print(f"\nSplitting PDF {original_pdf_path} into {len(segments)} documents")
-    reader = PdfReader(open(original_pdf_path, 'rb'))
-    for (start, end), title, doc_date in zip(segments, doc_titles, doc_dates):
-        print(f"\nProcessing document: {title}")
-        print(f"Pages {start} to {end}")
-        writer = PdfWriter()
-        for p in range(start, end+1):
-            writer.add_page(reader.pages[p])
-        # Format filename: YYYY-MM-DD - Document Title.pdf
-        # Fall back if date empty
-        date_str = doc_date if doc_date else "undated"
-        safe_title = title.replace('/', '-').replace('\\', '-').replace(':','-')
-        out_filename = f"{date_str} - {safe_title}.pdf"
-        out_path = os.path.join(output_dir, out_filename)
-        print(f"Writing document to {out_path}")
-        with open(out_path, 'wb') as f:
-            writer.write(f)
-        print(f"Successfully wrote document: {out_filename}")
-        yield out_path
+    with open(original_pdf_path, 'rb') as f:
+        reader = PdfReader(f)
+        for (start, end), title, doc_date in zip(segments, doc_titles, doc_dates):
+            yield _write_split(reader, start, end, output_dir, title, doc_date)
+
+class PdfOutputs:
+    """Writes per-document splits and the bookmarked copy of one source PDF.
+
+    The source is parsed once, on first use, and every output is copied from
+    that reader. A PdfReader loads pages lazily from its open file and is not
+    thread-safe, so writes from several threads take turns on it.
+    """
+
+    def __init__(self, original_pdf_path: str):
+        self.original_pdf_path = original_pdf_path
+        self._file = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _source(self) -> PdfReader:
+        if self._reader is None:
+            self._file = open(self.original_pdf_path, 'rb')
+            self._reader = PdfReader(self._file)
+        return self._reader
+
+    def split(self, start: int, end: int, output_dir: str, title: str, doc_date: str) -> str:
+        with self._lock, metrics.stage("write_split"):
+            return _write_split(self._source(), start, end, output_dir, title, doc_date)
+
+    def bookmarked(self, segments: list[tuple[int,int]], doc_titles: list[str], doc_dates: list[str], output_path: str) -> str:
+        with self._lock, metrics.stage("write_bookmarked"):
+            _write_bookmarked(self._source(), [start for start, _ in segments], doc_titles, output_path, doc_dates)
+        return output_path
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            self._reader = None
 
 def extract_pages_text(pdf_path: str) -> list[str]:
     """Extract text from each page of the PDF."""
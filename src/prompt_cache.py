@@ -0,0 +1,31 @@
+"""Provider prompt caching.
+
+Anthropic caches a request prefix (tools, then system, then messages) up to a
+block marked with `cache_control`; OpenAI caches the longest previously seen
+prefix on its own, and `prompt_cache_key` routes requests that share a prefix
+to the same cache. Either way only an identical leading part of the request is
+reused, and only once it is at least MIN_CACHEABLE_TOKENS long, so each call
+kind starts with a fixed system prompt of at least that size and puts the page
+content after it.
+"""
+
+EPHEMERAL = {"type": "ephemeral"}
+MIN_CACHEABLE_TOKENS = 1024
+
+def cache_point(provider: str) -> dict:
+    """Fields that end the cacheable prefix at the content block they are added to."""
+    return {"cache_control": EPHEMERAL} if provider == "anthropic" else {}
+
+def cached_system(system: str, *rest: str) -> list:
+    """Anthropic system blocks: `system` cached, followed by uncached `rest`."""
+    return [{"type": "text", "text": system, "cache_control": EPHEMERAL}] + [{"type": "text", "text": text} for text in rest]
+
+def system_message(provider: str, system: str) -> dict:
+    """A chat system message holding a fixed prompt, cached where the provider needs a breakpoint."""
+    if provider == "anthropic":
+        return {"role": "system", "content": cached_system(system)}
+    return {"role": "system", "content": system}
+
+def cache_options(provider: str, kind: str) -> dict:
+    """Extra create() arguments grouping requests of one kind onto the same OpenAI prompt cache."""
+    return {"prompt_cache_key": f"bookmarker-{kind}"} if provider == "openai" else {}
@@ -0,0 +1,288 @@
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import anthropic
+import openai
+
+from .metrics import metrics, usage_tokens
+
+# Rough input cost of one page image, used to charge the token bucket before the real usage is known
+IMAGE_TOKENS = 1600
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+_STATUS_ERRORS = (anthropic.APIStatusError, openai.APIStatusError)
+_CONNECTION_ERRORS = (anthropic.APIConnectionError, openai.APIConnectionError)
+# Limit headers per bucket; Anthropic sends e.g. anthropic-ratelimit-tokens-remaining, OpenAI x-ratelimit-remaining-tokens
+LIMIT_HEADERS = {
+    "requests": ("anthropic-ratelimit-requests-{}", "x-ratelimit-{}-requests"),
+    "tokens": ("anthropic-ratelimit-tokens-{}", "x-ratelimit-{}-tokens"),
+}
+# Model calls whose responses report the limits the scheduler paces; batch and file endpoints have their own
+MODEL_CALL_PATHS = ("/messages", "/chat/completions")
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def api_error(exc: BaseException):
+    """The provider API error behind `exc` (instructor and the clients wrap them), or None."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, _STATUS_ERRORS + _CONNECTION_ERRORS):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+def retry_after_seconds(headers) -> float:
+    """Seconds the provider asked us to wait (Retry-After / retry-after-ms), or None."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def reset_seconds(value: str) -> float:
+    """Seconds until a limit resets, from an RFC 3339 time (Anthropic) or a duration like "6m0s" (OpenAI), or None."""
+    try:
+        return max(datetime.fromisoformat(value).timestamp() - time.time(), 0.0)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value.strip():
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def rate_limit_headers(headers) -> dict:
+    """The limit, remaining and reset (in seconds) the provider reported for each bucket, where it sent them."""
+    limits = {}
+    for bucket, names in LIMIT_HEADERS.items():
+        state = {}
+        for field in ("limit", "remaining", "reset"):
+            value = next((headers[name.format(field)] for name in names if name.format(field) in headers), None)
+            if value is None:
+                continue
+            try:
+                state[field] = reset_seconds(value) if field == "reset" else float(value)
+            except ValueError:
+                continue
+            if state[field] is None:
+                del state[field]
+        if state:
+            limits[bucket] = state
+    return limits
+
+def estimate_tokens(messages: list, system: str = None) -> int:
+    """Approximate tokens a request will use: about four characters per token plus a flat cost per image."""
+    chars, images = len(system or ""), 0
+    for msg in messages:
+        content = msg["content"] if isinstance(msg["content"], list) else [msg["content"]]
+        for item in content:
+            if isinstance(item, dict) and item.get("type") in ("image", "image_url"):
+                images += 1
+            else:
+                chars += len(item["text"] if isinstance(item, dict) and "text" in item else json.dumps(item))
+    return chars // 4 + images * IMAGE_TOKENS
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units a minute, holding at most one minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available; requests larger than the bucket wait for a full one."""
+        self._refill(now)
+        amount = min(amount, self.per_minute)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.per_minute)
+
+    def adjust(self, amount: float):
+        """Give back (or charge) the difference between estimated and actual use."""
+        self.level = min(self.per_minute, self.level + amount)
+
+class RequestScheduler:
+    """Paces and retries every model call made through one provider account.
+
+    Calls wait for a slot in two token buckets, sized from the requests-per-minute
+    and tokens-per-minute limits (`rpm`, `tpm`, either may be None), and for a
+    concurrency slot. The provider's rate limit headers, passed to
+    `observe_headers` (see `http_client`), create a bucket that was not
+    configured from the reported limit, lower a bucket's level to what the
+    provider says remains, and pause callers until the reset when it is used up. The concurrency limit grows by one per window of successful
+    calls and halves on a 429 (AIMD), between `min_concurrency` and
+    `max_concurrency`. A 429's Retry-After pauses every caller, not just the one
+    that was refused; other retryable failures (overloaded, 5xx, timeouts,
+    connection errors) back off with full jitter. `share` scales the limits for
+    when several processes split one account.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=8, min_concurrency=1, max_retries=5, base_delay=1.0,
+                 max_delay=60.0, share=1.0):
+        self.requests = TokenBucket(rpm * share) if rpm else None
+        self.tokens = TokenBucket(tpm * share) if tpm else None
+        self.share = share
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.min_concurrency = max(min(int(min_concurrency), self.max_concurrency), 1)
+        self.concurrency = float(self.max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._rng = random.Random()
+
+    def _wait_time(self, tokens: int, now: float):
+        """Seconds until a call may start, or None to wait for a running call to finish."""
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        waits = [0.0]
+        if self.requests is not None:
+            waits.append(self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_time(tokens, now))
+        return max(waits)
+
+    def _acquire(self, tokens: int):
+        with self._condition:
+            while True:
+                wait = self._wait_time(tokens, time.monotonic())
+                if wait is not None and wait <= 0:
+                    break
+                self._condition.wait(wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+
+    def _release(self, rate_limited=False, retry_after=None):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if rate_limited:
+                # One halving per burst of 429s, however many calls were in flight when it hit
+                if now - self._last_decrease > 1.0:
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    self._last_decrease = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def _settle(self, estimated: int, response):
+        if self.tokens is None:
+            return
+        input_tokens, output_tokens = usage_tokens(response)
+        if input_tokens or output_tokens:
+            with self._condition:
+                self.tokens.adjust(estimated - input_tokens - output_tokens)
+
+    def observe_headers(self, headers):
+        """Size or correct the buckets from the rate limit headers of a provider response."""
+        limits = rate_limit_headers(headers)
+        if not limits:
+            return
+        with self._condition:
+            now = time.monotonic()
+            for name, state in limits.items():
+                bucket = getattr(self, name)
+                if bucket is None:
+                    if not state.get("limit"):
+                        continue
+                    # The limits are per account, so each process paces to its share of them
+                    bucket = TokenBucket(state["limit"] * self.share)
+                    setattr(self, name, bucket)
+                if "remaining" not in state:
+                    continue
+                bucket._refill(now)
+                bucket.level = min(bucket.level, state["remaining"] * self.share)
+                if state["remaining"] <= 0 and state.get("reset"):
+                    self.paused_until = max(self.paused_until, now + state["reset"])
+            self._condition.notify_all()
+
+    def _backoff(self, attempt: int) -> float:
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn, estimated_tokens: int = 0, description: str = "API call"):
+        """Run `fn()` under the rate limits, retrying retryable provider errors; the last error is re-raised."""
+        attempt = 0
+        while True:
+            self._acquire(estimated_tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                error = api_error(e)
+                status = getattr(error, "status_code", None)
+                retry_after = retry_after_seconds(getattr(getattr(error, "response", None), "headers", None))
+                self._release(rate_limited=status == 429, retry_after=retry_after)
+                retryable = error is not None and (status is None or status in RETRYABLE_STATUS)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                if status == 429:
+                    metrics.count("rate_limited")
+                metrics.count("retries")
+                # Honour the server's wait, with a little jitter so paused callers don't all return at once
+                delay = retry_after + self._rng.uniform(0, self.base_delay) if retry_after else self._backoff(attempt)
+                print(f"{description} failed ({status or type(error).__name__}), retrying in {delay:.1f}s "
+                      f"(attempt {attempt + 1}/{self.max_retries})...")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._release()
+            self._settle(estimated_tokens, result)
+            return result
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def scheduler_for(provider: str) -> RequestScheduler:
+    """The scheduler shared by every client of `provider` in this process."""
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            _schedulers[provider] = RequestScheduler()
+        return _schedulers[provider]
+
+def http_client(provider: str, scheduler: RequestScheduler):
+    """An SDK HTTP client that reports the rate limit headers of every model call to `scheduler`."""
+    def observe(response):
+        if response.request.url.path.endswith(MODEL_CALL_PATHS):
+            scheduler.observe_headers(response.headers)
+
+    sdk = anthropic if provider == "anthropic" else openai
+    return sdk.DefaultHttpxClient(event_hooks={"response": [observe]})
+
+def configure_scheduler(provider: str, **options) -> RequestScheduler:
+    """Replace the shared scheduler for `provider`; clients created afterwards pick it up."""
+    with _schedulers_lock:
+        _schedulers[provider] = RequestScheduler(**options)
+        return _schedulers[provider]
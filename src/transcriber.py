@@ -1,89 +1,286 @@
 from typing import List, Tuple
+import re
 import instructor
 from pydantic import BaseModel
 import os
+import threading
+import time
 from pathlib import Path
+from .batch import json_instruction, parse_json_response
+from .cache import ResponseCache
+from .concurrency import ordered_map
+from .db import assemble_markdown
+from .metrics import metrics, usage_tokens, payload_bytes, cache_usage
+from .pdf_utils import resolve_image
+from .prompt_cache import system_message, cache_options
+from .rate_limit import scheduler_for, estimate_tokens, api_error
 
 class PageTranscription(BaseModel):
     markdown_text: str
 
+# Frequent English function words; real prose has plenty of them, garbled text layers don't
+COMMON_WORDS = frozenset("""
+a an and are as at be been by for from has have in is it its may not of on or shall such that the this
+to under was were which will with any all other said upon herein thereof
+""".split())
+WORD_RE = re.compile(r"[A-Za-z]+(?:['-][A-Za-z]+)*")
+
+# Sent as the system prompt of every transcription request, image or text-only, so all of them
+# share one cacheable prefix (see prompt_cache.py); the per-page content follows in the user turn
+TRANSCRIPTION_GUIDE = """You transcribe pages of legal and regulatory documents into markdown for a document review database. Attorneys search and read these transcriptions instead of the original scans, so the transcription has to be complete and faithful: every word on the page, in reading order, with its structure shown in markdown. Respond with the transcription of the one page you are given and nothing else: no introduction, no commentary, no summary and no code fences around the result.
+
+Wording
+- Reproduce the text exactly, including spelling mistakes, unusual capitalization, abbreviations, citations and punctuation. Do not correct, modernize, translate or paraphrase anything.
+- Copy numbers, dollar amounts, percentages, dates, docket numbers, section symbols and Bates numbers character for character. Double-check digits against the page image; they matter more than anything else on the page.
+- Join words hyphenated only because they broke across a line, but keep hyphens that belong to the word.
+- Never add content that is not on the page, and never drop content because it looks repetitive or unimportant.
+
+Structure
+- Use # for the document's main title, ## for section headings and ### for subsections, following the visual hierarchy of the page rather than its font sizes alone. Do not promote ordinary bold lead-ins to headings.
+- Keep paragraphs as paragraphs separated by a blank line; do not keep the page's line breaks inside a paragraph. Keep line breaks where they carry meaning, as in addresses, signature blocks and poetry-like quoted material.
+- Reproduce numbered and lettered lists with their original markers (1., (a), i., A.) and bulleted lists with "-". Indent nested items by two spaces per level.
+- Show bold as **bold**, italics as *italics* and struck-through text as ~~struck~~. Underlined text that serves as emphasis or a heading is shown as bold.
+- Block quotations, such as quoted statutes or testimony excerpts, are marked with "> ".
+- On pleading paper and in transcripts with printed line numbers down the margin, leave the line numbers out and transcribe the text as continuous paragraphs. In question-and-answer testimony, start each question and answer on its own line with its "Q." or "A." marker.
+- Text in several columns is read one column at a time, left to right.
+
+Tables
+- Transcribe tables as markdown pipe tables with a header row and a separator row. Keep every row and column, keep empty cells empty, and keep numbers in their original format with their units and signs.
+- For merged header cells, repeat the merged label in each column it spans. If a table continues from a previous page without its headings, start it with the column headings it visibly has, or with an empty header row of the right width.
+- Forms laid out as label and value pairs are written one pair per line as "Label: value", keeping blank fields as "Label:".
+- Checkboxes are written as "[x]" when checked and "[ ]" when empty, followed by their label.
+
+Page furniture and marks
+- Running headers, footers, page numbers, Bates numbers and confidentiality legends are kept, each on its own line at the top or bottom of the transcription where they appear.
+- Footnote markers in the text become [^1], [^2] and so on, and the footnote texts are written at the end of the page as "[^1]: text".
+- Describe non-text content in square brackets where it appears: [Signature], [Initials], [Logo: company name], [Stamp: text of the stamp], [Seal], [Chart: title], [Photograph: short description], [Handwritten: the handwriting, transcribed].
+- Write [illegible] for words that cannot be read, and [REDACTED] for blacked-out or whited-out areas. Never guess at redacted or illegible text.
+- A page with no content at all is transcribed as [Blank page].
+
+Special pages
+- Case captions are transcribed line by line as they appear: the tribunal, the parties, the docket number and the title of the filing each on its own line, with the title as the # heading.
+- Email headers keep each of From, Sent, To, Cc and Subject on its own line, and quoted earlier messages in the thread keep their own header lines.
+- Spreadsheet printouts and financial schedules are tables even when their grid lines are not printed; keep subtotal and total rows where they are.
+
+The request says whether it includes the page image. With an image, the image is the authority: a text layer or OCR text supplied with it is a reference that helps with spelling and numbers, but where it disagrees with what is visibly on the page, follow the page. Without an image, the supplied text is the page: keep its wording exactly, and apply the formatting rules only where the text itself shows the structure, such as list markers, headings set on their own line or columns of figures."""
+
+class TextLayerCheck:
+    """Decides whether a page's pdfplumber text layer is clean enough to transcribe without the image.
+
+    A page qualifies when it has at least `min_chars` characters, at least
+    `min_word_ratio` of its tokens look like words, at least `min_common_ratio`
+    of its words are common English function words, and it has no unmapped
+    glyphs ("(cid:NN)") or replacement characters.
+    """
+
+    def __init__(self, min_chars=300, min_word_ratio=0.7, min_common_ratio=0.1):
+        self.min_chars = min_chars
+        self.min_word_ratio = min_word_ratio
+        self.min_common_ratio = min_common_ratio
+
+    @staticmethod
+    def score(text: str) -> dict:
+        tokens = (text or "").split()
+        words = [w.lower() for w in WORD_RE.findall(text or "")]
+        word_tokens = sum(1 for t in tokens if WORD_RE.fullmatch(t.strip(".,;:!?()[]\"'")))
+        return dict(
+            chars=len((text or "").strip()),
+            word_ratio=word_tokens / len(tokens) if tokens else 0.0,
+            common_ratio=sum(1 for w in words if w in COMMON_WORDS) / len(words) if words else 0.0,
+            garbled="(cid:" in (text or "") or "\ufffd" in (text or ""),
+        )
+
+    def is_usable(self, text: str) -> bool:
+        score = self.score(text)
+        return (score["chars"] >= self.min_chars
+                and score["word_ratio"] >= self.min_word_ratio
+                and score["common_ratio"] >= self.min_common_ratio
+                and not score["garbled"])
+
+def text_to_markdown(text: str) -> str:
+    """Local conversion of a clean text layer to markdown: paragraphs, list items and all-caps headings."""
+    blocks = []
+    paragraph = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        heading = stripped.isupper() and len(stripped) <= 80 and any(c.isalpha() for c in stripped)
+        bullet = re.match(r"^[•·▪◦*-]\s+(.*)", stripped)
+        numbered = re.match(r"^(\d+[.)]|\([a-z0-9]+\))\s+", stripped)
+        if not stripped or heading or bullet or numbered:
+            if paragraph:
+                blocks.append(" ".join(paragraph))
+                paragraph = []
+        if not stripped:
+            continue
+        if heading:
+            blocks.append(f"## {stripped}")
+        elif bullet:
+            blocks.append(f"- {bullet.group(1)}")
+        elif numbered:
+            blocks.append(stripped)
+        else:
+            paragraph.append(stripped)
+    if paragraph:
+        blocks.append(" ".join(paragraph))
+    return "\n\n".join(blocks)
+
 class DocumentTranscriber:
-    def __init__(self, model_client, provider="anthropic"):
+    def __init__(self, model_client, provider="anthropic", cache=None, max_workers=1, text_layer_check=None,
+                 text_mode="llm", scheduler=None):
         self.provider = provider
+        self.cache = cache
+        self.scheduler = scheduler or scheduler_for(provider)
+        self.max_workers = max_workers
+        # Pages whose text layer passes the check skip the image: "llm" sends a
+        # text-only prompt, "local" converts the text layer without a model call
+        self.text_layer_check = text_layer_check
+        self.text_mode = text_mode
+        # Pages are transcribed on worker threads, so the count is updated under a lock
+        self.text_pages = 0
+        self._text_pages_lock = threading.Lock()
         if provider == "anthropic":
             self.client = instructor.from_anthropic(model_client)
         else:
             self.client = instructor.patch(model_client)
 
-    def transcribe_page(self, image_b64: str, extracted_text: str) -> str:
-        """Transcribe a single page to markdown format."""
-        try:
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Please transcribe this document page exactly as it appears, preserving all formatting. 
-                            Format your response as markdown, including:
-                            - Proper headings (# for main titles, ## for subtitles, etc.)
-                            - Bold and italic text where appropriate
-                            - Lists (numbered and bulleted) as they appear
-                            - Indentation and spacing
-                            - Tables if present
-                            
-                            I'm providing both the image and OCR-extracted text to help with accuracy.
-                            Focus on creating a precise markdown representation of the document's layout and styling."""
-                        },
-                        {
-                            "type": "image_url" if self.provider == "openai" else "image",
-                            "image_url" if self.provider == "openai" else "source": {
-                                "url" if self.provider == "openai" else "type": f"data:image/png;base64,{image_b64}" if self.provider == "openai" else "base64",
-                                "detail": "high" if self.provider == "openai" else None,
-                                "media_type": "image/png" if self.provider == "anthropic" else None,
-                                "data": image_b64 if self.provider == "anthropic" else None
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": f"OCR-extracted text for reference:\n{extracted_text}"
-                        }
-                    ]
+    def page_request(self, image_b64, extracted_text: str, media_type: str = "image/png"):
+        """Build the request that transcribe_page would send, or None when the page needs no model call.
+
+        `image_b64` may be a callable (see resolve_image); it is only called when the image is sent.
+        """
+        if self.text_layer_check is not None and self.text_layer_check.is_usable(extracted_text):
+            return None if self.text_mode == "local" else self.text_request(extracted_text)
+        image_b64 = resolve_image(image_b64)
+        content = [
+            {
+                "type": "text",
+                "text": "Transcribe this document page. The OCR-extracted text after the image is for reference."
+            },
+            {
+                "type": "image_url" if self.provider == "openai" else "image",
+                "image_url" if self.provider == "openai" else "source": {
+                    "url" if self.provider == "openai" else "type": f"data:{media_type};base64,{image_b64}" if self.provider == "openai" else "base64",
+                    "detail": "high" if self.provider == "openai" else None,
+                    "media_type": media_type if self.provider == "anthropic" else None,
+                    "data": image_b64 if self.provider == "anthropic" else None
                 }
-            ]
-            
-            model = "claude-3-5-sonnet-latest" if self.provider == "anthropic" else "gpt-4o"
+            },
+            {
+                "type": "text",
+                "text": f"OCR-extracted text for reference:\n{extracted_text}"
+            }
+        ]
+        return self._request(content, [image_b64])
+
+    def text_request(self, extracted_text: str) -> dict:
+        """Build the text-only request used for pages with a usable text layer."""
+        content = [
+            {
+                "type": "text",
+                "text": "Convert this text extracted from a born-digital document page into markdown. There is no image."
+            },
+            {
+                "type": "text",
+                "text": f"Extracted text:\n{extracted_text}"
+            }
+        ]
+        return self._request(content, [])
+
+    def _request(self, content: list, images: list[str]) -> dict:
+        model = "claude-3-5-sonnet-latest" if self.provider == "anthropic" else "gpt-4o"
+        prompt = TRANSCRIPTION_GUIDE + "".join(item["text"] for item in content if item["type"] == "text")
+        messages = [system_message(self.provider, TRANSCRIPTION_GUIDE), {"role": "user", "content": content}]
+        # Batch requests can't use instructor's tool calling, so they ask for the JSON directly
+        batch_messages = [{"role": "user", "content": content + [json_instruction(PageTranscription)]}]
+        return {
+            "key": ResponseCache.make_key(self.provider, model, prompt, images),
+            "messages": messages,
+            "body": {"model": model, "max_tokens": 8000, "system": TRANSCRIPTION_GUIDE, "messages": batch_messages},
+            "parse": lambda text: parse_json_response(text, PageTranscription).markdown_text,
+        }
+
+    def _transcribe(self, request: dict) -> str:
+        if self.cache is not None:
+            cached = self.cache.get(request["key"])
+            if cached is not None:
+                return cached
+
+        def send():
+            started = time.perf_counter()
             response = self.client.chat.completions.create(
-                model=model,
+                model=request["body"]["model"],
                 max_tokens=8000,
-                messages=messages,
-                response_model=PageTranscription
+                messages=request["messages"],
+                response_model=PageTranscription,
+                **cache_options(self.provider, "transcription")
             )
-            return response.markdown_text
+            metrics.observe_call("transcription", time.perf_counter() - started, *usage_tokens(response),
+                                 payload_bytes(request["messages"]), **cache_usage(response))
+            return response
+
+        response = self.scheduler.call(send, estimate_tokens(request["messages"]), "Transcription")
+        if self.cache is not None:
+            self.cache.put(request["key"], response.markdown_text)
+        return response.markdown_text
+
+    def transcribe_page(self, image_b64, extracted_text: str, media_type: str = "image/png") -> str:
+        """Transcribe a single page to markdown format."""
+        if self.text_layer_check is not None and self.text_layer_check.is_usable(extracted_text):
+            with self._text_pages_lock:
+                self.text_pages += 1
+            metrics.count("text_layer_pages")
+            if self.text_mode == "local":
+                return text_to_markdown(extracted_text)
+            return self.transcribe_text(extracted_text)
+        try:
+            return self._transcribe(self.page_request(image_b64, extracted_text, media_type))
         except Exception as e:
+            # The scheduler already retried API errors; let them fail the PDF so it isn't marked complete
+            if api_error(e) is not None:
+                raise
             print(f"Error transcribing page: {str(e)}")
+            metrics.count("failed_pages")
             return ""
 
-    def transcribe_document(self, pages_data: List[Tuple[str, str]]) -> Tuple[str, List[str]]:
-        """Transcribe all pages of a document and return both combined and individual transcriptions."""
+    def transcribe_text(self, extracted_text: str) -> str:
+        """Transcribe a page from its text layer alone, without sending the image."""
+        try:
+            return self._transcribe(self.text_request(extracted_text))
+        except Exception as e:
+            if api_error(e) is not None:
+                raise
+            print(f"Error transcribing page text: {str(e)}")
+            metrics.count("failed_pages")
+            return ""
+
+    def transcribe_document(self, pages_data: List[Tuple[str, str]], media_type: str = "image/png",
+                            completed: dict = None, on_page=None) -> Tuple[str, List[str]]:
+        """Transcribe all pages of a document and return both combined and individual transcriptions.
+
+        Pages already in `completed` (page index -> markdown) are reused, and
+        `on_page(index, markdown)` is called for each newly transcribed page.
+        """
         print("Starting markdown transcription...")
-        transcriptions = []
-        
-        for i, (image_b64, extracted_text) in enumerate(pages_data):
+        completed = completed or {}
+
+        def transcribe(indexed_page):
+            i, (image_b64, extracted_text) = indexed_page
+            if i in completed:
+                print(f"Reusing transcription for page {i+1}/{len(pages_data)}")
+                return completed[i]
             print(f"Transcribing page {i+1}/{len(pages_data)}...")
-            page_transcription = self.transcribe_page(image_b64, extracted_text)
-            transcriptions.append(page_transcription)
-            
-        # Combine all pages with clear page markers
-        full_transcription = ""
-        for i, page_markdown in enumerate(transcriptions, 1):
-            if i > 1:  # Add extra newline before page markers (except first page)
-                full_transcription += "\n\n"
+            page_transcription = self.transcribe_page(image_b64, extracted_text, media_type)
+            # Pages with unusable answers come back empty; leave them unrecorded so a re-run retries them
+            if on_page is not None and page_transcription:
+                on_page(i, page_transcription)
+            return page_transcription
+
+        # Pages are transcribed independently; results come back in page order
+        transcriptions = ordered_map(transcribe, enumerate(pages_data), self.max_workers)
             
-            full_transcription += f"--- PDF PAGE {i} ---\n\n"
-            full_transcription += page_markdown.strip()
-            full_transcription += f"\n\n--- END OF PDF PAGE {i} ---"
-        
+        # Combine all pages with clear page markers; compressed storage rebuilds it the same way
+        full_transcription = assemble_markdown(transcriptions)
+
         print("Transcription complete")
         return full_transcription, transcriptions
 
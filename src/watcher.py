@@ -0,0 +1,137 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import shutil
+import time
+from pathlib import Path
+
+class _Inotify:
+    """Minimal inotify binding: wakes the watcher when files in a directory are written or moved in."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout: float) -> bool:
+        """Block until an event arrives or `timeout` passes; returns whether anything happened."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # The directory is rescanned anyway, so the events themselves are just drained
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    """Reports files in a directory once they have finished being written.
+
+    A file is ready when its size and modification time have not changed for
+    `settle_seconds` and it ends with a PDF end-of-file marker; a file that never
+    gets the marker is still released after `4 * settle_seconds` of quiet, so a
+    PDF with trailing bytes is not held forever. Each file is reported once until
+    `forget` is called for it.
+
+    inotify (Linux) wakes the watcher as soon as something changes; the directory
+    is still rescanned every `poll_interval` seconds, which is also the only
+    mechanism where inotify is unavailable or, as on network shares, misses
+    writes made by other machines.
+    """
+
+    def __init__(self, directory: str, pattern: str = "*.pdf", settle_seconds: float = 5.0, poll_interval: float = 2.0,
+                 use_inotify: bool = True):
+        self.directory = directory
+        self.pattern = pattern
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self._seen = {}
+        self._reported = set()
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify(directory)
+            except (OSError, AttributeError) as e:
+                print(f"inotify unavailable ({e}); polling {directory} every {poll_interval}s")
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._inotify is not None
+
+    def wait(self, timeout: float = None):
+        """Sleep until the directory changes or the next poll is due."""
+        timeout = self.poll_interval if timeout is None else timeout
+        if self._inotify is not None:
+            self._inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def ready_files(self, now: float = None) -> list[str]:
+        """Scan the directory and return files that became ready since the last call."""
+        now = time.time() if now is None else now
+        current = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name.lower(), self.pattern):
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self._seen.get(entry.path)
+            # Remember when the file last changed; a new signature restarts the clock
+            current[entry.path] = (signature, previous[1] if previous and previous[0] == signature else now)
+        self._seen = current
+        self._reported &= set(current)
+
+        ready = []
+        for path, ((size, _), stable_since) in sorted(current.items()):
+            if path in self._reported or size == 0:
+                continue
+            quiet = now - stable_since
+            if quiet >= self.settle_seconds and (_has_eof_marker(path) or quiet >= 4 * self.settle_seconds):
+                self._reported.add(path)
+                ready.append(path)
+        return ready
+
+    def forget(self, path: str):
+        self._reported.discard(path)
+        self._seen.pop(path, None)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+def _has_eof_marker(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(os.path.getsize(path) - 1024, 0))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+def move_aside(path: str, directory: str) -> str:
+    """Move a finished input file into `directory`, never overwriting an earlier file of the same name."""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    target = os.path.join(directory, os.path.basename(path))
+    if os.path.exists(target):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        target = os.path.join(directory, f"{stem}.{time.strftime('%Y%m%d-%H%M%S')}{ext}")
+    shutil.move(path, target)
+    return target
@@ -0,0 +1,176 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import anthropic
+import httpx
+from PIL import Image
+
+from src.anthropic_client import AnthropicClient
+from src.batch import BatchBackend, BatchRunner, OpenAIBatchBackend, AnthropicBatchBackend
+from src.cache import ResponseCache
+from src.doc_segmenter import segment_document, pil_to_base64
+from src.instructor_client import InstructorClient
+from src.rate_limit import RequestScheduler
+
+
+class FakeBatchBackend(BatchBackend):
+    """In-memory batch endpoint that answers each request with `answer(body)`."""
+
+    provider = "anthropic"
+
+    def __init__(self, answer, polls_until_done=1):
+        self.answer = answer
+        self.polls_until_done = polls_until_done
+        self.batches = {}
+        self.polls = 0
+
+    def submit(self, requests):
+        batch_id = f"batch_{len(self.batches)}"
+        self.batches[batch_id] = requests
+        return batch_id
+
+    def is_done(self, batch_id):
+        self.polls += 1
+        return self.polls >= self.polls_until_done
+
+    def results(self, batch_id):
+        return {r["custom_id"]: self.answer(r["body"]) for r in self.batches[batch_id]}
+
+
+class TestBatchRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(os.path.join(self.tmpdir.name, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def request(self, key, parse=str.upper):
+        return {"key": key, "body": {"model": "m", "max_tokens": 10, "messages": [{"role": "user", "content": key}]},
+                "parse": parse}
+
+    def test_results_are_parsed_into_the_cache(self):
+        backend = FakeBatchBackend(lambda body: f"answer to {body['messages'][0]['content']}", polls_until_done=3)
+        runner = BatchRunner(backend, self.cache, poll_interval=0)
+        self.assertEqual(runner.run([self.request("a"), self.request("b"), self.request("a")]), 2)
+        self.assertEqual(self.cache.get("a"), "ANSWER TO A")
+        self.assertEqual(self.cache.get("b"), "ANSWER TO B")
+
+    def test_cached_requests_are_not_resubmitted(self):
+        self.cache.put("a", "done")
+        backend = FakeBatchBackend(lambda body: "x")
+        runner = BatchRunner(backend, self.cache, poll_interval=0)
+        runner.run([self.request("a"), self.request("b"), None])
+        submitted = [r["custom_id"] for requests in backend.batches.values() for r in requests]
+        self.assertEqual(submitted, ["b"])
+        self.assertEqual(self.cache.get("a"), "done")
+
+    def test_batches_are_split_by_size(self):
+        backend = FakeBatchBackend(lambda body: "x")
+        runner = BatchRunner(backend, self.cache, poll_interval=0, max_requests=2)
+        runner.run([self.request(str(i)) for i in range(5)])
+        self.assertEqual([len(r) for r in backend.batches.values()], [2, 2, 1])
+
+    def test_unusable_answers_are_left_uncached(self):
+        def parse(text):
+            if text == "bad":
+                raise ValueError("unparseable")
+            return text
+
+        backend = FakeBatchBackend(lambda body: body["messages"][0]["content"])
+        runner = BatchRunner(backend, self.cache, poll_interval=0)
+        self.assertEqual(runner.run([self.request("good", parse), self.request("bad", parse)]), 1)
+        self.assertFalse(self.cache.contains("bad"))
+
+    def test_transient_poll_failures_are_retried(self):
+        response = httpx.Response(503, request=httpx.Request("GET", "https://api.test/v1/messages/batches/batch_0"))
+        backend = FakeBatchBackend(lambda body: "x")
+        backend.is_done = MagicMock(side_effect=[anthropic.InternalServerError("Error code: 503", response=response,
+                                                                               body=None), True])
+        runner = BatchRunner(backend, self.cache, poll_interval=0, scheduler=RequestScheduler(base_delay=0))
+        with patch('builtins.print'):
+            self.assertEqual(runner.run([self.request("a")]), 1)
+        self.assertEqual(backend.is_done.call_count, 2)
+
+    def test_backends_implement_the_interface(self):
+        with self.assertRaises(TypeError):
+            type("Incomplete", (BatchBackend,), {"submit": lambda self, requests: "id"})()
+
+    def test_requires_cache(self):
+        with self.assertRaises(ValueError):
+            BatchRunner(FakeBatchBackend(lambda body: ""), None)
+
+    def test_segmentation_uses_batched_answers(self):
+        client = AnthropicClient(api_key="test", cache=self.cache)
+        client.call_model = MagicMock(side_effect=AssertionError("interactive call in batch mode"))
+        pages = [Image.new("RGB", (40, 40), color=(i * 60, 0, 0)) for i in range(4)]
+        first_page_of_doc2 = pil_to_base64(pages[2])
+
+        def answer(body):
+            current_page = body["messages"][0]["content"][3]["source"]["data"]
+            return "YES" if current_page == first_page_of_doc2 else "NO"
+
+        runner = BatchRunner(FakeBatchBackend(answer), self.cache, poll_interval=0)
+        segments = segment_document(client, pages, batch_runner=runner)
+        self.assertEqual(segments, [(0, 1), (2, 3)])
+        self.assertEqual(runner.submitted, 3)
+
+    def test_metadata_batch_answer_matches_interactive_cache_format(self):
+        instructor_client = InstructorClient(MagicMock(), "openai", cache=self.cache)
+        request = instructor_client.metadata_request([("img", "text")], ["# Page"], "image/jpeg")
+        self.assertIn("schema", request["body"]["messages"][0]["content"][-1]["text"])
+        answer = 'Here you go: {"title": "Letter", "date": "2024-01-02", "summary": "s", "tags": ["a"]}'
+        BatchRunner(FakeBatchBackend(lambda body: answer), self.cache, poll_interval=0).run([request])
+
+        metadata = instructor_client.extract_metadata([("img", "text")], ["# Page"], "image/jpeg")
+        self.assertEqual(metadata.title, "Letter")
+        self.assertEqual(metadata.tags, ["a"])
+
+
+class TestBatchBackends(unittest.TestCase):
+
+    def test_openai_backend_uploads_chat_completion_jsonl(self):
+        client = MagicMock()
+        client.files.create.return_value.id = "file_1"
+        client.batches.create.return_value.id = "batch_1"
+        backend = OpenAIBatchBackend(client)
+        body = {"model": "gpt-4o", "max_tokens": 5, "system": "sys", "temperature": 0,
+                "messages": [{"role": "user", "content": [
+                    {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": "abc"}}]}]}
+        self.assertEqual(backend.submit([{"custom_id": "k1", "body": body}]), "batch_1")
+
+        _, upload = client.files.create.call_args.kwargs["file"]
+        line = json.loads(upload.getvalue().decode("utf-8"))
+        self.assertEqual(line["custom_id"], "k1")
+        self.assertEqual(line["url"], "/v1/chat/completions")
+        self.assertEqual(line["body"]["messages"][0], {"role": "system", "content": "sys"})
+        self.assertEqual(line["body"]["messages"][1]["content"][0]["image_url"]["url"], "data:image/jpeg;base64,abc")
+
+        client.batches.retrieve.return_value.status = "completed"
+        client.batches.retrieve.return_value.output_file_id = "file_2"
+        client.files.content.return_value.text = "\n".join([
+            json.dumps({"custom_id": "k1", "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": "NO"}}]}}}),
+            json.dumps({"custom_id": "k2", "response": {"status_code": 500, "body": {}}, "error": "boom"}),
+        ])
+        self.assertTrue(backend.is_done("batch_1"))
+        self.assertEqual(backend.results("batch_1"), {"k1": "NO"})
+
+    def test_anthropic_backend_drops_empty_fields(self):
+        client = MagicMock()
+        backend = AnthropicBatchBackend(client)
+        body = {"model": "m", "max_tokens": 5, "system": "sys", "messages": [{"role": "user", "content": [
+            {"type": "image", "source": {"type": "base64", "detail": None, "media_type": "image/png", "data": "x"}}]}]}
+        backend.submit([{"custom_id": "k1", "body": body}])
+        params = client.messages.batches.create.call_args.kwargs["requests"][0]["params"]
+        self.assertNotIn("detail", params["messages"][0]["content"][0]["source"])
+        self.assertEqual(params["system"], [{"type": "text", "text": "sys", "cache_control": {"type": "ephemeral"}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import base64
+import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO
+import unittest
+from unittest.mock import patch
+
+import pypdfium2 as pdfium
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfReader
+
+import benchmarks.run
+
+from benchmarks.fake_provider import FakeAnthropicServer
+from benchmarks.synthetic_pdf import make_synthetic_pdf, has_start_banner, BANNER_TOP, BANNER_HEIGHT
+from src.anthropic_client import AnthropicClient
+from src.instructor_client import InstructorClient
+from src.metrics import metrics
+from src.pdf_utils import PageSource, extract_pages_text, encode_image
+from src.rate_limit import RequestScheduler
+from src.transcriber import DocumentTranscriber
+
+
+def page_image(banner: bool):
+    img = Image.new("RGB", (612, 792), "white")
+    if banner:
+        ImageDraw.Draw(img).rectangle([54, BANNER_TOP, 558, BANNER_TOP + BANNER_HEIGHT], fill=0)
+    return encode_image(img)
+
+
+class PdfiumPages(PageSource):
+    """PageSource rendering with pypdfium2 (a pdfplumber dependency) where poppler isn't installed."""
+
+    # pdfium isn't thread-safe, and the pipeline renders from several threads and PageSources at once
+    _pdfium_lock = threading.Lock()
+
+    def __len__(self):
+        if self._page_count is None:
+            with self._pdfium_lock:
+                pdf = pdfium.PdfDocument(self.pdf_path)
+                self._page_count = len(pdf)
+                pdf.close()
+        return self._page_count
+
+    def _convert(self, index, first, last):
+        with self._pdfium_lock:
+            pdf = pdfium.PdfDocument(self.pdf_path)
+            images = [pdf[page].render(scale=self.dpi / 72).to_pil() for page in range(first - 1, last)]
+            pdf.close()
+        for offset, img in reversed(list(enumerate(images))):
+            self._remember(index + offset, img)
+
+
+class TestSyntheticPdf(unittest.TestCase):
+
+    def test_page_and_document_counts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "synthetic.pdf")
+            starts = make_synthetic_pdf(path, pages=9, documents=3, content="mixed", page_numbers=True)
+            self.assertEqual(len(PdfReader(path).pages), 9)
+            texts = extract_pages_text(path)
+        self.assertEqual(len(starts), 3)
+        self.assertEqual(starts[0], 0)
+        # Even documents are born-digital, odd ones scanned with no text layer
+        first_doc = range(starts[0], starts[1])
+        second_doc = range(starts[1], starts[2])
+        self.assertTrue(all("Page" in texts[p] for p in first_doc))
+        self.assertTrue(all(texts[p] == "" for p in second_doc))
+
+    def test_banner_detection(self):
+        for banner in (True, False):
+            img = Image.open(BytesIO(base64.b64decode(page_image(banner))))
+            self.assertEqual(has_start_banner(img), banner)
+
+
+class TestFakeProvider(unittest.TestCase):
+
+    def test_answers_segmentation_and_tool_requests(self):
+        server = FakeAnthropicServer()
+        client = AnthropicClient(api_key="test")
+        client.client = server.client()
+        plain, start = page_image(False), page_image(True)
+        self.assertTrue(client.is_new_document(plain, start))
+        self.assertFalse(client.is_new_document(start, plain))
+        self.assertEqual(client.find_document_starts([plain, plain, start]), [2])
+
+        metadata = InstructorClient(server.client()).extract_metadata([(plain, "text")], ["# page"])
+        self.assertEqual(metadata.date, "2024-01-01")
+        self.assertEqual(server.requests, 4)
+
+    def test_repeated_instructions_are_read_from_the_prompt_cache(self):
+        server = FakeAnthropicServer()
+        client = AnthropicClient(api_key="test")
+        client.client = server.client()
+        transcriber = DocumentTranscriber(server.client())
+        instructor_client = InstructorClient(server.client())
+        plain, start = page_image(False), page_image(True)
+        metrics.reset()
+        for _ in range(2):
+            client.is_new_document(plain, start)
+            transcriber.transcribe_page(plain, "")
+            instructor_client.extract_metadata([(plain, "text")], ["# page"])
+        calls = metrics.snapshot()["calls"]
+        # Each call kind's instructions clear the 1024-token minimum, so the second call reads them from the cache
+        for kind in ("segmentation", "transcription", "metadata"):
+            self.assertEqual(calls[kind]["cache_hits"], 1, kind)
+            self.assertGreaterEqual(calls[kind]["cache_write_tokens"], server.MIN_CACHE_TOKENS, kind)
+            self.assertEqual(calls[kind]["cache_read_tokens"], calls[kind]["cache_write_tokens"], kind)
+
+    def test_rate_limit(self):
+        server = FakeAnthropicServer(rate_limit_rpm=1)
+        client = AnthropicClient(api_key="test", scheduler=RequestScheduler(max_retries=0))
+        client.client = server.client()
+        plain = page_image(False)
+        client.is_new_document(plain, plain)
+        with self.assertRaises(Exception):
+            client.call_model("model", [{"role": "user", "content": "hi"}], "system")
+        self.assertEqual(server.rate_limited, 1)
+
+
+class TestBenchmarkRun(unittest.TestCase):
+
+    def test_smoke(self):
+        with patch('benchmarks.run.PageSource', PdfiumPages), patch('main.PageSource', PdfiumPages), \
+                patch.dict('src.rate_limit._schedulers'), patch('builtins.print'):
+            results = benchmarks.run.main(["--pages", "10", "--documents", "3", "--latency", "0", "--jitter", "0"])
+        self.addCleanup(shutil.rmtree, results["workdir"])
+        self.assertTrue(results["segmentation_correct"])
+        self.assertEqual([stage["stage"] for stage in results["stages"]],
+                         ["text_layer", "render_encode", "render_lowres", "segmentation", "extraction",
+                          "write_outputs", "db_insert", "full_pipeline"])
+        self.assertEqual(results["provider"]["errors"], 0)
+        self.assertTrue(os.path.exists(os.path.join(results["workdir"], "full", "synthetic", "synthetic_bookmarked.pdf")))
+
+
+if __name__ == '__main__':
+    unittest.main()
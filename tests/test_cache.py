@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from src.cache import ResponseCache
+from src.anthropic_client import AnthropicClient
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_depends_on_every_input(self):
+        base = ResponseCache.make_key("anthropic", "model-a", "prompt", ["img1"])
+        self.assertEqual(base, ResponseCache.make_key("anthropic", "model-a", "prompt", ["img1"]))
+        self.assertNotEqual(base, ResponseCache.make_key("openai", "model-a", "prompt", ["img1"]))
+        self.assertNotEqual(base, ResponseCache.make_key("anthropic", "model-b", "prompt", ["img1"]))
+        self.assertNotEqual(base, ResponseCache.make_key("anthropic", "model-a", "prompt2", ["img1"]))
+        self.assertNotEqual(base, ResponseCache.make_key("anthropic", "model-a", "prompt", ["img2"]))
+
+    def test_get_put_and_persistence(self):
+        cache = ResponseCache(self.path)
+        self.assertIsNone(cache.get("k"))
+        cache.put("k", "value")
+        cache.close()
+
+        reopened = ResponseCache(self.path)
+        self.assertEqual(reopened.get("k"), "value")
+        self.assertEqual(reopened.hits, 1)
+        reopened.close()
+
+    def test_lru_eviction_by_size(self):
+        cache = ResponseCache(self.path, max_bytes=20)
+        cache.put("a", "x" * 8)
+        cache.put("b", "x" * 8)
+        cache.get("a")  # "b" is now least recently used
+        cache.put("c", "x" * 8)
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        cache.close()
+
+    def test_size_is_tracked_without_rescanning(self):
+        cache = ResponseCache(self.path, max_bytes=20)
+        cache.put("a", "x" * 8)
+        statements = []
+        cache._connection().set_trace_callback(statements.append)
+        cache.put("a", "x" * 4)  # replacing an entry only counts its new size
+        cache.put("b", "x" * 8)
+        cache.put("c", "x" * 9)
+        self.assertFalse(any("SUM(" in sql for sql in statements))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertEqual(cache._total_bytes, 17)
+        cache.close()
+
+        reopened = ResponseCache(self.path, max_bytes=20)
+        reopened.get("b")
+        self.assertEqual(reopened._total_bytes, 17)
+        reopened.close()
+
+    def test_client_reuses_cached_answer(self):
+        cache = ResponseCache(self.path)
+        client = AnthropicClient(api_key="test", cache=cache)
+        response = MagicMock()
+        response.content = [MagicMock(text="YES")]
+        client.call_model = MagicMock(return_value=response)
+
+        self.assertTrue(client.is_new_document("prev", "curr"))
+        self.assertTrue(client.is_new_document("prev", "curr"))
+        self.assertEqual(client.call_model.call_count, 1)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
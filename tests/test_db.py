@@ -0,0 +1,299 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from src.db import (init_db, connect, insert_document, DocumentWriter, search_documents, get_document_tags,
+                    find_documents_by_tags, tag_facets, assemble_markdown, get_page_markdowns, get_full_text,
+                    get_markdown_transcription, compress_text_storage)
+from src.checkpoint import PipelineCheckpoint
+from src.doc_extractor import extract_document_data
+from src.instructor_client import DocumentMetadata
+from src.pdf_utils import PageSource
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "documents.db")
+        init_db(self.db_path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+def make_document(title, tags=("tag",), pages=("page one", "page two")):
+    return dict(
+        title=title,
+        date="2024-01-01",
+        summary=f"Summary of {title}",
+        original_filename=f"{title}.pdf",
+        tags=list(tags),
+        full_text="text",
+        markdown_transcription="markdown",
+        page_transcriptions=list(pages),
+    )
+
+
+class TestDocumentWriter(DatabaseTestCase):
+
+    def test_bulk_insert_in_one_transaction(self):
+        with DocumentWriter(self.db_path) as writer:
+            doc_ids = writer.insert_documents([make_document("A", tags=("x", "y")), make_document("B")])
+        self.assertEqual(len(doc_ids), 2)
+
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM document_pages").fetchone()[0], 4)
+        tags = conn.execute("SELECT tag FROM tags WHERE document_id = ? ORDER BY tag", (doc_ids[0],)).fetchall()
+        self.assertEqual([t[0] for t in tags], ["x", "y"])
+        conn.close()
+
+    def test_failed_batch_is_rolled_back(self):
+        broken = make_document("Broken")
+        del broken["full_text"]
+        with self.assertRaises(KeyError):
+            with DocumentWriter(self.db_path) as writer:
+                writer.insert_documents([make_document("A"), broken])
+
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0], 0)
+        conn.close()
+
+    def test_insert_document_wrapper(self):
+        doc_id = insert_document(self.db_path, "T", "Unknown", "S", "t.pdf", ["a"], "text", "md", ["p1"])
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT title FROM documents WHERE id = ?", (doc_id,)).fetchone()[0], "T")
+        conn.close()
+
+
+class TestFullTextSearch(DatabaseTestCase):
+
+    def test_ranked_search_with_page_hits(self):
+        with DocumentWriter(self.db_path) as writer:
+            writer.insert_documents([
+                dict(make_document("Motion to Compel", pages=("Entergy filed a motion", "unrelated")),
+                     full_text="Entergy filed a motion", markdown_transcription="Entergy filed a motion"),
+                dict(make_document("Entergy Rate Case", pages=("The Entergy RFP", "Entergy again")),
+                     full_text="The Entergy RFP Entergy again", markdown_transcription="The Entergy RFP"),
+                make_document("Other"),
+            ])
+
+        results = search_documents(self.db_path, "entergy")
+        self.assertEqual([r["title"] for r in results], ["Entergy Rate Case", "Motion to Compel"])
+        self.assertIn("[Entergy]", results[0]["snippet"])
+        self.assertEqual(sorted(p["page_number"] for p in results[0]["pages"]), [1, 2])
+        self.assertEqual([p["page_number"] for p in results[1]["pages"]], [1])
+
+        # Stemming and punctuation in user queries
+        self.assertEqual(len(search_documents(self.db_path, "motions")), 1)
+        self.assertEqual(len(search_documents(self.db_path, 'rfp"')), 1)
+        self.assertEqual(len(search_documents(self.db_path, "entergy OR rfp", raw=True)), 2)
+
+    def test_plain_database_is_readable_without_connect(self):
+        with DocumentWriter(self.db_path) as writer:
+            writer.insert_documents([dict(make_document("Motion", pages=("Entergy filed a motion",)),
+                                          full_text="Entergy filed a motion")])
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT title, full_text FROM documents_text").fetchall(),
+                         [("Motion", "Entergy filed a motion")])
+        self.assertEqual(conn.execute("""SELECT snippet(document_pages_fts, 0, '[', ']', '...', 8)
+                                         FROM document_pages_fts WHERE document_pages_fts MATCH 'entergy'""").fetchall(),
+                         [("[Entergy] filed a motion",)])
+        conn.close()
+
+    def test_existing_rows_are_indexed_on_upgrade(self):
+        conn = connect(self.db_path)
+        conn.execute("DROP TABLE documents_fts")
+        conn.execute("DROP TABLE document_pages_fts")
+        conn.execute("INSERT INTO documents (id, title, full_text) VALUES (1, 'Legacy', 'legacy text')")
+        conn.execute("INSERT INTO document_pages (document_id, page_number, markdown_text) VALUES (1, 1, 'legacy page')")
+        conn.commit()
+        conn.close()
+        init_db(self.db_path)
+        results = search_documents(self.db_path, "legacy")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0]["pages"]), 1)
+
+
+def paged_document(title, pages, page_texts):
+    return dict(make_document(title, pages=pages), full_text="\n\n".join(page_texts),
+                markdown_transcription=assemble_markdown(pages), page_texts=list(page_texts))
+
+
+class TestCompressedStorage(DatabaseTestCase):
+
+    def stored(self, sql, *params):
+        conn = connect(self.db_path)
+        rows = conn.execute(sql, params).fetchall()
+        conn.close()
+        return rows
+
+    def test_document_text_is_rebuilt_from_pages(self):
+        init_db(self.db_path, text_storage="compressed")
+        doc = paged_document("Entergy Filing", ("# Entergy filed\n\nA motion", "Page two"),
+                             ("Entergy filed\n\nA motion", "page two"))
+        with DocumentWriter(self.db_path) as writer:
+            doc_id = writer.insert_documents([doc])[0]
+
+        self.assertEqual(self.stored("""SELECT full_text, markdown_transcription, full_text_zlib, markdown_zlib
+                                        FROM documents"""), [(None, None, None, None)])
+        self.assertEqual(self.stored("SELECT COUNT(*) FROM document_pages WHERE markdown_text IS NULL"), [(2,)])
+        self.assertEqual(get_page_markdowns(self.db_path, doc_id), list(doc["page_transcriptions"]))
+        self.assertEqual(get_full_text(self.db_path, doc_id), doc["full_text"])
+        self.assertEqual(get_markdown_transcription(self.db_path, doc_id), doc["markdown_transcription"])
+        results = search_documents(self.db_path, "entergy")
+        self.assertIn("[Entergy]", results[0]["snippet"])
+        self.assertEqual([p["page_number"] for p in results[0]["pages"]], [1])
+
+    def test_existing_database_is_migrated(self):
+        with DocumentWriter(self.db_path) as writer:
+            source_id, copy_id, legacy_id = writer.insert_documents([
+                paged_document("Exhibit", ("Exhibit A", "Schedule"), ("exhibit a", "schedule")),
+                dict(paged_document("Exhibit copy", ("Exhibit A", "Cover"), ("exhibit a", "cover")), page_texts=None),
+                make_document("Legacy", pages=("old page",)),
+            ])
+        conn = connect(self.db_path)
+        conn.execute("""UPDATE document_pages SET duplicate_of = (SELECT id FROM document_pages
+                        WHERE document_id = ? AND page_number = 1) WHERE document_id = ? AND page_number = 1""",
+                     (source_id, copy_id))
+        conn.commit()
+        conn.close()
+        before = {doc_id: (get_full_text(self.db_path, doc_id), get_markdown_transcription(self.db_path, doc_id),
+                           get_page_markdowns(self.db_path, doc_id)) for doc_id in (source_id, copy_id, legacy_id)}
+
+        with patch('builtins.print'):
+            self.assertEqual(compress_text_storage(self.db_path, batch_size=2), 3)
+        self.assertEqual(self.stored("""SELECT COUNT(*) FROM documents
+                                        WHERE full_text IS NOT NULL OR markdown_transcription IS NOT NULL"""), [(0,)])
+        # The copied page points at its source. Plain storage kept no page text layers, so full_text stays
+        # (compressed) on every document, and so does markdown that doesn't match the pages
+        self.assertEqual(self.stored("SELECT COUNT(*) FROM document_pages WHERE markdown_zlib IS NULL"), [(1,)])
+        self.assertEqual(self.stored("SELECT full_text_zlib IS NOT NULL, markdown_zlib IS NOT NULL FROM documents ORDER BY id"),
+                         [(1, 0), (1, 0), (1, 1)])
+        for doc_id, text in before.items():
+            self.assertEqual((get_full_text(self.db_path, doc_id), get_markdown_transcription(self.db_path, doc_id),
+                              get_page_markdowns(self.db_path, doc_id)), text)
+        self.assertEqual(len(search_documents(self.db_path, "exhibit")), 2)
+
+        # Reading compressed text takes the functions connect() registers, even with the mode set back
+        plain = sqlite3.connect(self.db_path)
+        with self.assertRaises(sqlite3.OperationalError):
+            plain.execute("SELECT full_text FROM documents_text").fetchall()
+        plain.close()
+        init_db(self.db_path, text_storage="plain")
+        self.assertEqual(get_page_markdowns(self.db_path, copy_id), before[copy_id][2])
+        init_db(self.db_path, text_storage="compressed")
+
+        # Later documents go straight into compressed storage
+        insert_document(self.db_path, "New", "2024-01-01", "", "new.pdf", [], "text", "markdown", ["page"])
+        self.assertEqual(self.stored("SELECT markdown_text FROM document_pages WHERE document_id = 4"), [(None,)])
+
+
+class TestTags(DatabaseTestCase):
+
+    def test_tags_are_folded_and_faceted(self):
+        with DocumentWriter(self.db_path) as writer:
+            a, b, c = writer.insert_documents([
+                make_document("A", tags=("Rate Case", "Motion")),
+                make_document("B", tags=("rate  case", "RFP", "RFP")),
+                make_document("C", tags=(" RATE CASE ", "Motion", "")),
+            ])
+
+        self.assertEqual(get_document_tags(self.db_path, b), ["Rate Case", "RFP"])
+        self.assertEqual(find_documents_by_tags(self.db_path, ["rate case"]), [a, b, c])
+        self.assertEqual(find_documents_by_tags(self.db_path, ["rate case", "MOTION"]), [a, c])
+        self.assertEqual(tag_facets(self.db_path), [("Rate Case", 3), ("Motion", 2), ("RFP", 1)])
+        self.assertEqual(tag_facets(self.db_path, ["motion"]), [("Rate Case", 2)])
+
+    def test_legacy_tags_table_is_migrated(self):
+        conn = connect(self.db_path)
+        conn.execute("DROP VIEW tags")
+        conn.execute("CREATE TABLE tags (id INTEGER PRIMARY KEY AUTOINCREMENT, document_id INTEGER, tag TEXT)")
+        conn.execute("INSERT INTO documents (id, title) VALUES (7, 'Old')")
+        conn.executemany("INSERT INTO tags (document_id, tag) VALUES (?,?)", [(7, "Exhibit"), (7, "exhibit "), (7, "Order")])
+        conn.commit()
+        conn.close()
+
+        init_db(self.db_path)
+        self.assertEqual(get_document_tags(self.db_path, 7), ["Exhibit", "Order"])
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT type FROM sqlite_master WHERE name='tags'").fetchone()[0], "view")
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM tags WHERE document_id = 7").fetchone()[0], 2)
+        conn.close()
+
+
+class TestPipelineCheckpoint(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pdf_path = os.path.join(self.tmpdir.name, "input.pdf")
+        with open(self.pdf_path, "wb") as f:
+            f.write(b"%PDF-1.4 fake content")
+
+    def test_stages_are_keyed_by_content_hash(self):
+        checkpoint = PipelineCheckpoint(self.db_path, self.pdf_path)
+        self.assertIsNone(checkpoint.get("segments"))
+        checkpoint.save("segments", [[0, 1], [2, 2]])
+        checkpoint.save("transcription", "page zero", 0)
+        checkpoint.save("transcription", "page two", 2)
+
+        # Same content under another name resumes the same run
+        renamed = os.path.join(self.tmpdir.name, "renamed.pdf")
+        os.rename(self.pdf_path, renamed)
+        resumed = PipelineCheckpoint(self.db_path, renamed)
+        self.assertEqual(resumed.get("segments"), [[0, 1], [2, 2]])
+        self.assertEqual(resumed.get_all("transcription"), {"0": "page zero", "2": "page two"})
+        self.assertFalse(resumed.is_complete())
+        resumed.mark_complete()
+        self.assertTrue(PipelineCheckpoint(self.db_path, renamed).is_complete())
+
+    def test_extraction_resumes_from_checkpoint(self):
+        checkpoint = PipelineCheckpoint(self.db_path, self.pdf_path)
+        checkpoint.save("transcription", "saved page 0", 0)
+        checkpoint.save("metadata", DocumentMetadata(title="Saved", date="2020-01-01", summary="s", tags=[]).model_dump(), "0-1")
+
+        pages = MagicMock(spec=PageSource)
+        pages.media_type = "image/png"
+        pages.encoded.side_effect = lambda i: f"b64-{i}"
+        transcriber = MagicMock()
+        transcriber.transcribe_document.side_effect = lambda pages_data, media_type, completed, on_page: (
+            "full", [completed.get(j) or on_page(j, f"new page {j}") or f"new page {j}" for j in range(len(pages_data))]
+        )
+        instructor_client = MagicMock()
+        instructor_client.extract_metadata.return_value = DocumentMetadata(title="New", date="Unknown", summary="s", tags=[])
+
+        result = extract_document_data(instructor_client, transcriber, self.pdf_path, [(0, 1), (2, 2)],
+                                       self.tmpdir.name, pages, ["t0", "t1", "t2"], checkpoint)
+
+        self.assertEqual([doc[0].title for doc in result], ["Saved", "New"])
+        self.assertEqual(result[0][3], ["saved page 0", "new page 1"])
+        self.assertEqual(instructor_client.extract_metadata.call_count, 1)
+        self.assertEqual(checkpoint.get_all("transcription"),
+                         {"0": "saved page 0", "1": "new page 1", "2": "new page 0"})
+        self.assertEqual(checkpoint.get("metadata", "2-2")["title"], "New")
+
+    def test_document_results_follow_their_pages(self):
+        checkpoint = PipelineCheckpoint(self.db_path, self.pdf_path)
+        checkpoint.save("metadata", DocumentMetadata(title="Saved", date="2020-01-01", summary="s", tags=[]).model_dump(), "0-1")
+
+        pages = MagicMock(spec=PageSource)
+        pages.media_type = "image/png"
+        pages.encoded.side_effect = lambda i: f"b64-{i}"
+        transcriber = MagicMock()
+        transcriber.transcribe_document.side_effect = lambda pages_data, media_type, completed, on_page: (
+            "full", [f"page {j}" for j in range(len(pages_data))])
+        instructor_client = MagicMock()
+        instructor_client.extract_metadata.return_value = DocumentMetadata(title="New", date="Unknown", summary="s", tags=[])
+
+        # Segmented differently this time: the saved metadata belongs to neither document
+        result = extract_document_data(instructor_client, transcriber, self.pdf_path, [(0, 0), (1, 2)],
+                                       self.tmpdir.name, pages, ["t0", "t1", "t2"], checkpoint)
+        self.assertEqual([doc[0].title for doc in result], ["New", "New"])
+        self.assertEqual(sorted(checkpoint.get_all("metadata")), ["0-0", "0-1", "1-2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from PIL import Image, ImageDraw, ImageFont
+
+from src.db import init_db, connect, DocumentWriter
+from src.dedup import (DuplicateIndex, page_fingerprint, text_signature, text_similarity, hash_distance, image_hash,
+                       ink_difference)
+from src.doc_extractor import extract_single_document
+from src.instructor_client import DocumentMetadata
+
+WORDS = ("rate case exhibit schedule docket commission filing testimony witness order "
+         "customer generation capacity transmission contract").split()
+
+
+def page_text(seed, words=200):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def page_image(seed, noise=0):
+    rng = random.Random(seed)
+    img = Image.new("RGB", (320, 420), "white")
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(20, 260), rng.randrange(20, 380)
+        draw.rectangle((x, y, x + rng.randrange(10, 50), y + 6), fill="black")
+    # Scanner noise: a few stray specks
+    specks = random.Random(seed + 1000 + noise)
+    for _ in range(noise):
+        img.putpixel((specks.randrange(320), specks.randrange(420)), (0, 0, 0))
+    return img
+
+
+def scan_image(seed, noise=0):
+    """A scanned page with no text layer: a letterhead bar above justified lines of different words."""
+    rng = random.Random(seed)
+    font = ImageFont.load_default(size=20)
+    img = Image.new("RGB", (850, 1100), (250, 248, 244))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((60, 50, 790, 110), fill=(30, 30, 30))
+    for y in range(160, 1020, 30):
+        line = ""
+        while draw.textlength(line + " transmission", font=font) < 720:
+            line += " " + rng.choice(WORDS)
+        draw.text((70, y), line.strip(), fill=(20, 20, 20), font=font)
+    specks = random.Random(seed + 1000 + noise)
+    for _ in range(noise):
+        img.putpixel((specks.randrange(850), specks.randrange(1100)), (0, 0, 0))
+    return img
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_near_copies_are_close(self):
+        original = page_fingerprint(page_image(1), page_text(1))
+        copy = page_fingerprint(page_image(1, noise=20), page_text(1))
+        other = page_fingerprint(page_image(2), page_text(2))
+        self.assertLessEqual(hash_distance(original["image_hash"], copy["image_hash"]), 12)
+        self.assertGreater(hash_distance(original["image_hash"], other["image_hash"]), 12)
+        self.assertEqual(text_similarity(original["text_signature"], copy["text_signature"]), 1.0)
+        self.assertLess(text_similarity(original["text_signature"], other["text_signature"]), 0.5)
+        self.assertEqual(len(image_hash(page_image(1))), 32)
+
+    def test_pages_without_text(self):
+        self.assertIsNone(text_signature("  \n"))
+        self.assertIsNotNone(text_signature("Exhibit A"))
+        self.assertIsNone(page_fingerprint(page_image(1), page_text(1))["ink_mask"])
+        original = page_fingerprint(scan_image(1), "")["ink_mask"]
+        self.assertLess(ink_difference(original, page_fingerprint(scan_image(1, noise=300), "")["ink_mask"]), 0.12)
+        self.assertLess(ink_difference(original, page_fingerprint(scan_image(1).resize((425, 550)), "")["ink_mask"]), 0.12)
+        self.assertGreater(ink_difference(original, page_fingerprint(scan_image(2), "")["ink_mask"]), 0.12)
+
+
+class TestDuplicateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "documents.db")
+        init_db(self.db_path)
+        self.index = DuplicateIndex(self.db_path)
+        images = [page_image(1), page_image(2)]
+        texts = [page_text(1), page_text(2)]
+        match = self.index.match(images, texts, (0, 1))
+        self.assertEqual(match.transcriptions(), {})
+        with DocumentWriter(self.db_path) as writer:
+            self.source_id = writer.insert_documents([dict(
+                title="Cover sheet", date="2024-01-01", summary="A cover sheet", original_filename="a.pdf",
+                tags=["Exhibit"], full_text="\n\n".join(texts), markdown_transcription="markdown",
+                page_transcriptions=["# Page one", "# Page two"], page_fingerprints=match.fingerprints,
+            )])[0]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_repeated_document_reuses_stored_results(self):
+        images = [page_image(9), page_image(1, noise=15), page_image(2, noise=15)]
+        texts = [page_text(9), page_text(1), page_text(2)]
+        match = self.index.match(images, texts, (1, 2))
+        self.assertEqual(match.transcriptions(), {0: "# Page one", 1: "# Page two"})
+        self.assertEqual(match.document, (self.source_id, dict(title="Cover sheet", date="2024-01-01",
+                                                               summary="A cover sheet", tags=["Exhibit"])))
+
+        partial = self.index.match(images, texts, (0, 1))
+        self.assertEqual(partial.transcriptions(), {1: "# Page one"})
+        self.assertIsNone(partial.document)
+
+    def test_text_must_match_too(self):
+        match = self.index.match([page_image(1)], [page_text(5)], (0, 0))
+        self.assertEqual(match.transcriptions(), {})
+        match = self.index.match([page_image(1)], [""], (0, 0))
+        self.assertEqual(match.transcriptions(), {})
+
+    def test_extraction_skips_model_calls_and_links_rows(self):
+        images = [page_image(1, noise=5), page_image(2, noise=5)]
+        texts = [page_text(1), page_text(2)]
+        match = self.index.match(images, texts, (0, 1))
+        pages = MagicMock()
+        pages.media_type = "image/png"
+        transcriber = MagicMock()
+        transcriber.transcribe_document.side_effect = lambda data, media, completed, on_page: (
+            "markdown", [completed[j] for j in range(len(data))])
+        instructor_client = MagicMock()
+
+        metadata, _, _, page_markdowns = extract_single_document(instructor_client, transcriber, pages, texts, (0, 1),
+                                                                 self.tmpdir.name, duplicate=match)
+        self.assertEqual(metadata, DocumentMetadata(title="Cover sheet", date="2024-01-01", summary="A cover sheet",
+                                                    tags=["Exhibit"]))
+        self.assertEqual(page_markdowns, ["# Page one", "# Page two"])
+        instructor_client.extract_metadata.assert_not_called()
+        pages.encoded.assert_not_called()
+
+        with DocumentWriter(self.db_path) as writer:
+            copy_id = writer.insert_documents([dict(
+                title=metadata.title, date=metadata.date, summary=metadata.summary, original_filename="b.pdf",
+                tags=metadata.tags, full_text="text", markdown_transcription="markdown", page_transcriptions=page_markdowns,
+                duplicate_of=match.document[0], page_duplicates=match.page_links(), page_fingerprints=match.fingerprints,
+            )])[0]
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT duplicate_of FROM documents WHERE id = ?", (copy_id,)).fetchone()[0],
+                         self.source_id)
+        links = conn.execute(
+            """SELECT c.duplicate_of = s.id FROM document_pages c JOIN document_pages s
+               ON s.document_id = ? AND s.page_number = c.page_number WHERE c.document_id = ?""",
+            (self.source_id, copy_id)).fetchall()
+        self.assertEqual(links, [(1,), (1,)])
+        # Only the originals are indexed, so later copies keep linking to them
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM page_fingerprints").fetchone()[0], 2)
+        conn.close()
+
+
+class TestScannedDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "documents.db")
+        init_db(self.db_path)
+        # Scans sharing a layout can hash identically (rendered through pdfium they often do), so
+        # let every page through the hash check and leave telling them apart to the ink masks
+        self.index = DuplicateIndex(self.db_path, max_image_distance=256)
+        match = self.index.match([scan_image(1)], [""], (0, 0))
+        with DocumentWriter(self.db_path) as writer:
+            writer.insert_documents([dict(
+                title="Letter", date="2024-01-01", summary="A letter", original_filename="scan.pdf", tags=[],
+                full_text="", markdown_transcription="# Letter", page_transcriptions=["# Letter"],
+                page_fingerprints=match.fingerprints,
+            )])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_different_scans_are_not_reused(self):
+        for seed in (2, 3, 4):
+            self.assertEqual(self.index.match([scan_image(seed)], [""], (0, 0)).transcriptions(), {})
+
+    def test_rescanned_page_is_reused(self):
+        self.assertEqual(self.index.match([scan_image(1, noise=300)], [""], (0, 0)).transcriptions(), {0: "# Letter"})
+        self.assertEqual(self.index.match([scan_image(1).resize((425, 550))], [""], (0, 0)).transcriptions(),
+                         {0: "# Letter"})
+
+    def test_stored_scans_without_a_mask_never_match(self):
+        conn = connect(self.db_path)
+        conn.execute("UPDATE page_fingerprints SET ink_mask = NULL")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.index.match([scan_image(1)], [""], (0, 0)).transcriptions(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock, patch
 from PIL import Image
-from src.doc_extractor import extract_document_data
-from src.instructor_client import DocumentMetadata
+from src.doc_extractor import extract_document_data, extract_single_document
+from src.instructor_client import DocumentMetadata, InstructorClient, select_text_pages, METADATA_PROMPT
+from src.pdf_utils import PageSource, ImageEncoding, encode_image, resolve_image
+from src.transcriber import DocumentTranscriber, TextLayerCheck
 
 class TestDocumentExtractor(unittest.TestCase):
 
@@ -13,10 +16,20 @@ class TestDocumentExtractor(unittest.TestCase):
             img = Image.new('RGB', (100, 100), color='white')
             self.images.append(img)
         self.segments = [(0,1), (2,2)]  # Two documents: pages [0-1], and page [2]
+        self.texts = ["text 0", "text 1", "text 2"]
 
-    @patch('src.doc_extractor.base64.b64encode', return_value=b'fake_b64')
-    def test_extract_document_data(self, mock_b64encode):
+        # Page source backed by the in-memory images
+        self.pages = MagicMock(spec=PageSource)
+        self.pages.media_type = "image/jpeg"
+        self.pages.encoded.side_effect = lambda i: f"b64-{i}"
+
+    def test_extract_document_data(self):
         mock_instructor_client = MagicMock()
+        mock_transcriber = MagicMock()
+        mock_transcriber.transcribe_document.side_effect = [
+            ("full md 1", ["md 0", "md 1"]),
+            ("full md 2", ["md 2"]),
+        ]
 
         # We expect `extract_metadata` to be called twice (once per doc segment)
         # Return a fake DocumentMetadata object for each call
@@ -34,15 +47,92 @@ class TestDocumentExtractor(unittest.TestCase):
         )
         mock_instructor_client.extract_metadata.side_effect = [fake_meta_1, fake_meta_2]
 
-        result = extract_document_data(mock_instructor_client, self.images, self.segments)
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = extract_document_data(mock_instructor_client, mock_transcriber, "doc.pdf", self.segments,
+                                           output_dir, self.pages, self.texts)
         
         self.assertEqual(len(result), 2)
-        self.assertEqual(result[0].title, "Doc1 Title")
-        self.assertEqual(result[1].title, "Doc2 Title")
+        self.assertEqual(result[0][0].title, "Doc1 Title")
+        self.assertEqual(result[1][0].title, "Doc2 Title")
+        self.assertEqual(result[0][1], "text 0\n\ntext 1")
 
         # Check that the client was called twice (once per segment)
         self.assertEqual(mock_instructor_client.extract_metadata.call_count, 2)
 
+        # Pages are sent using the shared encoding and its media type
+        pages_data, page_markdowns, media_type, mode = mock_instructor_client.extract_metadata.call_args_list[0].args
+        self.assertEqual([(resolve_image(image), text) for image, text in pages_data],
+                         [("b64-0", "text 0"), ("b64-1", "text 1")])
+        self.assertEqual(media_type, "image/jpeg")
+        self.assertEqual(mode, "images")
+
+    def test_only_pages_sent_as_images_are_encoded(self):
+        prose = "The commission shall consider the filing and the testimony of each witness in this docket. " * 5
+        transcriber = DocumentTranscriber(MagicMock(), "openai", text_layer_check=TextLayerCheck(), text_mode="local")
+        transcriber.client = MagicMock()
+        transcriber.client.chat.completions.create.return_value = MagicMock(markdown_text="# Scanned")
+        instructor_client = InstructorClient(MagicMock(), "openai")
+        instructor_client.client = MagicMock()
+        instructor_client.client.chat.completions.create.return_value = DocumentMetadata(
+            title="Order", date="2024-03-01", summary="An order.", tags=[])
+
+        with tempfile.TemporaryDirectory() as output_dir, patch('builtins.print'):
+            metadata, _, _, page_markdowns = extract_single_document(
+                instructor_client, transcriber, self.pages, [prose, "", prose], (0, 2), output_dir, metadata_mode="text")
+        self.assertEqual(metadata.title, "Order")
+        self.assertEqual(page_markdowns[1], "# Scanned")
+        # Only the page without a text layer was transcribed from its image
+        self.pages.encoded.assert_called_once_with(1)
+
+    def test_encode_image_formats(self):
+        img = self.images[0]
+        self.assertTrue(encode_image(img).startswith("iVBOR"))  # PNG signature
+        self.assertTrue(encode_image(img, ImageEncoding(format="JPEG")).startswith("/9j/"))
+        self.assertEqual(ImageEncoding(format="WEBP").media_type, "image/webp")
+
+
+class TestTextMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.client = InstructorClient(MagicMock(), "openai")
+        self.client.client = MagicMock()
+        self.pages_data = [("b64-0", "layer 0"), ("b64-1", "layer 1")]
+
+    @staticmethod
+    def image_count(call):
+        return sum(1 for item in call.kwargs["messages"][-1]["content"] if item["type"] == "image_url")
+
+    def test_long_documents_keep_first_and_last_pages(self):
+        texts = [f"page {i} " + "x" * 1000 for i in range(20)]
+        selected = select_text_pages(texts, max_chars=9000, head_pages=3, tail_pages=2)
+        self.assertEqual([i for i, _ in selected], [0, 1, 2, 18, 19])
+        self.assertTrue(all(len(text) <= 1800 for _, text in selected))
+        self.assertEqual(len(select_text_pages(texts[:5], max_chars=9000)), 5)
+
+    def test_text_mode_sends_no_images(self):
+        good = DocumentMetadata(title="Motion", date="2024-03-01", summary="A motion.", tags=["motion"])
+        self.client.client.chat.completions.create.return_value = good
+        metadata = self.client.extract_metadata(self.pages_data, ["# Motion", ""], mode="text")
+        self.assertEqual(metadata, good)
+        call = self.client.client.chat.completions.create.call_args
+        self.assertEqual(self.image_count(call), 0)
+        prompt = "".join(item["text"] for item in call.kwargs["messages"][-1]["content"])
+        self.assertIn("# Motion", prompt)
+        self.assertIn("layer 1", prompt)  # blank transcription falls back to the text layer
+        # The fixed instructions lead, and OpenAI is asked to keep metadata requests on one prompt cache
+        self.assertEqual(call.kwargs["messages"][0], {"role": "system", "content": METADATA_PROMPT})
+        self.assertEqual(call.kwargs["prompt_cache_key"], "bookmarker-metadata")
+
+    def test_implausible_text_answer_falls_back_to_images(self):
+        bad = DocumentMetadata(title="Motion", date="March 2024", summary="A motion.", tags=[])
+        good = DocumentMetadata(title="Motion", date="2024-03-01", summary="A motion.", tags=[])
+        self.client.client.chat.completions.create.side_effect = [bad, good]
+        with patch('builtins.print'):
+            metadata = self.client.extract_metadata(self.pages_data, ["# Motion", "body"], mode="text")
+        self.assertEqual(metadata, good)
+        first, second = self.client.client.chat.completions.create.call_args_list
+        self.assertEqual((self.image_count(first), self.image_count(second)), (0, 2))
+
 
 if __name__ == '__main__':
     unittest.main()
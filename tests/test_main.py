@@ -0,0 +1,40 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+import os
+import tempfile
+from pathlib import Path
+from main import main
+
+class TestIntegration(unittest.TestCase):
+
+    def test_main_processes_pdfs_in_worker_pool(self):
+        def fake_process_single_pdf(pdf_path, *args, **kwargs):
+            if "bad" in pdf_path:
+                raise RuntimeError("broken pdf")
+            return 2
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                Path("input_dir").mkdir()
+                for name in ("a.pdf", "b.pdf", "bad.pdf"):
+                    Path("input_dir", name).write_bytes(b"%PDF-1.4")
+                env = {"MODEL_PROVIDER": "anthropic", "PDF_WORKERS": "2"}
+                # Patches don't reach child processes under the spawn start method, so the pool's
+                # initializer and tasks run on threads here; they are the same functions and arguments
+                with patch.dict(os.environ, env), \
+                        patch('main.ProcessPoolExecutor', ThreadPoolExecutor), \
+                        patch('main.process_single_pdf', side_effect=fake_process_single_pdf), \
+                        patch('main.create_clients', return_value=(MagicMock(), MagicMock(), MagicMock())), \
+                        patch('builtins.print') as mock_print:
+                    main()
+            finally:
+                os.chdir(cwd)
+        printed = [" ".join(str(a) for a in call.args) for call in mock_print.call_args_list]
+        self.assertIn("Found total of 4 documents", printed)
+        self.assertTrue(any("Error processing" in line and "bad.pdf" in line for line in printed))
+
+if __name__ == '__main__':
+    unittest.main()
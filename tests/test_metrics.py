@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from src.metrics import Metrics, usage_tokens, payload_bytes, cache_usage
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stage_records_wall_and_cpu_time(self):
+        m = Metrics()
+        with m.stage("render"):
+            sum(i * i for i in range(10000))
+        with m.stage("render"):
+            pass
+        stage = m.snapshot()["stages"]["render"]
+        self.assertEqual(stage["count"], 2)
+        self.assertGreater(stage["wall_seconds"], 0)
+        self.assertGreaterEqual(stage["cpu_seconds"], 0)
+
+    def test_stage_cpu_is_the_stage_threads_own(self):
+        m = Metrics()
+        busy = threading.Thread(target=lambda: sum(i * i for i in range(3000000)))
+        with m.stage("segmentation"):
+            busy.start()
+            busy.join()
+        stage = m.snapshot()["stages"]["segmentation"]
+        self.assertLess(stage["cpu_seconds"], stage["wall_seconds"] / 2)
+
+    def test_timed_only_counts_producing_items(self):
+        m = Metrics()
+
+        def produce():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+
+        for _ in m.timed("segmentation", produce()):
+            time.sleep(0.05)
+        stage = m.snapshot()["stages"]["segmentation"]
+        self.assertEqual(stage["count"], 1)
+        self.assertGreaterEqual(stage["wall_seconds"], 0.03)
+        self.assertLess(stage["wall_seconds"], 0.1)
+
+    def test_calls_are_bucketed_and_merged(self):
+        m = Metrics()
+        m.observe_call("transcription", 0.3, 100, 20, 5000)
+        m.observe_call("transcription", 45, 200, 40, 6000)
+        m.count("retries")
+
+        worker = Metrics()
+        worker.observe_call("transcription", 0.05, 1, 2, 3)
+        worker.count("retries", 2)
+        m.merge(worker.snapshot())
+
+        call = m.snapshot()["calls"]["transcription"]
+        self.assertEqual(call["count"], 3)
+        self.assertEqual(call["input_tokens"], 301)
+        self.assertEqual(call["output_tokens"], 62)
+        self.assertEqual(call["request_bytes"], 11003)
+        self.assertEqual(call["latency_buckets"][0], 1)   # <= 0.1s
+        self.assertEqual(call["latency_buckets"][2], 1)   # <= 0.5s
+        self.assertEqual(call["latency_buckets"][8], 1)   # <= 60s
+        self.assertEqual(m.snapshot()["counters"]["retries"], 3)
+
+    def test_usage_from_either_provider(self):
+        anthropic_resp = SimpleNamespace(usage=SimpleNamespace(input_tokens=10, output_tokens=3))
+        openai_resp = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=7, completion_tokens=2))
+        structured = SimpleNamespace(_raw_response=anthropic_resp)
+        self.assertEqual(usage_tokens(anthropic_resp), (10, 3))
+        self.assertEqual(usage_tokens(openai_resp), (7, 2))
+        self.assertEqual(usage_tokens(structured), (10, 3))
+        self.assertEqual(usage_tokens(object()), (0, 0))
+        self.assertEqual(payload_bytes([{"a": 1}], "sys"), len('[{"a": 1}]') + 3)
+
+    def test_prompt_cache_usage(self):
+        anthropic_resp = SimpleNamespace(usage=SimpleNamespace(input_tokens=10, output_tokens=3,
+                                                               cache_read_input_tokens=2000, cache_creation_input_tokens=0))
+        openai_resp = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=7, completion_tokens=2,
+                                                            prompt_tokens_details=SimpleNamespace(cached_tokens=1024)))
+        self.assertEqual(cache_usage(anthropic_resp), dict(cache_read_tokens=2000, cache_write_tokens=0))
+        self.assertEqual(cache_usage(openai_resp), dict(cache_read_tokens=1024, cache_write_tokens=0))
+        self.assertEqual(cache_usage(object()), dict(cache_read_tokens=0, cache_write_tokens=0))
+
+        m = Metrics()
+        m.observe_call("segmentation", 0.2, 10, 1, 100, **cache_usage(anthropic_resp))
+        m.observe_call("segmentation", 0.2, 10, 1, 100, cache_write_tokens=1500)
+        call = m.snapshot()["calls"]["segmentation"]
+        self.assertEqual((call["cache_hits"], call["cache_read_tokens"], call["cache_write_tokens"]), (1, 2000, 1500))
+
+    def test_exports(self):
+        m = Metrics()
+        with m.stage("db_insert"):
+            pass
+        m.observe_call("metadata", 1.5, 10, 5, 100)
+        m.count("retries")
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "report.json")
+            prom_path = os.path.join(tmp, "bookmarker.prom")
+            m.write_json(json_path, documents=3)
+            m.write_prometheus(prom_path)
+            with open(json_path) as f:
+                report = json.load(f)
+            with open(prom_path) as f:
+                prom = f.read()
+            self.assertEqual(sorted(os.listdir(tmp)), ["bookmarker.prom", "report.json"])
+        self.assertEqual(report["documents"], 3)
+        self.assertEqual(report["calls"]["metadata"]["input_tokens"], 10)
+        self.assertIn('bookmarker_model_call_seconds_bucket{kind="metadata",le="2.5"} 1', prom)
+        self.assertIn('bookmarker_model_call_seconds_bucket{kind="metadata",le="+Inf"} 1', prom)
+        self.assertIn('bookmarker_model_call_seconds_count{kind="metadata"} 1', prom)
+        self.assertIn('bookmarker_stage_wall_seconds{stage="db_insert"}', prom)
+        self.assertIn("bookmarker_retries_total 1", prom)
+
+
+if __name__ == '__main__':
+    unittest.main()
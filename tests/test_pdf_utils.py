@@ -0,0 +1,148 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from PIL import Image
+
+from PyPDF2 import PdfReader
+from src.pdf_utils import PageSource, ImageEncoding, ImageProfile, PdfOutputs, preprocess_image
+
+PAGE_COUNT = 10
+
+
+def fake_convert_from_path(pdf_path, dpi=150, output_folder=None, first_page=None, last_page=None,
+                           fmt="ppm", paths_only=False, **kwargs):
+    first_page = first_page or 1
+    last_page = last_page or PAGE_COUNT
+    images = [Image.new('RGB', (40, 60), color=(p, 0, 0)) for p in range(first_page, last_page + 1)]
+    if not paths_only:
+        return images
+    paths = []
+    for page, img in zip(range(first_page, last_page + 1), images):
+        path = os.path.join(output_folder, f"page-{page}.{fmt}")
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+@patch('pdf2image.pdfinfo_from_path', return_value={"Pages": PAGE_COUNT})
+@patch('pdf2image.convert_from_path', side_effect=fake_convert_from_path)
+class TestPageSource(unittest.TestCase):
+
+    def test_renders_in_chunks(self, mock_convert, mock_info):
+        with PageSource("doc.pdf", chunk_size=4) as pages:
+            self.assertEqual(len(pages), PAGE_COUNT)
+            colors = [img.getpixel((0, 0))[0] for img in pages]
+        self.assertEqual(colors, list(range(1, PAGE_COUNT + 1)))
+        self.assertEqual(mock_convert.call_count, 3)
+        first_call = mock_convert.call_args_list[0]
+        self.assertEqual((first_call.kwargs["first_page"], first_call.kwargs["last_page"]), (1, 4))
+
+    def test_shares_rendered_pages(self, mock_convert, mock_info):
+        with PageSource("doc.pdf", chunk_size=4) as pages:
+            first = pages[0]
+            self.assertIs(first, pages[0])
+            pages[1]
+        self.assertEqual(mock_convert.call_count, 1)
+
+    def test_memory_budget_bounds_held_pages(self, mock_convert, mock_info):
+        page_bytes = 40 * 60 * 3
+        with PageSource("doc.pdf", chunk_size=4, memory_budget=3 * page_bytes) as pages:
+            for img in pages:
+                self.assertLessEqual(pages._image_bytes, 3 * page_bytes)
+            self.assertEqual(pages[PAGE_COUNT - 1].getpixel((0, 0))[0], PAGE_COUNT)
+
+    def test_each_page_encoded_once(self, mock_convert, mock_info):
+        encoding = ImageEncoding(format="JPEG", quality=70, grayscale=True)
+        with PageSource("doc.pdf", encoding=encoding) as pages:
+            first = pages.encoded(0)
+            self.assertEqual(pages.encoded(0), first)
+            pages.encoded(1)
+            self.assertEqual(pages.encodes, 2)
+            self.assertEqual(pages.media_type, "image/jpeg")
+
+    def test_renders_at_profile_dpi(self, mock_convert, mock_info):
+        profile = ImageProfile(dpi=72, encoding=ImageEncoding(format="JPEG", grayscale=True))
+        with PageSource("doc.pdf", dpi=profile.dpi, encoding=profile.encoding) as pages:
+            pages.encoded(0)
+        self.assertEqual(mock_convert.call_args.kwargs["dpi"], 72)
+
+    def test_spill_to_disk_cleans_up(self, mock_convert, mock_info):
+        with PageSource("doc.pdf", spill_to_disk=True, chunk_size=4, memory_budget=1) as pages:
+            self.assertEqual(pages[0].getpixel((0, 0)), (1, 0, 0))
+            self.assertEqual(pages[1].getpixel((0, 0)), (2, 0, 0))
+            self.assertEqual(pages[0].getpixel((0, 0)), (1, 0, 0))
+            tmpdir = pages._tmpdir
+            self.assertTrue(os.path.isdir(tmpdir))
+        self.assertEqual(mock_convert.call_count, 1)
+        self.assertFalse(os.path.exists(tmpdir))
+
+
+class TestImageProfiles(unittest.TestCase):
+
+    def test_crop_margins_ignores_specks(self):
+        img = Image.new('RGB', (400, 500), color="white")
+        img.paste((0, 0, 0), (100, 150, 300, 350))
+        img.putpixel((5, 5), (0, 0, 0))
+        cropped = preprocess_image(img, ImageEncoding(crop_margins=True))
+        self.assertLess(cropped.width, 240)
+        self.assertLess(cropped.height, 240)
+        blank = Image.new('RGB', (400, 500), color="white")
+        self.assertEqual(preprocess_image(blank, ImageEncoding(crop_margins=True)).size, (400, 500))
+
+    def test_binarize_and_resize(self):
+        img = Image.new('RGB', (2000, 1000), color=(200, 200, 200))
+        img.paste((100, 100, 100), (0, 0, 1000, 1000))
+        out = preprocess_image(img, ImageEncoding(binarize=True, max_long_edge=500))
+        self.assertEqual(out.size, (500, 250))
+        self.assertEqual(out.mode, "L")
+        self.assertEqual({c for _, c in out.getcolors()}, {0, 255})
+
+    def test_provider_limits_apply_unless_tighter(self):
+        profile = ImageProfile().for_provider("anthropic")
+        self.assertEqual(profile.encoding.max_long_edge, 1568)
+        img = Image.new('RGB', (1275, 1650))
+        width, height = preprocess_image(img, profile.encoding).size
+        self.assertLessEqual(width * height, 1_150_000)
+        tight = ImageProfile(encoding=ImageEncoding(max_long_edge=800)).for_provider("anthropic")
+        self.assertEqual(tight.encoding.max_long_edge, 800)
+        self.assertIsNone(ImageProfile().for_provider("other").encoding.max_pixels)
+
+
+class TestPdfOutputs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmpdir.name, "source.pdf")
+        images = [Image.new('RGB', (60, 80), color=(i * 40, 0, 0)) for i in range(5)]
+        images[0].save(self.pdf_path, "PDF", save_all=True, append_images=images[1:])
+        self.segments = [(0, 1), (2, 2), (3, 4)]
+        self.titles = ["First", "Second: Part/2", "Third"]
+        self.dates = ["2024-01-01", "", "Unknown"]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_outputs_share_one_parse_across_threads(self):
+        out_dir = self.tmpdir.name
+        bookmarked = os.path.join(out_dir, "bookmarked.pdf")
+        with patch('src.pdf_utils.PdfReader', wraps=PdfReader) as reader_class, PdfOutputs(self.pdf_path) as outputs:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                paths = list(executor.map(outputs.split, [s for s, _ in self.segments], [e for _, e in self.segments],
+                                          [out_dir] * 3, self.titles, self.dates))
+            outputs.bookmarked(self.segments, self.titles, self.dates, bookmarked)
+        self.assertEqual(reader_class.call_count, 1)
+
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ["2024-01-01 - First.pdf", "undated - Second- Part-2.pdf", "Unknown - Third.pdf"])
+        self.assertEqual([len(PdfReader(p).pages) for p in paths], [2, 1, 2])
+        reader = PdfReader(bookmarked)
+        self.assertEqual(len(reader.pages), 5)
+        self.assertEqual([item.title for item in reader.outline],
+                         ["2024-01-01 - First", "undated - Second: Part/2", "Unknown - Third"])
+        self.assertEqual([reader.get_destination_page_number(item) for item in reader.outline], [0, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
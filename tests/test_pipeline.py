@@ -0,0 +1,139 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import httpx
+from anthropic import Anthropic
+from PIL import Image
+
+from benchmarks.fake_provider import FakeAnthropicServer
+from benchmarks.synthetic_pdf import make_synthetic_pdf
+from main import process_single_pdf
+from src.checkpoint import PipelineCheckpoint
+from src.db import init_db, connect, DocumentWriter
+from src.instructor_client import InstructorClient
+from src.pdf_utils import PageSource
+from src.rate_limit import RequestScheduler, api_error
+
+
+class FakePages(PageSource):
+    """Stands in for PageSource without poppler; each page's "encoding" names its index."""
+
+    media_type = "image/png"
+
+    def __init__(self, count):
+        self.count = count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return Image.new("RGB", (10, 10), "white")
+
+    def encoded(self, index):
+        return f"page-{index}"
+
+
+class FakeSegmenter:
+    """Finds the given document starts; before answering about the last page it waits for a stored document."""
+
+    def __init__(self, starts, last_page, stored):
+        self.starts = starts
+        self.last_page = last_page
+        self.stored = stored
+        self.overlapped = None
+
+    def is_new_document(self, prev_image_b64, curr_image_b64, media_type="image/png"):
+        page = int(curr_image_b64.split("-")[1])
+        if page == self.last_page:
+            self.overlapped = self.stored.wait(10)
+        return page in self.starts
+
+
+class TestOverlappedPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmpdir.name, "batch.pdf")
+        self.starts = make_synthetic_pdf(self.pdf_path, pages=8, documents=3, content="text")
+        self.db_path = os.path.join(self.tmpdir.name, "documents.db")
+        self.output_dir = os.path.join(self.tmpdir.name, "out")
+        os.makedirs(self.output_dir)
+        init_db(self.db_path)
+        server = FakeAnthropicServer()
+        self.model_client = server.client()
+        self.instructor_client = InstructorClient(self.model_client)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_pipeline(self, segmenter, model_client=None):
+        with patch('main.PageSource', return_value=FakePages(8)), patch('builtins.print'):
+            return process_single_pdf(self.pdf_path, self.output_dir, self.db_path, segmenter, self.instructor_client,
+                                      model_client or self.model_client, "anthropic", document_workers=2)
+
+    def test_documents_are_stored_while_segmentation_continues(self):
+        stored = threading.Event()
+        insert_documents = DocumentWriter.insert_documents
+
+        def recording_insert(writer, documents, commit=True):
+            ids = insert_documents(writer, documents, commit)
+            stored.set()
+            return ids
+
+        writers = []
+        writer_init = DocumentWriter.__init__
+
+        def recording_init(writer, *args, **kwargs):
+            writers.append(writer)
+            writer_init(writer, *args, **kwargs)
+
+        segmenter = FakeSegmenter(set(self.starts[1:]), 7, stored)
+        with patch.object(DocumentWriter, "insert_documents", recording_insert), \
+                patch.object(DocumentWriter, "__init__", recording_init):
+            self.assertEqual(self.run_pipeline(segmenter), 3)
+        self.assertTrue(segmenter.overlapped)
+        # The documents share one writer, across the worker threads
+        self.assertEqual(len(writers), 1)
+
+        conn = connect(self.db_path)
+        filenames = [row[0] for row in conn.execute("SELECT original_filename FROM documents")]
+        conn.close()
+        self.assertEqual(len(filenames), 3)
+        outputs = os.listdir(os.path.join(self.output_dir, "batch"))
+        self.assertIn("batch_bookmarked.pdf", outputs)
+        self.assertTrue(set(filenames) <= set(outputs))
+
+        checkpoint = PipelineCheckpoint(self.db_path, self.pdf_path)
+        self.assertTrue(checkpoint.is_complete())
+        self.assertEqual([tuple(s) for s in checkpoint.get("segments")],
+                         list(zip(self.starts, [s - 1 for s in self.starts[1:]] + [7])))
+        self.assertEqual(sorted(checkpoint.get_all("db")), [f"{s[0]}-{s[1]}" for s in checkpoint.get("segments")])
+
+    def test_exhausted_rate_limits_leave_the_pdf_incomplete(self):
+        stored = threading.Event()
+        stored.set()
+        rate_limited = Anthropic(api_key="test", max_retries=0, http_client=httpx.Client(transport=httpx.MockTransport(
+            lambda request: httpx.Response(429, json={"type": "error", "error": {
+                "type": "rate_limit_error", "message": "Rate limited"}}))))
+        with patch.dict('src.rate_limit._schedulers', {"anthropic": RequestScheduler(max_retries=1, base_delay=0)}):
+            with self.assertRaises(Exception) as raised:
+                self.run_pipeline(FakeSegmenter(set(self.starts[1:]), 7, stored), rate_limited)
+        self.assertEqual(api_error(raised.exception).status_code, 429)
+
+        self.assertFalse(PipelineCheckpoint(self.db_path, self.pdf_path).is_complete())
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0], 0)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import time
+import unittest
+from datetime import datetime, timezone
+from email.utils import formatdate
+from unittest.mock import MagicMock, patch
+
+import anthropic
+import httpx
+
+from src.metrics import metrics
+from src.rate_limit import (RequestScheduler, TokenBucket, retry_after_seconds, api_error, estimate_tokens,
+                            rate_limit_headers, http_client)
+from src.transcriber import DocumentTranscriber, PageTranscription
+
+
+def api_status_error(status, headers=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.test/v1/messages"))
+    error_class = anthropic.RateLimitError if status == 429 else anthropic.APIStatusError
+    return error_class(f"Error code: {status}", response=response, body=None)
+
+
+class TestRetryAfter(unittest.TestCase):
+
+    def test_header_forms(self):
+        self.assertEqual(retry_after_seconds({"retry-after": "2.5"}), 2.5)
+        self.assertEqual(retry_after_seconds({"retry-after-ms": "250", "retry-after": "9"}), 0.25)
+        self.assertAlmostEqual(retry_after_seconds({"retry-after": formatdate(time.time() + 30, usegmt=True)}), 30, delta=2)
+        self.assertIsNone(retry_after_seconds({}))
+        self.assertIsNone(retry_after_seconds(None))
+
+    def test_limit_header_forms(self):
+        reset = datetime.fromtimestamp(time.time() + 30, timezone.utc).isoformat().replace("+00:00", "Z")
+        limits = rate_limit_headers({"anthropic-ratelimit-requests-limit": "50",
+                                     "anthropic-ratelimit-requests-remaining": "49",
+                                     "anthropic-ratelimit-requests-reset": reset})
+        self.assertEqual(limits["requests"]["limit"], 50)
+        self.assertEqual(limits["requests"]["remaining"], 49)
+        self.assertAlmostEqual(limits["requests"]["reset"], 30, delta=2)
+        limits = rate_limit_headers({"x-ratelimit-limit-tokens": "30000", "x-ratelimit-remaining-tokens": "29000",
+                                     "x-ratelimit-reset-tokens": "1m30.5s"})
+        self.assertEqual(limits, {"tokens": {"limit": 30000, "remaining": 29000, "reset": 90.5}})
+        self.assertEqual(rate_limit_headers({"x-ratelimit-reset-requests": "soon"}), {})
+
+    def test_wrapped_errors_are_found(self):
+        error = api_status_error(429)
+        try:
+            try:
+                raise error
+            except Exception as e:
+                raise RuntimeError("Max retries exceeded") from e
+        except RuntimeError as wrapped:
+            self.assertIs(api_error(wrapped), error)
+        self.assertIsNone(api_error(ValueError("bad json")))
+
+    def test_estimate_counts_images(self):
+        messages = [{"role": "user", "content": [{"type": "text", "text": "x" * 400},
+                                                  {"type": "image", "source": {}}]}]
+        self.assertEqual(estimate_tokens(messages, "y" * 40), 110 + 1600)
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_rate_limit_pauses_and_halves_concurrency(self):
+        scheduler = RequestScheduler(max_concurrency=8, base_delay=0.01)
+        fn = MagicMock(side_effect=[api_status_error(429, {"retry-after": "0.2"}), "ok"])
+        started = time.monotonic()
+        with patch('builtins.print'):
+            self.assertEqual(scheduler.call(fn), "ok")
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(fn.call_count, 2)
+        self.assertLess(scheduler.concurrency, 5)
+        self.assertEqual(metrics.snapshot()["counters"]["rate_limited"], 1)
+
+    def test_concurrency_recovers_additively(self):
+        scheduler = RequestScheduler(max_concurrency=8)
+        scheduler.concurrency = 2.0
+        for _ in range(4):
+            scheduler.call(lambda: None)
+        self.assertGreater(scheduler.concurrency, 3)
+        self.assertLess(scheduler.concurrency, 4)
+
+    def test_client_errors_are_not_retried(self):
+        scheduler = RequestScheduler(base_delay=0)
+        fn = MagicMock(side_effect=api_status_error(400))
+        with self.assertRaises(anthropic.APIStatusError):
+            scheduler.call(fn)
+        fn = MagicMock(side_effect=ValueError("unparseable"))
+        with self.assertRaises(ValueError):
+            scheduler.call(fn)
+        self.assertEqual(fn.call_count, 1)
+        self.assertEqual(scheduler.in_flight, 0)
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = RequestScheduler(max_retries=2, base_delay=0)
+        fn = MagicMock(side_effect=api_status_error(529))
+        with patch('builtins.print'), self.assertRaises(anthropic.APIStatusError):
+            scheduler.call(fn)
+        self.assertEqual(fn.call_count, 3)
+
+    def test_token_bucket_paces_requests(self):
+        bucket = TokenBucket(60)
+        now = time.monotonic()
+        self.assertEqual(bucket.wait_time(60, now), 0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 1.0, places=2)
+        self.assertAlmostEqual(bucket.wait_time(1, now + 0.5), 0.5, places=2)
+        bucket.adjust(30)
+        self.assertEqual(bucket.wait_time(10, now + 0.5), 0)
+
+
+class TestLimitHeaders(unittest.TestCase):
+
+    def test_first_response_sizes_missing_buckets(self):
+        scheduler = RequestScheduler(share=0.5)
+        scheduler.observe_headers({"anthropic-ratelimit-requests-limit": "50",
+                                   "anthropic-ratelimit-requests-remaining": "10",
+                                   "anthropic-ratelimit-tokens-limit": "40000"})
+        self.assertEqual(scheduler.requests.per_minute, 25)
+        self.assertEqual(scheduler.requests.level, 5)
+        self.assertEqual(scheduler.tokens.per_minute, 20000)
+        self.assertEqual(scheduler.tokens.level, 20000)
+
+    def test_remaining_corrects_configured_buckets(self):
+        scheduler = RequestScheduler(rpm=100, tpm=10000)
+        scheduler.observe_headers({"x-ratelimit-limit-tokens": "90000", "x-ratelimit-remaining-tokens": "4000",
+                                   "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "0.3s"})
+        # The configured limits are kept; only the levels drop to what the account has left
+        self.assertEqual(scheduler.tokens.per_minute, 10000)
+        self.assertEqual(scheduler.tokens.level, 4000)
+        self.assertEqual(scheduler.requests.level, 0)
+        self.assertGreater(scheduler.paused_until, time.monotonic() + 0.2)
+
+    def test_sdk_client_reports_model_call_headers(self):
+        scheduler = RequestScheduler()
+        [observe] = http_client("anthropic", scheduler).event_hooks["response"]
+        headers = {"anthropic-ratelimit-requests-limit": "60", "anthropic-ratelimit-requests-remaining": "59"}
+        observe(httpx.Response(200, headers=headers, request=httpx.Request("POST", "https://api.test/v1/messages/batches")))
+        self.assertIsNone(scheduler.requests)
+        observe(httpx.Response(200, headers=headers, request=httpx.Request("POST", "https://api.test/v1/messages")))
+        self.assertEqual(scheduler.requests.per_minute, 60)
+        self.assertEqual(scheduler.requests.level, 59)
+
+
+class TestTranscriberRetries(unittest.TestCase):
+
+    def test_transient_failures_are_retried(self):
+        scheduler = RequestScheduler(base_delay=0)
+        transcriber = DocumentTranscriber(MagicMock(), "openai", scheduler=scheduler)
+        transcriber.client = MagicMock()
+        transcriber.client.chat.completions.create.side_effect = [
+            api_status_error(503), PageTranscription(markdown_text="# Page")]
+        with patch('builtins.print'):
+            self.assertEqual(transcriber.transcribe_page("b64", "text"), "# Page")
+        self.assertEqual(transcriber.client.chat.completions.create.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+
+from src.metrics import metrics
+from src.transcriber import DocumentTranscriber, TextLayerCheck, text_to_markdown, TRANSCRIPTION_GUIDE
+
+CLEAN_TEXT = """MOTION TO COMPEL
+Plaintiff moves the Court for an order compelling the production of documents. The defendant
+has failed to respond to the requests that were served on it in January, and the time for such
+a response has passed. It is therefore requested that the motion be granted in all respects and
+that the defendant be ordered to respond within ten days of the order."""
+
+
+class TestTextLayerFastPath(unittest.TestCase):
+
+    def setUp(self):
+        with patch('src.transcriber.instructor'):
+            self.transcriber = DocumentTranscriber(MagicMock(), text_layer_check=TextLayerCheck())
+        self.create = self.transcriber.client.chat.completions.create
+        self.create.return_value = MagicMock(markdown_text="# transcribed")
+
+    def test_quality_check(self):
+        check = TextLayerCheck()
+        self.assertTrue(check.is_usable(CLEAN_TEXT))
+        self.assertFalse(check.is_usable(""))
+        self.assertFalse(check.is_usable("Exhibit A"))
+        self.assertFalse(check.is_usable(CLEAN_TEXT + " (cid:12)(cid:7)"))
+        self.assertFalse(check.is_usable("x7$ 9#k qz1 %%2 " * 40))
+
+    def test_clean_text_layer_is_sent_without_image(self):
+        self.assertEqual(self.transcriber.transcribe_page("image-b64", CLEAN_TEXT), "# transcribed")
+        content = self.create.call_args.kwargs["messages"][-1]["content"]
+        self.assertTrue(all(item["type"] == "text" for item in content))
+        self.assertEqual(self.transcriber.text_pages, 1)
+
+    def test_poor_text_layer_falls_back_to_image(self):
+        self.transcriber.transcribe_page("image-b64", "scanned")
+        content = self.create.call_args.kwargs["messages"][-1]["content"]
+        self.assertIn("image", [item["type"] for item in content])
+        self.assertEqual(self.transcriber.text_pages, 0)
+
+    def test_text_pages_are_counted_across_workers(self):
+        metrics.reset()
+        self.transcriber.text_mode = "local"
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: self.transcriber.transcribe_page("image-b64", CLEAN_TEXT), range(200)))
+        self.assertEqual(self.transcriber.text_pages, 200)
+        self.assertEqual(metrics.snapshot()["counters"]["text_layer_pages"], 200)
+
+    def test_instructions_are_a_shared_cached_prefix(self):
+        self.transcriber.transcribe_page("image-b64", CLEAN_TEXT)
+        self.transcriber.transcribe_page("image-b64", "scanned")
+        (text_call, image_call) = self.create.call_args_list
+        system = text_call.kwargs["messages"][0]
+        self.assertEqual(system, image_call.kwargs["messages"][0])
+        self.assertEqual(system["content"], [{"type": "text", "text": TRANSCRIPTION_GUIDE,
+                                              "cache_control": {"type": "ephemeral"}}])
+
+    def test_local_mode_makes_no_model_call(self):
+        self.transcriber.text_mode = "local"
+        markdown = self.transcriber.transcribe_page("image-b64", CLEAN_TEXT)
+        self.create.assert_not_called()
+        self.assertTrue(markdown.startswith("## MOTION TO COMPEL\n\nPlaintiff moves"))
+
+    def test_text_to_markdown_lists(self):
+        self.assertEqual(text_to_markdown("Intro line\n• first\n2. second"), "Intro line\n\n- first\n\n2. second")
+
+
+if __name__ == '__main__':
+    unittest.main()
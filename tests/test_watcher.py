@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+from main import watch
+from src.watcher import FolderWatcher, move_aside
+
+PDF_BYTES = b"%PDF-1.4\n1 0 obj\n<<>>\nendobj\ntrailer\n<<>>\n%%EOF\n"
+
+
+class TestFolderWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+        self.watcher = FolderWatcher(self.dir, settle_seconds=5, use_inotify=False)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmpdir.cleanup()
+
+    def test_files_are_ready_once_unchanged_for_settle_time(self):
+        path = os.path.join(self.dir, "scan.pdf")
+        Path(path).write_bytes(PDF_BYTES[:10])
+        self.assertEqual(self.watcher.ready_files(now=100), [])
+        # Still being written: the growing file restarts the clock
+        Path(path).write_bytes(PDF_BYTES[:20])
+        self.assertEqual(self.watcher.ready_files(now=104), [])
+        Path(path).write_bytes(PDF_BYTES)
+        self.assertEqual(self.watcher.ready_files(now=106), [])
+        self.assertEqual(self.watcher.ready_files(now=110), [])
+        self.assertEqual(self.watcher.ready_files(now=111), [path])
+        # Reported only once
+        self.assertEqual(self.watcher.ready_files(now=120), [])
+
+    def test_file_without_eof_marker_waits_longer(self):
+        path = os.path.join(self.dir, "odd.PDF")
+        Path(path).write_bytes(b"%PDF-1.4 no trailer")
+        Path(self.dir, "notes.txt").write_text("ignored")
+        self.watcher.ready_files(now=0)
+        self.assertEqual(self.watcher.ready_files(now=10), [])
+        self.assertEqual(self.watcher.ready_files(now=20), [path])
+
+    def test_inotify_wakes_on_new_file(self):
+        watcher = FolderWatcher(self.dir, poll_interval=5)
+        try:
+            if not watcher.uses_inotify:
+                self.skipTest("inotify not available")
+            Path(self.dir, "new.pdf").write_bytes(PDF_BYTES)
+            self.assertTrue(watcher._inotify.wait(1))
+        finally:
+            watcher.close()
+
+    def test_move_aside_keeps_earlier_files(self):
+        done = os.path.join(self.dir, "done")
+        for _ in range(2):
+            Path(self.dir, "a.pdf").write_bytes(PDF_BYTES)
+            move_aside(os.path.join(self.dir, "a.pdf"), done)
+        self.assertEqual(len(os.listdir(done)), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "a.pdf")))
+
+
+class TestWatchMode(unittest.TestCase):
+
+    def test_processes_and_moves_files(self):
+        def fake_process_single_pdf(pdf_path, *args, **kwargs):
+            if "bad" in pdf_path:
+                raise RuntimeError("broken pdf")
+            return 3
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                Path("input_dir").mkdir()
+                for name in ("a.pdf", "bad.pdf"):
+                    Path("input_dir", name).write_bytes(PDF_BYTES)
+                env = {"MODEL_PROVIDER": "anthropic", "PDF_WORKERS": "2"}
+                with patch.dict(os.environ, env), \
+                        patch('main.process_single_pdf', side_effect=fake_process_single_pdf), \
+                        patch('main.create_clients', return_value=(MagicMock(), MagicMock(), MagicMock())), \
+                        patch('builtins.print'):
+                    finished = watch(poll_interval=0.05, settle_seconds=0, max_files=2)
+                self.assertEqual(finished, 2)
+                self.assertEqual(os.listdir("input_dir"), [])
+                self.assertEqual(os.listdir("processed_dir"), ["a.pdf"])
+                self.assertEqual(os.listdir("failed_dir"), ["bad.pdf"])
+            finally:
+                os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()